@@ -0,0 +1,315 @@
+"""Benchmarks for the austxt pipeline.
+
+    python -m benchmarks run --sizes 10,50 --workers 1,2,4 -o results.json
+    python -m benchmarks compare baseline.json results.json
+    python -m benchmarks startup
+
+Each case is run in a fresh interpreter so peak memory is measured per case.
+Stages that talk to Elasticsearch use an in-memory stand-in started by the
+runner.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import resource
+import subprocess
+from pathlib import Path
+
+import click
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_workdir(workdir):
+    # keep the query cache etc. out of the current directory, this needs to
+    # be set before austxt.config is imported
+    os.environ['AUSTXT_DATA_PATH'] = str(workdir)
+    os.environ.setdefault('AUSTXT_QUERY_CACHE', '0')
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument('path', type=click.Path(file_okay=False))
+@click.option('--days', default=10, type=int)
+@click.option('--speeches', default=120, type=int,
+              help="Speeches per sitting day.")
+@click.option('--seed', default=0, type=int)
+def generate(path, days, speeches, seed):
+    """Write a synthetic corpus of sitting day files"""
+    from .synthetic import generate_corpus
+    paths = generate_corpus(path, days, speeches=speeches, seed=seed)
+    print(f"{len(paths)} sitting days in {path}")
+
+
+@cli.command(name='serve-elastic')
+@click.option('--port', default=9200, type=int)
+def serve_elastic(port):
+    """Serve the Elasticsearch stand-in"""
+    from .fake_elastic import make_server
+    server = make_server(port)
+    print(f"listening on http://127.0.0.1:{server.server_address[1]}",
+          flush=True)
+    server.serve_forever()
+
+
+@cli.command()
+@click.argument('stage')
+@click.argument('corpus-path', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', default=1, type=int)
+@click.option('--elastic-url', default=None)
+def case(stage, corpus_path, workers, elastic_url):
+    """Run a single stage, printing its measurements as JSON"""
+    use_workdir(Path(corpus_path).parent)
+    from .stages import STAGES
+    setup, run, _, _ = STAGES[stage]
+    result = {'stage': stage, 'size': Path(corpus_path).name,
+              'workers': workers}
+    try:
+        state = setup(corpus_path, workers, elastic_url) if setup else None
+    except ImportError as error:
+        result['skipped'] = str(error)
+        print(json.dumps(result))
+        return
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    items = run(corpus_path, workers, state)
+    seconds = time.perf_counter() - start
+    result.update(
+        items=items,
+        seconds=round(seconds, 4),
+        items_per_sec=round(items / seconds, 2) if seconds else None,
+        setup_rss_mb=round(rss_before, 1),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        peak_child_rss_mb=round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+    )
+    print(json.dumps(result))
+
+
+def run_case(stage, corpus_path, workers, elastic_url):
+    command = [sys.executable, '-m', 'benchmarks', 'case', stage,
+               str(corpus_path), '--workers', str(workers)]
+    if elastic_url is not None:
+        command += ['--elastic-url', elastic_url]
+    process = subprocess.run(command, capture_output=True, text=True,
+                             cwd=Path(__file__).resolve().parent.parent)
+    if process.returncode != 0:
+        return {'stage': stage, 'size': corpus_path.name, 'workers': workers,
+                'error': process.stderr.strip().splitlines()[-1:]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+@cli.command()
+@click.option('--sizes', default='10,50', type=parse_ints,
+              help="Comma separated corpus sizes, in sitting days.")
+@click.option('--workers', 'worker_counts', default='1,2,4', type=parse_ints,
+              help="Comma separated worker counts for stages that use them.")
+@click.option('--stages', default=None,
+              help="Comma separated stages to run, defaults to all.")
+@click.option('--speeches', default=120, type=int,
+              help="Speeches per sitting day.")
+@click.option('--workdir', default='bench_data',
+              type=click.Path(file_okay=False),
+              help="Where generated corpora are kept between runs.")
+@click.option('-o', '--output', default=None, type=click.Path(dir_okay=False),
+              help="Save the results as JSON, for use as a baseline.")
+def run(sizes, worker_counts, stages, speeches, workdir, output):
+    """Run the benchmarks at each corpus size and number of workers"""
+    workdir = Path(workdir).resolve()
+    use_workdir(workdir)
+    from .synthetic import generate_corpus
+    from .stages import STAGES, prepare, xml_path
+    stage_names = stages.split(',') if stages else list(STAGES)
+
+    elastic = None
+    elastic_url = None
+    if any(STAGES[name][3] for name in stage_names):
+        port = free_port()
+        elastic = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks', 'serve-elastic',
+             '--port', str(port)],
+            stdout=subprocess.PIPE, text=True,
+            cwd=Path(__file__).resolve().parent.parent)
+        elastic.stdout.readline()
+        elastic_url = f"http://127.0.0.1:{port}"
+
+    results = []
+    try:
+        for size in sizes:
+            corpus_path = workdir / f"{size}_days_{speeches}"
+            generate_corpus(xml_path(corpus_path), size, speeches=speeches)
+            prepare(corpus_path, elastic_url)
+            for name in stage_names:
+                uses_workers = STAGES[name][2]
+                for workers in (worker_counts if uses_workers else [1]):
+                    result = run_case(name, corpus_path, workers, elastic_url)
+                    print(format_result(result), flush=True)
+                    results.append(result)
+    finally:
+        if elastic is not None:
+            elastic.terminate()
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'meta': {
+                'commit': git_commit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'speeches_per_day': speeches,
+            }, 'results': results}, f, indent=2)
+
+
+def format_result(result):
+    name = f"{result['stage']:<18} {result['size']:<14} {result['workers']:>2}"
+    if 'error' in result or 'skipped' in result:
+        return f"{name}  {result.get('error') or 'skipped: ' + result['skipped']}"
+    return (f"{name}  {result['items']:>8} items  {result['seconds']:>8.2f}s  "
+            f"{result['items_per_sec']:>10.1f}/s  "
+            f"peak {result['peak_rss_mb']:>7.1f}MB "
+            f"(workers {result['peak_child_rss_mb']:.1f}MB)")
+
+
+def case_key(result):
+    return result['stage'], result['size'], result['workers']
+
+
+@cli.command()
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=0.1, type=float,
+              help="Relative change in throughput or memory that counts as "
+              "a regression.")
+def compare(baseline, current, threshold):
+    """Compare results against a baseline, failing on regressions"""
+    baseline = {case_key(r): r for r in json.load(baseline)['results']
+                if 'items_per_sec' in r}
+    regressions = 0
+    for result in json.load(current)['results']:
+        before = baseline.get(case_key(result))
+        if before is None or 'items_per_sec' not in result:
+            continue
+        speed = result['items_per_sec'] / before['items_per_sec'] - 1
+        memory = result['peak_rss_mb'] / before['peak_rss_mb'] - 1
+        regressed = speed < -threshold or memory > threshold
+        regressions += regressed
+        flag = 'REGRESSED' if regressed else ''
+        print(f"{' '.join(map(str, case_key(result))):<40} "
+              f"throughput {speed:+7.1%}  memory {memory:+7.1%}  {flag}")
+    if regressions:
+        print(f"{regressions} regressions", file=sys.stderr)
+        sys.exit(1)
+
+
+# runs the CLI in a fresh interpreter, reporting the heavy modules it
+# imported on the last line of stderr
+STARTUP_SCRIPT = """
+import sys, json, atexit
+heavy = set(sys.argv.pop(1).split(','))
+atexit.register(lambda: print(json.dumps(sorted(
+    name for name in sys.modules if name.split('.')[0] in heavy)),
+    file=sys.stderr))
+from austxt.cli import cli
+cli(sys.argv[1:], prog_name='austxt')
+"""
+HEAVY_MODULES = ['pandas', 'pyarrow', 'numpy', 'lxml', 'spacy',
+                 'elasticsearch', 'scipy', 'flask']
+
+
+STARTUP_INDEX = 'startup'
+STARTUP_SPEECH = 'startup_speech'
+
+
+def time_command(args, heavy, repeat, env=None):
+    """The fastest of repeat runs of a CLI command, and what it imported"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, ','.join(heavy)] + args,
+            capture_output=True, text=True, env=env,
+            cwd=Path(__file__).resolve().parent.parent)
+        times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            raise click.ClickException(
+                f"{' '.join(args)} failed:\n{process.stderr}")
+    imported = json.loads(process.stderr.strip().splitlines()[-1])
+    return min(times), imported
+
+
+@cli.command()
+@click.option('--max-seconds', default=1.0, type=float,
+              help="Slowest acceptable startup.")
+@click.option('--max-run-seconds', default=3.0, type=float,
+              help="Slowest acceptable run of get-speech.")
+@click.option('--repeat', default=3, type=int)
+def startup(max_seconds, max_run_seconds, repeat):
+    """Check that the austxt CLI starts quickly, failing if it doesn't.
+
+    Showing help for the CLI and each of its commands should not import any
+    of the heavy dependencies that commands import when they run. Getting a
+    speech from the Elasticsearch stand-in is timed too, as a command that
+    does some work.
+    """
+    from austxt.cli import cli as austxt_cli
+    from .fake_elastic import serve_in_thread
+    commands = [(['--help'], max_seconds, HEAVY_MODULES, None)]
+    commands += [([name, '--help'], max_seconds, HEAVY_MODULES, None)
+                 for name in sorted(austxt_cli.commands)]
+
+    server, url = serve_in_thread()
+    server.elastic.indices[STARTUP_INDEX].add(
+        STARTUP_SPEECH, {'text': "The Senate met.", 'house': 'senate'})
+    env = dict(os.environ, AUSTXT_ELASTIC_ADDRESS=url,
+               AUSTXT_ELASTIC_USE_SSL='0')
+    # running a command imports what it needs, so only its time is checked
+    commands.append((['get-speech', STARTUP_SPEECH, '--backend', 'elastic',
+                      '--index-name', STARTUP_INDEX], max_run_seconds, [], env))
+
+    failures = 0
+    try:
+        for args, limit, heavy, env in commands:
+            seconds, imported = time_command(args, heavy, repeat, env)
+            failed = seconds > limit or bool(imported)
+            failures += failed
+            flag = 'FAILED' if failed else ''
+            print(f"{' '.join(args):<30} {seconds:6.3f}s  "
+                  f"{', '.join(imported)}  {flag}")
+    finally:
+        server.shutdown()
+    if failures:
+        print(f"{failures} commands start slowly or import heavy modules",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,412 @@
+"""An in-memory stand-in for the Elasticsearch endpoints austxt uses.
+
+It speaks enough of the HTTP API for the bulk, search, scroll, msearch,
+mtermvectors, mget, analyze and get calls made by austxt.elastic, including
+the filters, aggregations and highlighting of its searches. Text is analyzed with
+austxt.analysis so results match the local index. It is meant for
+measuring the client side of indexing and querying, not Elasticsearch
+itself.
+"""
+import json
+import uuid
+import threading
+from fnmatch import fnmatch
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from austxt.analysis import analyze, analyze_word, tokenize
+
+
+class FakeIndex:
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = defaultdict(dict)
+
+    def add(self, doc_id, source):
+        if doc_id in self.docs:
+            self.remove(doc_id)
+        self.docs[doc_id] = source
+        for term, position in analyze(source.get('text') or ''):
+            self.postings[term].setdefault(doc_id, []).append(position)
+
+    def remove(self, doc_id):
+        for term, _ in analyze(self.docs.pop(doc_id).get('text') or ''):
+            self.postings[term].pop(doc_id, None)
+
+    def search(self, query):
+        """Return the ids of the documents matching a match or match_phrase,
+        which may be filtered in a bool query"""
+        if 'bool' in query:
+            clauses = query['bool'].get('filter', [])
+            return [doc for doc in self.search(query['bool']['must'])
+                    if all(self.passes(doc, clause) for clause in clauses)]
+        if 'match_phrase' in query:
+            text = next(iter(query['match_phrase'].values()))
+            terms = analyze(text)
+            docs = self.matching(terms, 'and')
+            if len(terms) < 2:
+                return docs
+            return [doc for doc in docs if self.phrase_in(terms, doc)]
+        if 'match' in query:
+            match = next(iter(query['match'].values()))
+            return self.matching(analyze(match['query']),
+                                 match.get('operator', 'or'))
+        return list(self.docs)
+
+    def matching(self, terms, operator):
+        sets = [set(self.postings.get(term, ())) for term, _ in terms]
+        if not sets:
+            return []
+        docs = set.intersection(*sets) if operator == 'and' else set.union(
+            *sets)
+        return sorted(docs)
+
+    def passes(self, doc, clause):
+        source = self.docs[doc]
+        if 'range' in clause:
+            field, bounds = next(iter(clause['range'].items()))
+            value = source.get(field)
+            return (value is not None and
+                    bounds.get('gte', value) <= value <= bounds.get('lte',
+                                                                    value))
+        if 'ids' in clause:
+            return doc in clause['ids']['values']
+        field, values = next(iter(clause['terms'].items()))
+        return source.get(field) in values
+
+    def phrase_starts(self, terms, doc):
+        start = terms[0][1]
+        starts = None
+        for term, position in terms:
+            term_starts = {p - (position - start)
+                           for p in self.postings[term].get(doc, ())}
+            starts = term_starts if starts is None else starts & term_starts
+        return starts
+
+    def phrase_in(self, terms, doc):
+        return bool(self.phrase_starts(terms, doc))
+
+    def frequency(self, query, doc):
+        """The score of a document under a term frequency similarity"""
+        if 'bool' in query:
+            query = query['bool']['must']
+        if 'match_phrase' in query:
+            terms = analyze(next(iter(query['match_phrase'].values())))
+            if len(terms) > 1:
+                return len(self.phrase_starts(terms, doc))
+        else:
+            terms = analyze(next(iter(query['match'].values()))['query'])
+        return sum(len(self.postings[term].get(doc, ())) for term, _ in terms)
+
+    def highlight(self, query, doc, tags):
+        """The text of a document with each matching word wrapped in tags,
+        a word at a time like the unified highlighter"""
+        if 'bool' in query:
+            query = query['bool']['must']
+        if 'match_phrase' in query:
+            terms = analyze(next(iter(query['match_phrase'].values())))
+            first = terms[0][1] if terms else 0
+            positions = {start + position - first
+                         for start in self.phrase_starts(terms, doc)
+                         for _, position in terms} if len(terms) > 1 else None
+        else:
+            terms = analyze(next(iter(query['match'].values()))['query'])
+            positions = None
+        wanted = {term for term, _ in terms}
+        text = self.docs[doc].get('text') or ''
+        parts, last = [], 0
+        for position, (word, start, end) in enumerate(tokenize(text)):
+            if analyze_word(word) in wanted and (positions is None or
+                                                 position in positions):
+                parts.extend([text[last:start], tags[0], word, tags[1]])
+                last = end
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def term_vectors(self, doc_id, positions):
+        terms = {}
+        for term, position in analyze(self.docs[doc_id].get('text') or ''):
+            entry = terms.setdefault(term, {'term_freq': 0})
+            entry['term_freq'] += 1
+            if positions:
+                entry.setdefault('tokens', []).append({'position': position})
+        return terms
+
+
+class FakeElastic:
+
+    def __init__(self):
+        self.indices = defaultdict(FakeIndex)
+        self.aliases = defaultdict(set)
+        self.scrolls = {}
+        # the number of bulk requests to reject as if the queue were full
+        self.rejections = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, name):
+        """The name of the index an alias points to, or the name itself"""
+        if self.aliases.get(name):
+            return next(iter(self.aliases[name]))
+        return name
+
+    def update_aliases(self, actions):
+        with self.lock:
+            for action in actions:
+                kind, params = next(iter(action.items()))
+                if kind == 'add':
+                    self.aliases[params['alias']].add(params['index'])
+                elif kind == 'remove':
+                    self.aliases[params['alias']].discard(params['index'])
+                elif kind == 'remove_index':
+                    self.indices.pop(params['index'], None)
+
+    def bulk(self, lines, default_index=None):
+        items = []
+        with self.lock:
+            if self.rejections:
+                self.rejections -= 1
+                for action_line in lines[::2]:
+                    op, meta = next(iter(json.loads(action_line).items()))
+                    items.append({op: {'_id': meta['_id'], 'status': 429,
+                                       'error': 'rejected'}})
+                return {'took': 1, 'errors': True, 'items': items}
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                op, meta = next(iter(json.loads(action_line).items()))
+                index = self.indices[self.resolve(
+                    meta.get('_index', default_index))]
+                index.add(meta['_id'], json.loads(source_line))
+                items.append({op: {'_id': meta['_id'], 'status': 201}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def search(self, index_name, body, size, scroll=False):
+        index_name = self.resolve(index_name)
+        index = self.indices[index_name]
+        hits = index.search(body.get('query', {}))
+        offset = body.get('from', 0)
+        response = {'took': 1, 'timed_out': False,
+                    '_shards': {'total': 1, 'successful': 1,
+                                'skipped': 0, 'failed': 0},
+                    'hits': {'total': len(hits), 'hits': [
+                        {'_id': doc_id, '_index': index_name}
+                        for doc_id in hits[offset:offset + size]]}}
+        if 'highlight' in body:
+            tags = body['highlight']['pre_tags'][0], body['highlight'][
+                'post_tags'][0]
+            for hit in response['hits']['hits']:
+                hit['highlight'] = {'text': [index.highlight(
+                    body['query'], hit['_id'], tags)]}
+        if 'aggs' in body:
+            response['aggregations'] = {'periods': {'buckets': self.periods(
+                index, hits, body['query'], body['aggs']['periods'])}}
+        if scroll:
+            scroll_id = uuid.uuid4().hex
+            with self.lock:
+                self.scrolls[scroll_id] = (index_name, hits[size:], size)
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def periods(self, index, hits, query, aggregation):
+        """Buckets of a date_histogram, in the shape made by do_aggregate"""
+        interval = aggregation['date_histogram']['interval']
+        periods = defaultdict(list)
+        for doc in hits:
+            date = index.docs[doc].get('date')
+            if date is not None:
+                periods[period_start(date, interval)].append(doc)
+        return [dict(self.bucket(index, periods[key], query,
+                                 aggregation['aggs']), key_as_string=key)
+                for key in sorted(periods)]
+
+    def bucket(self, index, docs, query, aggs):
+        bucket = {'doc_count': len(docs)}
+        if 'tf' in aggs:
+            bucket['tf'] = {'value': float(sum(index.frequency(query, doc)
+                                               for doc in docs))}
+        if 'groups' in aggs:
+            terms = aggs['groups']['terms']
+            groups = defaultdict(list)
+            for doc in docs:
+                groups[index.docs[doc].get(terms['field'],
+                                           terms.get('missing'))].append(doc)
+            bucket['groups'] = {'buckets': [
+                dict(self.bucket(index, group_docs, query,
+                                 aggs['groups']['aggs']), key=key)
+                for key, group_docs in sorted(groups.items(),
+                                              key=lambda g: -len(g[1]))]}
+        return bucket
+
+    def scroll(self, scroll_id):
+        with self.lock:
+            index_name, hits, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (index_name, hits[size:], size)
+        return {'_scroll_id': scroll_id, 'took': 1, 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1,
+                            'skipped': 0, 'failed': 0},
+                'hits': {'hits': [{'_id': doc_id, '_index': index_name}
+                                  for doc_id in hits[:size]]}}
+
+
+def period_start(date, interval):
+    if interval == 'year':
+        return f"{date[:4]}-01-01"
+    month = int(date[5:7])
+    if interval == 'quarter':
+        month = (month - 1) // 3 * 3 + 1
+    return f"{date[:4]}-{month:02}-01"
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep connections alive, as Elasticsearch does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def do_HEAD(self):
+        elastic = self.server.elastic
+        name = self.path.strip('/').split('?')[0]
+        exists = (not name or name in elastic.indices or
+                  bool(elastic.aliases.get(name)))
+        self.send_json({}, 200 if exists else 404)
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def do_PUT(self):
+        self.route()
+
+    def do_DELETE(self):
+        self.read_body()
+        name = urlparse(self.path).path.strip('/')
+        if not name.startswith('_'):
+            self.server.elastic.indices.pop(name, None)
+            return self.send_json({'acknowledged': True})
+        self.send_json({'succeeded': True})
+
+    def route(self):
+        elastic = self.server.elastic
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        raw = self.read_body()
+        endpoint = parts[-1] if parts else ''
+        index_name = parts[0] if parts and not parts[0].startswith('_') \
+            else None
+        if index_name is not None and self.command != 'PUT':
+            index_name = elastic.resolve(index_name)
+
+        if endpoint == '_bulk':
+            lines = [line for line in raw.split('\n') if line]
+            return self.send_json(elastic.bulk(lines, index_name))
+        if endpoint == '_msearch':
+            lines = [line for line in raw.split('\n') if line]
+            responses = [elastic.search(index_name, json.loads(body),
+                                        json.loads(body).get('size', 10))
+                         for body in lines[1::2]]
+            return self.send_json({'responses': responses})
+        if parts[:2] == ['_search', 'scroll']:
+            body = json.loads(raw) if raw else {}
+            return self.send_json(elastic.scroll(
+                body.get('scroll_id') or params['scroll_id']))
+        if endpoint == '_search':
+            body = json.loads(raw) if raw else {}
+            size = int(params.get('size', body.get('size', 10)))
+            return self.send_json(elastic.search(index_name, body, size,
+                                                 scroll='scroll' in params))
+        if endpoint == '_mtermvectors':
+            body = json.loads(raw)
+            positions = body.get('parameters', {}).get('positions', False)
+            index = elastic.indices[index_name]
+            return self.send_json({'docs': [
+                {'_id': doc_id, '_index': index_name, 'found': True,
+                 'term_vectors': {'text': {
+                     'terms': index.term_vectors(doc_id, positions)}}}
+                for doc_id in body['ids'] if doc_id in index.docs]})
+        if endpoint == '_mget':
+            index = elastic.indices[index_name]
+            fields = params.get('_source_includes')
+            docs = []
+            for doc_id in json.loads(raw)['ids']:
+                doc = {'_id': doc_id, '_index': index_name,
+                       'found': doc_id in index.docs}
+                if doc['found']:
+                    source = index.docs[doc_id]
+                    if fields:
+                        source = {field: source.get(field)
+                                  for field in fields.split(',')}
+                    doc['_source'] = source
+                docs.append(doc)
+            return self.send_json({'docs': docs})
+        if endpoint == '_analyze':
+            body = json.loads(raw)
+            return self.send_json({'tokens': [
+                {'token': term, 'position': position}
+                for term, position in analyze(body['text'])]})
+        if endpoint == '_aliases':
+            elastic.update_aliases(json.loads(raw)['actions'])
+            return self.send_json({'acknowledged': True})
+        if parts[:1] == ['_alias']:
+            indices = {name: {'aliases': {parts[1]: {}}}
+                       for name in elastic.aliases.get(parts[1], ())}
+            return self.send_json(indices, 200 if indices else 404)
+        if len(parts) == 2 and endpoint == '_alias':
+            if index_name not in elastic.indices:
+                return self.send_json({'error': 'index_not_found'}, 404)
+            aliases = {alias: {} for alias, names in elastic.aliases.items()
+                       if index_name in names}
+            return self.send_json({index_name: {'aliases': aliases}})
+        if parts[:2] == ['_cluster', 'health']:
+            return self.send_json({'status': 'green', 'timed_out': False})
+        if endpoint in ('_settings', '_refresh'):
+            return self.send_json({'acknowledged': True})
+        if len(parts) == 3 and self.command == 'GET':
+            index = elastic.indices[index_name]
+            found = parts[2] in index.docs
+            response = {'_index': index_name, '_id': parts[2], 'found': found}
+            if found:
+                response['_source'] = index.docs[parts[2]]
+            return self.send_json(response, 200 if found else 404)
+        if len(parts) == 1 and self.command == 'PUT':
+            elastic.indices[parts[0]]
+            return self.send_json({'acknowledged': True, 'index': parts[0]})
+        if len(parts) == 1 and self.command == 'GET':
+            return self.send_json({
+                name: {} for name in list(elastic.indices)
+                if fnmatch(name, parts[0])})
+        if not parts:
+            return self.send_json({'acknowledged': True})
+        self.send_json({'error': f"unsupported: {self.command} {url.path}"},
+                       400)
+
+
+def make_server(port=0):
+    """A server on localhost, port 0 picks a free port"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.elastic = FakeElastic()
+    return server
+
+
+def serve_in_thread(port=0):
+    server = make_server(port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,177 @@
+"""The stages of the pipeline being measured.
+
+Each stage is a function of a prepared corpus directory and a number of
+workers that does its work and returns the number of items it handled.
+Set up that shouldn't be timed goes in the stage's setup function.
+"""
+from pathlib import Path
+
+from austxt import elastic
+from austxt.process import process_speeches, write_speeches
+from austxt.datasets import read_dataset, iter_dataset
+from austxt.local_index import build_local_index, LocalIndex
+from austxt.backends import ElasticBackend
+from austxt.kwic import kwic
+from austxt.pipeline import ingest
+from austxt.utils import (query_term_frequencies, query_to_column_name,
+                          add_results_columns)
+
+
+SPEECHES_NAME = 'speeches'
+QUERIES = [
+    ('climate change', 'exact'),
+    ('carbon price', 'exact'),
+    ('tax', 'and'),
+    ('health education', 'and'),
+    ('drought farmers water', 'or'),
+    ('asylum refugees', 'or'),
+]
+
+
+def xml_path(corpus_path):
+    return Path(corpus_path) / 'xml'
+
+
+def speeches_path(corpus_path):
+    return Path(corpus_path) / f"{SPEECHES_NAME}_full.csv"
+
+
+def local_index_path(corpus_path):
+    return Path(corpus_path) / 'local_index'
+
+
+def elastic_index_name(corpus_path):
+    return f"bench_{Path(corpus_path).name}"
+
+
+def connect(elastic_url, workers):
+    # the package's own client needs TLS, the stand-in doesn't
+    from elasticsearch import Elasticsearch
+    elastic.ELASTIC = Elasticsearch(elastic_url, timeout=100,
+                                    maxsize=max(workers, 10))
+
+
+def prepare(corpus_path, elastic_url=None):
+    """Make the datasets and indexes that later stages start from"""
+    if not speeches_path(corpus_path).exists():
+        batches = process_speeches(xml_path(corpus_path), 'senate', None,
+                                   False, None, None, 1)
+        write_speeches(batches, corpus_path, SPEECHES_NAME)
+    if not (local_index_path(corpus_path) / 'meta.json').exists():
+        build_local_index(speeches_path(corpus_path),
+                          local_index_path(corpus_path))
+    if elastic_url is not None:
+        connect(elastic_url, 4)
+        elastic.index_speeches(speeches_path(corpus_path),
+                               elastic_index_name(corpus_path), None, 4)
+
+
+def parse(corpus_path, workers, setup):
+    batches = process_speeches(xml_path(corpus_path), 'senate', None, False,
+                               None, None, workers)
+    return sum(len(batch) for batch in batches)
+
+
+def clean_setup(corpus_path, workers, elastic_url):
+    from austxt.text import get_nlp
+    # loading the model isn't part of cleaning
+    get_nlp()
+    return list(iter_dataset(speeches_path(corpus_path), chunk_size=10000))
+
+
+def clean(corpus_path, workers, frames):
+    from austxt.text import clean_frames
+    return sum(len(frame) for frame in clean_frames(iter(frames),
+                                                    workers=workers))
+
+
+def index_setup(corpus_path, workers, elastic_url):
+    connect(elastic_url, workers)
+
+
+def index(corpus_path, workers, setup):
+    count, _ = elastic.index_speeches(
+        speeches_path(corpus_path),
+        f"{elastic_index_name(corpus_path)}_{workers}", None, workers)
+    return count
+
+
+def ingest_setup(corpus_path, workers, elastic_url):
+    connect(elastic_url, workers)
+
+
+def ingest_all(corpus_path, workers, setup):
+    # both houses from the same files, parsed, written and indexed at once
+    name = f"ingest_{workers}"
+    counts = ingest({'senate': xml_path(corpus_path),
+                     'representatives': xml_path(corpus_path)},
+                    output_path=Path(corpus_path) / name,
+                    alias=f"{elastic_index_name(corpus_path)}_{name}",
+                    parse_workers=workers, index_workers=workers)
+    return sum(counts.values())
+
+
+def query_elastic_setup(corpus_path, workers, elastic_url):
+    connect(elastic_url, workers)
+
+
+def query_elastic(corpus_path, workers, setup):
+    results = query_term_frequencies(QUERIES, elastic_index_name(corpus_path),
+                                     concurrency=workers)
+    return sum(map(len, results))
+
+
+def kwic_setup(corpus_path, workers, elastic_url):
+    connect(elastic_url, workers)
+    results = query_term_frequencies(QUERIES, elastic_index_name(corpus_path))
+    return [[doc for doc, _ in result] for result in results]
+
+
+def kwic_elastic(corpus_path, workers, hits):
+    backend = ElasticBackend(elastic_index_name(corpus_path))
+    return sum(len(list(kwic(backend, speech_ids, query, query_type)))
+               for (query, query_type), speech_ids in zip(QUERIES, hits))
+
+
+def build_index(corpus_path, workers, setup):
+    path = Path(corpus_path) / f"local_index_{workers}"
+    build_local_index(speeches_path(corpus_path), path, workers)
+    return LocalIndex(path).meta['num_docs']
+
+
+def query_local_setup(corpus_path, workers, elastic_url):
+    return LocalIndex(local_index_path(corpus_path))
+
+
+def query_local(corpus_path, workers, index):
+    results = [index.term_frequencies(query, query_type)
+               for query, query_type in QUERIES]
+    return sum(map(len, results))
+
+
+def dataset_setup(corpus_path, workers, elastic_url):
+    index = LocalIndex(local_index_path(corpus_path))
+    results = {query_to_column_name(query, query_type):
+               index.term_frequencies(query, query_type)
+               for query, query_type in QUERIES}
+    dataset_df = read_dataset(speeches_path(corpus_path)).drop('text', axis=1)
+    return dataset_df, results
+
+
+def dataset(corpus_path, workers, setup):
+    dataset_df, results = setup
+    return len(add_results_columns(dataset_df, results))
+
+
+# name: (setup, run, whether it uses workers, whether it needs elastic)
+STAGES = {
+    'parse': (None, parse, True, False),
+    'clean': (clean_setup, clean, True, False),
+    'index': (index_setup, index, True, True),
+    'ingest': (ingest_setup, ingest_all, True, True),
+    'query-elastic': (query_elastic_setup, query_elastic, True, True),
+    'kwic-elastic': (kwic_setup, kwic_elastic, False, True),
+    'build-local-index': (None, build_index, True, False),
+    'query-local': (query_local_setup, query_local, False, False),
+    'dataset': (dataset_setup, dataset, False, False),
+}
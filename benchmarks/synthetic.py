@@ -0,0 +1,115 @@
+"""Synthetic Hansard sitting day files shaped like the Open Australia dumps.
+
+Each day has a few major and minor headings, each followed by a debate of
+speeches and short interjections. Speech lengths are log-normally
+distributed and words are drawn from a Zipf distribution over a fixed
+vocabulary, so term frequencies look roughly like real debate.
+"""
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+from lxml import etree
+
+
+ID_PREFIX = 'uk.org.publicwhip'
+COMMON_WORDS = """
+    the of to and a in that is for it this be on government not have are with
+    as we by was will minister bill i senator they has from at an which all
+    their would but he been there australia people what or these its our more
+    should do so can about one those if time no were must other who into also
+    very support any amendment labor coalition budget tax climate change
+    health education states funding committee member report question debate
+    policy economy energy carbon price water workers industry families motion
+    national act legislation commonwealth state services community public
+    security defence immigration asylum refugees farmers drought mining jobs
+""".split()
+SPEAKERS = 300
+FIRST_SPEAKER_ID = 100001
+
+
+def make_vocabulary(size, rng):
+    """Common debate words followed by made up words of typical lengths"""
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = list(dict.fromkeys(COMMON_WORDS))
+    while len(words) < size:
+        length = int(rng.integers(3, 12))
+        words.append(''.join(rng.choice(letters, length)))
+    return np.array(words[:size])
+
+
+def make_text(vocabulary, num_words, rng):
+    ranks = np.minimum(rng.zipf(1.3, num_words), len(vocabulary)) - 1
+    return ' '.join(vocabulary[ranks])
+
+
+def add_paragraphs(speech, vocabulary, num_words, rng):
+    while num_words > 0:
+        paragraph_words = min(num_words, int(rng.integers(20, 120)))
+        p = etree.SubElement(speech, 'p')
+        p.text = make_text(vocabulary, paragraph_words, rng) + '.'
+        if rng.random() < 0.1:
+            # inline formatting, which is stripped when parsing
+            emphasis = etree.SubElement(p, rng.choice(['i', 'b']))
+            emphasis.text = make_text(vocabulary, 3, rng)
+            emphasis.tail = ' ' + make_text(vocabulary, 5, rng) + '.'
+        num_words -= paragraph_words
+
+
+def sitting_day(day, house, vocabulary, rng, speeches=120):
+    """Build the XML tree of a sitting day with about this many speeches"""
+    root = etree.Element('debates')
+    house_path = 'lords' if house == 'senate' else 'debate'
+    minutes = 9 * 60 + 30
+    section = 0
+    for i in range(speeches):
+        if i == 0 or rng.random() < 0.08:
+            section += 1
+            heading = etree.SubElement(root, 'major-heading', id=(
+                f"{ID_PREFIX}/{house_path}/{day}.{section}.0"))
+            heading.text = make_text(vocabulary, 4, rng).title()
+            etree.SubElement(root, 'minor-heading').text = make_text(
+                vocabulary, 6, rng)
+
+        interjection = rng.random() < 0.25
+        speaker = int(rng.integers(SPEAKERS)) + FIRST_SPEAKER_ID
+        attributes = {
+            'id': f"{ID_PREFIX}/{house_path}/{day}.{section}.{i + 1}",
+            'talktype': 'interjection' if interjection else 'speech',
+            'time': f"{minutes // 60 % 24:02d}:{minutes % 60:02d}:00",
+            'speakername': f"Speaker {speaker}",
+            'speakerid': f"{ID_PREFIX}/member/{speaker}",
+        }
+        if interjection and rng.random() < 0.2:
+            # interjections from the floor, which are skipped
+            attributes.update(speakername='Honourable senators',
+                              speakerid='unknown')
+        num_words = (int(rng.integers(3, 30)) if interjection else
+                     int(rng.lognormal(6, 0.8)))
+        attributes['approximate_duration'] = str(num_words * 60 // 130)
+        minutes += max(1, num_words // 130)
+        speech = etree.SubElement(root, 'speech', **attributes)
+        add_paragraphs(speech, vocabulary, num_words, rng)
+    return etree.ElementTree(root)
+
+
+def generate_corpus(path, days, house='senate', speeches=120,
+                    vocabulary_size=50000, seed=0):
+    """Write sitting day files to path, skipping any that already exist"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    day = date(2010, 2, 2)
+    paths = []
+    for i in range(days):
+        xml_path = path / f"{day.isoformat()}.xml"
+        paths.append(xml_path)
+        if not xml_path.exists():
+            # each day has its own seed so days don't depend on the others
+            day_rng = np.random.default_rng([seed, i])
+            tree = sitting_day(day.isoformat(), house, vocabulary, day_rng,
+                               speeches)
+            tree.write(str(xml_path), encoding='utf-8', xml_declaration=True)
+        day += timedelta(days=1 if day.weekday() < 3 else 5)
+    return paths
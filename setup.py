@@ -11,11 +11,12 @@ setup(
         'WTForms',
         'unidecode',
         'pandas',
-        'spacy',
+        'pyarrow',
+        'spacy>=2.2.2',
         'en_core_web_sm',
         'elasticsearch'
     ],
-    dependency_links=['https://github.com/explosion/spacy-models/releases/download/en_core_web_sm-2.0.0/en_core_web_sm-2.0.0.tar.gz#egg=en_core_web_sm-2.0.0'],
+    dependency_links=['https://github.com/explosion/spacy-models/releases/download/en_core_web_sm-2.2.0/en_core_web_sm-2.2.0.tar.gz#egg=en_core_web_sm-2.2.0'],
     packages=find_packages('src'),
     package_dir={'': 'src'},
     entry_points={'console_scripts': [
@@ -0,0 +1,243 @@
+"""An approximation of Elasticsearch's english analyzer.
+
+Text is split into words much like the standard tokenizer, possessives are
+removed, words are lowercased, stop words are dropped (keeping their
+positions, as Lucene does) and the rest are reduced with the Porter stemmer.
+"""
+import re
+
+
+# Lucene's EnglishAnalyzer.ENGLISH_STOP_WORDS_SET
+STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+    "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the",
+    "their", "then", "there", "these", "they", "this", "to", "was", "will",
+    "with",
+])
+
+# words may contain apostrophes and full stops between letters, and numbers
+# may contain commas between digits
+TOKEN_RE = re.compile(r"\w+(?:(?:['’.]|(?<=\d),(?=\d))\w+)*")
+POSSESSIVE_RE = re.compile(r"['’][sS]$")
+
+
+def tokenize(text):
+    """Yield (word, start, end) for each word in text"""
+    for match in TOKEN_RE.finditer(text):
+        yield match.group(), match.start(), match.end()
+
+
+def analyze(text):
+    """Return a list of (term, position) for the terms in text"""
+    terms = []
+    for position, (word, _, _) in enumerate(tokenize(text)):
+        term = analyze_word(word)
+        if term is not None:
+            terms.append((term, position))
+    return terms
+
+
+def analyze_word(word):
+    word = POSSESSIVE_RE.sub('', word).lower()
+    if word in STOP_WORDS:
+        return None
+    return stem(word)
+
+
+class PorterStemmer:
+    """The reference implementation of the Porter stemmer used by Lucene"""
+
+    def __init__(self, word):
+        self.b = list(word)
+        self.k = len(word) - 1
+        self.j = 0
+
+    def cons(self, i):
+        ch = self.b[i]
+        if ch in 'aeiou':
+            return False
+        if ch == 'y':
+            return i == 0 or not self.cons(i - 1)
+        return True
+
+    def m(self):
+        """The number of consonant sequences between 0 and j"""
+        n = 0
+        i = 0
+        while True:
+            if i > self.j:
+                return n
+            if not self.cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > self.j:
+                    return n
+                if self.cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > self.j:
+                    return n
+                if not self.cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def vowel_in_stem(self):
+        return any(not self.cons(i) for i in range(self.j + 1))
+
+    def double_cons(self, j):
+        return j >= 1 and self.b[j] == self.b[j - 1] and self.cons(j)
+
+    def cvc(self, i):
+        return (i >= 2 and self.cons(i) and not self.cons(i - 1) and
+                self.cons(i - 2) and self.b[i] not in 'wxy')
+
+    def ends(self, s):
+        length = len(s)
+        if length > self.k + 1:
+            return False
+        if ''.join(self.b[self.k - length + 1:self.k + 1]) != s:
+            return False
+        self.j = self.k - length
+        return True
+
+    def set_to(self, s):
+        self.b[self.j + 1:] = list(s)
+        self.k = self.j + len(s)
+
+    def replace(self, s):
+        if self.m() > 0:
+            self.set_to(s)
+
+    def step1ab(self):
+        b = self.b
+        if b[self.k] == 's':
+            if self.ends('sses'):
+                self.k -= 2
+            elif self.ends('ies'):
+                self.set_to('i')
+            elif b[self.k - 1] != 's':
+                self.k -= 1
+            del b[self.k + 1:]
+        if self.ends('eed'):
+            if self.m() > 0:
+                self.k -= 1
+        elif (self.ends('ed') or self.ends('ing')) and self.vowel_in_stem():
+            self.k = self.j
+            if self.ends('at'):
+                self.set_to('ate')
+            elif self.ends('bl'):
+                self.set_to('ble')
+            elif self.ends('iz'):
+                self.set_to('ize')
+            elif self.double_cons(self.k):
+                self.k -= 1
+                if b[self.k] in 'lsz':
+                    self.k += 1
+            elif self.m() == 1 and self.cvc(self.k):
+                self.set_to('e')
+        del b[self.k + 1:]
+
+    def step1c(self):
+        if self.ends('y') and self.vowel_in_stem():
+            self.b[self.k] = 'i'
+
+    def apply_suffixes(self, suffixes):
+        for suffix, replacement in suffixes:
+            if self.ends(suffix):
+                self.replace(replacement)
+                return
+
+    def step2(self):
+        self.apply_suffixes(STEP2_SUFFIXES.get(self.b[self.k - 1], ()))
+
+    def step3(self):
+        self.apply_suffixes(STEP3_SUFFIXES.get(self.b[self.k], ()))
+
+    def step4(self):
+        for suffix in STEP4_SUFFIXES.get(self.b[self.k - 1], ()):
+            if not self.ends(suffix):
+                continue
+            if suffix == 'ion' and not (self.j >= 0 and
+                                        self.b[self.j] in 'st'):
+                continue
+            break
+        else:
+            return
+        if self.m() > 1:
+            self.k = self.j
+
+    def step5(self):
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            a = self.m()
+            if a > 1 or (a == 1 and not self.cvc(self.k - 1)):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self.double_cons(self.k) and self.m() > 1:
+            self.k -= 1
+
+    def stem(self):
+        if self.k <= 1:
+            return ''.join(self.b)
+        self.step1ab()
+        if self.k > 0:
+            self.step1c()
+            self.step2()
+            self.step3()
+            self.step4()
+            self.step5()
+        return ''.join(self.b[:self.k + 1])
+
+
+STEP2_SUFFIXES = {
+    'a': [('ational', 'ate'), ('tional', 'tion')],
+    'c': [('enci', 'ence'), ('anci', 'ance')],
+    'e': [('izer', 'ize')],
+    'l': [('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+          ('ousli', 'ous')],
+    'o': [('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')],
+    's': [('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'),
+          ('ousness', 'ous')],
+    't': [('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')],
+    'g': [('logi', 'log')],
+}
+
+STEP3_SUFFIXES = {
+    'e': [('icate', 'ic'), ('ative', ''), ('alize', 'al')],
+    'i': [('iciti', 'ic')],
+    'l': [('ical', 'ic'), ('ful', '')],
+    's': [('ness', '')],
+}
+
+STEP4_SUFFIXES = {
+    'a': ['al'],
+    'c': ['ance', 'ence'],
+    'e': ['er'],
+    'i': ['ic'],
+    'l': ['able', 'ible'],
+    'n': ['ant', 'ement', 'ment', 'ent'],
+    'o': ['ion', 'ou'],
+    's': ['ism'],
+    't': ['ate', 'iti'],
+    'u': ['ous'],
+    'v': ['ive'],
+    'z': ['ize'],
+}
+
+STEM_CACHE = {}
+
+
+def stem(word):
+    try:
+        return STEM_CACHE[word]
+    except KeyError:
+        stemmed = PorterStemmer(word).stem()
+        if len(STEM_CACHE) < 500000:
+            STEM_CACHE[word] = stemmed
+        return stemmed
@@ -1,30 +1,122 @@
 import os
+import re
+import json
+import time
+import threading
 
-import pandas as pd
-from flask import Flask, render_template, request, abort, send_from_directory
-from werkzeug.security import safe_join
+import numpy as np
+from flask import (Flask, Response, render_template, request, abort,
+                   redirect, url_for, jsonify, send_from_directory, g)
 
-from .utils import get_download_path, make_query_form
-from .. import config
-from ..utils import (process_query_result, query_to_column_name,
-                     add_results_to_dataframe)
-from ..elastic import global_elastic, do_query
+from .utils import make_query_form
+from .jobs import JobQueue, DONE, save_results, load_results, start_sweeper
+from .streaming import stream_csv_gzip, stream_parquet
+from .. import config, metrics
+from ..config import FILTERS, INTERVALS, GROUPS
+from ..utils import query_to_column_name, result_column
+from ..backends import get_backend
+from ..kwic import kwic, SnippetCache, DEFAULT_WIDTH, MAX_WIDTH
+from ..store import load_store
 
 
 app = Flask(__name__)
 QueryForm = make_query_form()
+JOB_ID_RE = re.compile(r'^[0-9a-f]+$')
+KWIC_PAGE_SIZE = 100
+MAX_KWIC_PAGE_SIZE = 1000
 
 
-@app.before_first_request
-def run_on_start():
-    global SENATES_DF
-    global REPRESENTATIVES_DF
-    SENATES_DF = pd.read_csv(config.SENATES_CSV_PATH)
-    REPRESENTATIVES_DF = pd.read_csv(config.REPRESENTATIVES_CSV_PATH)
+DATASET_PATHS = {
+    "senate": config.SENATES_PATH,
+    "representatives": config.REPRESENTATIVES_PATH,
+}
+# the datasets are mapped from the store when the app is imported, so with
+# gunicorn --preload they're loaded once and shared by every worker
+STORES = {name: load_store(path, config.STORE_PATH, name)
+          for name, path in DATASET_PATHS.items()}
+BACKEND = get_backend()
+SNIPPETS = SnippetCache()
 
 # TODO:
 # -- style the page
 
+
+def result_columns(store, results):
+    return {column_name: result_column(parsed_results, store.rows)
+            for column_name, parsed_results in results.items()}
+
+
+def build_dataset(job):
+    """Build the query datasets for a job, returning counts and file names"""
+    job.update(message="Running queries", progress=0.1)
+    results = BACKEND.query_term_frequencies(job.queries,
+                                             filters=job.filters)
+
+    # add a column with the results of each query to the original datasets
+    new_columns = [query_to_column_name(query, query_type)
+                   for query, query_type in job.queries]
+    results = dict(zip(new_columns, results))
+    save_results(job.path, results)
+    counts, files = {}, {}
+    for i, (name, store) in enumerate(STORES.items()):
+        columns = result_columns(store, results)
+        # get the counts of our results
+        counts[name] = {col: int(np.count_nonzero(values))
+                        for col, values in columns.items()}
+        if config.STREAM_DOWNLOADS:
+            # the dataset is built again from the results when downloaded
+            continue
+        job.update(message=f"Writing {name} dataset",
+                   progress=0.5 + 0.25 * i)
+        filename = f"{name}_speeches_query.csv.gz"
+        with open(job.path / filename, 'wb') as f:
+            for data in stream_csv_gzip(store.iter_frames(columns)):
+                f.write(data)
+        files[name] = filename
+    return {'counts': counts, 'files': files}
+
+
+# threads don't survive a fork, so with gunicorn --preload the job queue and
+# sweeper are started in each worker on its first request, not on import
+JOBS = None
+JOBS_PID = None
+JOBS_LOCK = threading.Lock()
+
+
+@app.before_request
+def start_jobs():
+    global JOBS, JOBS_PID
+    if JOBS_PID == os.getpid():
+        return
+    with JOBS_LOCK:
+        if JOBS_PID != os.getpid():
+            JOBS = JobQueue(build_dataset)
+            start_sweeper()
+            JOBS_PID = os.getpid()
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # streamed downloads are timed until their headers are sent
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('http_request_seconds', time.perf_counter() - g.start,
+                    endpoint=endpoint)
+    metrics.increment('http_requests', endpoint=endpoint,
+                      status=response.status_code)
+    return response
+
+
+def get_job(job_id):
+    job = JOBS.get(job_id) if JOB_ID_RE.match(job_id) else None
+    if job is None:
+        abort(404)
+    return job
+
     
 @app.route("/", methods=['GET', 'POST'])
 def index():
@@ -32,49 +124,140 @@ def index():
     if not (request.method == 'POST' and form.validate()):
         return render_template('query.html', form=form)
 
-    new_columns = []
-    savepath = get_download_path()
+    queries = []
+    for i in range(1, form.num_queries + 1):
+        query = getattr(form, f"query_{i}").data
+        query_type = getattr(form, f"query_type_{i}").data
+        if query == '' or query_type == '':
+            continue
+        queries.append((query, query_type))
+    job = JOBS.submit(queries, config.BACKEND, config.DEFAULT_INDEX,
+                      form.get_filters())
+    return redirect(url_for('job_page', job_id=job.id))
+
+
+@app.route("/jobs/<job_id>")
+def job_page(job_id):
+    return render_template('job.html', job=get_job(job_id))
+
+
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id):
+    return jsonify(get_job(job_id).to_dict())
+
+
+@app.route("/stream/<job_id>/<any(senate, representatives):name>"
+           ".<any('csv.gz', parquet):file_format>")
+def stream_dataset(job_id, name, file_format):
+    """Stream a query dataset built from the stored results of a job"""
+    job = get_job(job_id)
+    if job.status != DONE:
+        abort(404)
+    store = STORES[name]
+    columns = result_columns(store, load_results(job.path))
+    if file_format == 'csv.gz':
+        stream, mimetype = stream_csv_gzip, 'application/gzip'
+        frames = store.iter_frames(columns)
+    else:
+        stream, mimetype = stream_parquet, 'application/octet-stream'
+        frames = store.iter_frames(columns, chunk_size=100000)
+
+    filename = f"{name}_speeches_query.{file_format}"
+    return Response(stream(frames), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+
+
+def query_args(args):
+    """The query, query type and filters of a request, aborting if invalid"""
+    query = args.get('query', '').strip()
+    query_type = args.get('query_type', 'and')
+    if not query or query_type not in ('exact', 'and', 'or'):
+        abort(400)
+    form = QueryForm(args)
+    if not all(getattr(form, name).validate(form) for name in FILTERS):
+        abort(400)
+    return query, query_type, form.get_filters()
+
+
+def int_arg(args, name, default, low, high=None):
     try:
-        # initialise these to the original dataset, then for each query, add
-        # a column with the results of the query
-        sen_df = SENATES_DF
-        reps_df = REPRESENTATIVES_DF
-        for i in range(1, form.num_queries + 1):
-            query = getattr(form, f"query_{i}").data
-            query_type = getattr(form, f"query_type_{i}").data
-            if query == '' or query_type == '':
-                continue
-            results = do_query(query, config.DEFAULT_INDEX,
-                               config.ELASTIC_MAX_RESULTS, query_type)
-            column_name = query_to_column_name(query, query_type)
-            new_columns.append(column_name)
-            parsed_results = process_query_result(results)
-            sen_df = add_results_to_dataframe(parsed_results, sen_df, column_name)
-            reps_df = add_results_to_dataframe(parsed_results, reps_df, column_name)
-    except Exception as error:
-        # Clean up directory that was created
-        savepath.rmdir()
-        raise error
-    sen_path = savepath / "senate_speeches_query.csv.gz"
-    reps_path = savepath / "representatives_speeches_query.csv.gz"
-    sen_df.to_csv(sen_path, compression="gzip")
-    reps_df.to_csv(reps_path, compression="gzip")
-
-    # get the counts of our results
-    sen_counts = {col: sen_df[col].astype(bool).sum() for col in new_columns}
-    reps_counts = {col: reps_df[col].astype(bool).sum() for col in new_columns}
-    
-    # convert to relative paths for the links
-    sen_path = '/' + str(sen_path.relative_to(config.DATA_PATH))
-    reps_path = '/' + str(reps_path.relative_to(config.DATA_PATH))
-    return render_template('query.html', results=True, form=form,
-                           sen_path=sen_path, reps_path=reps_path,
-                           sen_counts=sen_counts, reps_counts=reps_counts)
+        value = int(args.get(name, default))
+    except ValueError:
+        abort(400)
+    if value < low or (high is not None and value > high):
+        abort(400)
+    return value
+
+
+@app.route("/aggregate")
+def aggregate():
+    """Counts of the speeches matching a query over time, as JSON.
+
+    Takes query, query_type, interval and group_by arguments as well as the
+    filters of the query form.
+    """
+    query, query_type, filters = query_args(request.args)
+    interval = request.args.get('interval', 'year')
+    group_by = request.args.get('group_by') or None
+    if interval not in INTERVALS or group_by not in [None] + GROUPS:
+        abort(400)
+    try:
+        rows = BACKEND.aggregate(query, query_type, interval, group_by,
+                                 filters)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify(rows)
+
+
+@app.route("/kwic")
+def kwic_page():
+    """Stream the words around each match of a query as lines of JSON.
+
+    Takes query, query_type, width, page and page_size arguments as well as
+    the filters of the query form. Each page has the matches in page_size
+    hits, counting pages from 1, and an empty page is past the last hit.
+    Pages end at the backend's limit on how far it pages into the hits.
+    """
+    query, query_type, filters = query_args(request.args)
+    width = int_arg(request.args, 'width', DEFAULT_WIDTH, 1, MAX_WIDTH)
+    page = int_arg(request.args, 'page', 1, 1)
+    page_size = int_arg(request.args, 'page_size', KWIC_PAGE_SIZE, 1,
+                        MAX_KWIC_PAGE_SIZE)
+    try:
+        speech_ids = BACKEND.hit_ids(query, query_type, (page - 1) * page_size,
+                                     page_size, filters)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    rows = kwic(BACKEND, speech_ids, query, query_type, width,
+                cache=SNIPPETS)
+    return Response((json.dumps(row) + '\n' for row in rows),
+                    mimetype='application/x-ndjson')
+
+
+@app.route("/ready")
+def ready():
+    """Readiness check for load balancers and orchestrators"""
+    status = {name: len(store) for name, store in STORES.items()}
+    try:
+        status['backend'] = BACKEND.is_available()
+    except Exception:
+        status['backend'] = False
+    return jsonify(status), 200 if status['backend'] else 503
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Metrics of this process in the Prometheus text format"""
+    return Response(metrics.REGISTRY.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route(f"/download/<tmp_dir>/<path:filename>")
 def download_file(filename, tmp_dir):
-    path = safe_join(os.path.join(config.DOWNLOAD_PATH.resolve(), tmp_dir))
-    if path is None:
+    """Download a dataset written by a job, not other files it keeps"""
+    job = get_job(tmp_dir)
+    if (job.status != DONE or
+            filename not in job.result.get('files', {}).values()):
         abort(404)
-    return send_from_directory(path, filename, as_attachment=True)
+    return send_from_directory(job.path, filename, as_attachment=True)
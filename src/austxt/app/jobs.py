@@ -0,0 +1,221 @@
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import traceback
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .. import config, metrics
+from ..query_cache import (normalize_query, read_generations, pack_results,
+                           unpack_results)
+
+
+logger = logging.getLogger(__package__)
+
+STATUS_FILE = 'status.json'
+RESULTS_FILE = 'results.npz'
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def make_job_id(queries, backend_name, index_name, filters=None):
+    """Identical queries against the same index generation share a job ID"""
+    generation = read_generations(config.QUERY_CACHE_PATH).get(index_name, 0)
+    normalized = [(normalize_query(query), query_type)
+                  for query, query_type in queries]
+    key = [normalized, backend_name, index_name, generation]
+    if filters:
+        key.append(filters)
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+def save_results(path, results):
+    """Store a dict of column name to query results in a job's directory"""
+    arrays = {}
+    for i, parsed_results in enumerate(results.values()):
+        doc_ids, tfs = pack_results(parsed_results)
+        arrays[f'doc_ids_{i}'], arrays[f'tfs_{i}'] = doc_ids, tfs
+    arrays['columns'] = np.array(list(results), dtype=str)
+    np.savez(Path(path) / RESULTS_FILE, **arrays)
+
+
+def load_results(path):
+    with np.load(Path(path) / RESULTS_FILE) as npz:
+        return {column: unpack_results((npz[f'doc_ids_{i}'], npz[f'tfs_{i}']))
+                for i, column in enumerate(npz['columns'].tolist())}
+
+
+def sweep_jobs(path=config.DOWNLOAD_PATH, ttl=config.DOWNLOAD_TTL,
+               stale_after=config.JOB_STALE_AFTER):
+    """Remove the directories of finished jobs not updated within ttl.
+
+    Jobs left queued or running for longer than stale_after were abandoned
+    by a process that died, so are marked as failed, and removed once they
+    too have gone ttl without an update.
+    """
+    now = time.time()
+    for job_path in Path(path).glob('*'):
+        if not job_path.is_dir():
+            continue
+        try:
+            job = Job.load(job_path)
+            if not job.finished and now - job.updated > stale_after:
+                logger.warning(f"job {job.id} was abandoned")
+                job.error = 'The job was abandoned before it finished'
+                job.update(status=FAILED, message='Failed')
+            expired = job.finished and now - job.updated > ttl
+        except (FileNotFoundError, ValueError, KeyError):
+            # not a job, or a job from before statuses were kept
+            expired = now - job_path.stat().st_mtime > ttl
+        if expired:
+            logger.info(f"removing expired job {job_path.name}")
+            shutil.rmtree(job_path, ignore_errors=True)
+
+
+def start_sweeper(interval=config.SWEEP_INTERVAL, **kwargs):
+    def sweep_forever():
+        while True:
+            try:
+                sweep_jobs(**kwargs)
+            except Exception:
+                logger.exception("sweeping jobs failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=sweep_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+class Job:
+    """A dataset build whose status is stored in its download directory"""
+
+    def __init__(self, job_id, queries, path, filters=None):
+        self.id = job_id
+        self.queries = queries
+        self.filters = filters or {}
+        self.path = Path(path)
+        self.status = QUEUED
+        self.message = 'Waiting for a worker'
+        self.progress = 0.0
+        self.result = {}
+        self.error = None
+        self.updated = time.time()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def update(self, status=None, message=None, progress=None):
+        if status is not None:
+            self.status = status
+        if message is not None:
+            self.message = message
+        if progress is not None:
+            self.progress = progress
+        self.updated = time.time()
+        self.save()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'queries': self.queries,
+            'filters': self.filters,
+            'status': self.status,
+            'message': self.message,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'updated': self.updated,
+        }
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / f"{STATUS_FILE}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        tmp_path.replace(self.path / STATUS_FILE)
+
+    @classmethod
+    def load(cls, path):
+        with open(Path(path) / STATUS_FILE) as f:
+            status = json.load(f)
+        job = cls(status['id'], [tuple(q) for q in status['queries']], path,
+                  status.get('filters'))
+        for key in ['status', 'message', 'progress', 'result', 'error',
+                    'updated']:
+            setattr(job, key, status[key])
+        return job
+
+
+class JobQueue:
+    """Runs dataset builds on a pool of worker threads.
+
+    Jobs are identified by their queries, so submitting the same queries
+    while a job is queued, running or done returns the existing job. Status
+    is kept on disk, so other processes serving the app can see it too.
+    """
+
+    def __init__(self, build, workers=config.JOB_WORKERS,
+                 path=config.DOWNLOAD_PATH, stale_after=config.JOB_STALE_AFTER):
+        self.build = build
+        self.path = Path(path)
+        self.stale_after = stale_after
+        self.executor = ThreadPoolExecutor(workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def get(self, job_id):
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        try:
+            return Job.load(self.path / job_id)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def is_reusable(self, job):
+        if job is None or job.status == FAILED:
+            return False
+        if job.status == DONE:
+            return True
+        # a job left queued or running by a process that died is abandoned
+        return (job.id in self.jobs or
+                time.time() - job.updated < self.stale_after)
+
+    def submit(self, queries, backend_name, index_name, filters=None):
+        job_id = make_job_id(queries, backend_name, index_name, filters)
+        with self.lock:
+            existing = self.get(job_id)
+            if self.is_reusable(existing):
+                if existing.status == DONE:
+                    # keep it from being swept while it's still wanted
+                    existing.update()
+                return existing
+            job = Job(job_id, queries, self.path / job_id, filters)
+            job.save()
+            self.jobs[job_id] = job
+        self.executor.submit(self.run, job)
+        return job
+
+    def run(self, job):
+        job.update(status=RUNNING, message='Starting')
+        start = time.perf_counter()
+        try:
+            job.result = self.build(job)
+            job.update(status=DONE, message='Finished', progress=1.0)
+        except Exception:
+            logger.exception(f"job {job.id} failed")
+            job.error = traceback.format_exc(limit=1)
+            job.update(status=FAILED, message='Failed')
+        finally:
+            metrics.observe('job_seconds', time.perf_counter() - start,
+                            status=job.status)
+            with self.lock:
+                self.jobs.pop(job.id, None)
@@ -0,0 +1,55 @@
+import io
+import zlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..datasets import fixed_schema
+
+
+def stream_csv_gzip(frames):
+    """Yield a gzipped CSV of an iterable of DataFrames as they are written"""
+    # wbits of 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    header = True
+    for chunk in frames:
+        text = chunk.to_csv(header=header)
+        header = False
+        data = compressor.compress(text.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class ChunkSink(io.RawIOBase):
+    """A write only file that hands back what was written since last asked"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_parquet(frames):
+    """Yield a Parquet file of an iterable of DataFrames a row group at a time"""
+    sink = ChunkSink()
+    writer = None
+    for chunk in frames:
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, fixed_schema(table.schema))
+        writer.write_table(table.cast(writer.schema))
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+    yield sink.take()
@@ -1,22 +1,37 @@
-import tempfile
-from pathlib import Path
+from wtforms import (Form, StringField, SelectField, IntegerField,
+                     validators)
 
-from wtforms import Form, StringField, SelectField, validators
 
-from .. import config
-
-
-def get_download_path(basepath=config.DOWNLOAD_PATH):
-    Path(basepath).mkdir(exist_ok=True)
-    return Path(tempfile.mkdtemp(dir=basepath))
+DATE_RE = r'^\d{4}-\d{2}-\d{2}$'
 
 
 def make_query_form(num_queries=10):
     class FormClass(Form):
+        date_from = StringField('From', validators=[
+            validators.optional(), validators.Regexp(DATE_RE)])
+        date_to = StringField('To', validators=[
+            validators.optional(), validators.Regexp(DATE_RE)])
+        house = SelectField('House', default='', choices=[
+            ('', 'both'), ('senate', 'senate'),
+            ('representatives', 'representatives')])
+        party = StringField('Party', validators=[validators.optional()])
+        speaker_id = IntegerField('Speaker ID',
+                                  validators=[validators.optional()])
+
         def get_query(self, i):
             query_field = getattr(self, f"query_{i}") 
             query_type_field = getattr(self, f"query_type_{i}") 
             return query_field, query_type_field 
+
+        def get_filters(self):
+            """The metadata filters that were filled in"""
+            filters = {}
+            for name in ['date_from', 'date_to', 'house', 'party',
+                         'speaker_id']:
+                value = getattr(self, name).data
+                if value not in (None, ''):
+                    filters[name] = value
+            return filters
     
     FormClass.num_queries = num_queries
     FormClass.queries = []
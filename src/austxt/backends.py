@@ -0,0 +1,130 @@
+from itertools import islice
+
+from . import config, metrics
+from .elastic import (do_get, do_ping, do_aggregate, do_highlight,
+                      do_hit_ids)
+from .query_cache import QueryCache, CachedBackend
+
+
+class ElasticBackend:
+    """Run queries against an Elasticsearch index"""
+
+    def __init__(self, index_name):
+        self.index_name = index_name
+
+    # imported when querying, as getting a speech doesn't need pandas
+    def query_term_frequencies(self, queries, size=None, filters=None):
+        from .utils import query_term_frequencies
+        return query_term_frequencies(queries, self.index_name, size,
+                                      filters=filters)
+
+    def iter_term_frequencies(self, query, query_type, size=None,
+                              filters=None):
+        from .utils import iter_term_frequencies
+        return iter_term_frequencies(query, query_type, self.index_name, size,
+                                     filters=filters)
+
+    def hit_ids(self, query, query_type, offset=0, size=10, filters=None):
+        """The IDs of size hits of a query, skipping the first offset"""
+        return do_hit_ids(query, query_type, self.index_name, offset, size,
+                          filters)
+
+    def aggregate(self, query, query_type, interval='year', group_by=None,
+                  filters=None):
+        return do_aggregate(query, query_type, self.index_name, interval,
+                            group_by, filters)
+
+    def highlight(self, identifiers, query, query_type):
+        """The text of each speech and the spans of the query's matches"""
+        from .kwic import marked_spans, MARK_START, MARK_END
+        marked = do_highlight(identifiers, query, query_type, self.index_name,
+                              (MARK_START, MARK_END))
+        return {identifier: marked_spans(text)
+                for identifier, text in marked.items()}
+
+    def get(self, identifier):
+        return do_get(identifier, self.index_name)
+
+    def is_available(self):
+        return do_ping()
+
+
+class LocalBackend:
+    """Run queries against a local inverted index, without Elasticsearch.
+
+    The index for an index name is found in a directory of that name in
+    config.LOCAL_INDEX_PATH, and is built with the build-local-index command.
+    It only has the text of speeches, so can't filter or aggregate them.
+    """
+
+    def __init__(self, index_name):
+        # imported here so the elastic backend doesn't need numpy's index code
+        from .local_index import LocalIndex
+        self.index_name = index_name
+        self.index = LocalIndex(config.LOCAL_INDEX_PATH / index_name)
+
+    def check_filters(self, filters):
+        if filters:
+            raise ValueError("filters need the elastic backend")
+
+    def query_term_frequencies(self, queries, size=None, filters=None):
+        self.check_filters(filters)
+        results = []
+        for query, query_type in queries:
+            with metrics.timer('local_query_seconds'):
+                result = self.index.term_frequencies(query, query_type, size)
+            metrics.observe('query_hits', len(result), backend='local')
+            results.append(result)
+        return results
+
+    def iter_term_frequencies(self, query, query_type, size=None,
+                              filters=None):
+        self.check_filters(filters)
+        return iter(self.index.term_frequencies(query, query_type, size))
+
+    def hit_ids(self, query, query_type, offset=0, size=10, filters=None):
+        # the index finds every hit at once anyway
+        hits = self.iter_term_frequencies(query, query_type, None, filters)
+        return [doc for doc, _ in islice(hits, offset, offset + size)]
+
+    def aggregate(self, query, query_type, interval='year', group_by=None,
+                  filters=None):
+        raise ValueError("aggregations need the elastic backend")
+
+    def highlight(self, identifiers, query, query_type):
+        from .kwic import query_spans
+        highlighted = {}
+        for identifier in identifiers:
+            doc = self.get(identifier)
+            if doc['found']:
+                text = doc['_source']['text']
+                highlighted[identifier] = (text, query_spans(text, query,
+                                                             query_type))
+        return highlighted
+
+    def get(self, identifier):
+        return self.index.get(identifier)
+
+    def is_available(self):
+        # the index is opened when the backend is created
+        return True
+
+
+BACKENDS = {
+    'elastic': ElasticBackend,
+    'local': LocalBackend,
+}
+
+
+CACHES = {}
+
+
+def get_backend(name=config.BACKEND, index_name=config.DEFAULT_INDEX,
+                cache=config.QUERY_CACHE):
+    backend = BACKENDS[name](index_name)
+    if not cache:
+        return backend
+    # share one in-memory cache between all backends in a process
+    if 'query' not in CACHES:
+        CACHES['query'] = QueryCache()
+    return CachedBackend(backend, CACHES['query'])
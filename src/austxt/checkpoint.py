@@ -0,0 +1,111 @@
+import csv
+import json
+import logging
+from pathlib import Path
+
+from .store import source_stamp, replace_file
+from .elastic import METADATA_FIELDS
+
+
+logger = logging.getLogger(__package__)
+
+DEAD_LETTER_COLUMNS = (['speech_id', 'text'] + list(METADATA_FIELDS) +
+                       ['status', 'error'])
+
+
+class Checkpoint:
+    """Records how far indexing a dataset has got, so that it can resume.
+
+    Rows are sent in order and bulk results come back in the same order, so
+    progress is kept as the number of leading rows of the dataset that are
+    done with, whether indexed, unchanged or written to the dead letter
+    file. The checkpoint is only valid for the dataset and index it was
+    made for; if the dataset has changed since, rows may have moved.
+    """
+
+    def __init__(self, path, source_path, index_name, every=10000):
+        self.path = Path(path)
+        self.every = every
+        self.state = {'source': source_stamp(source_path),
+                      'index': index_name, 'rows': 0, 'complete': False}
+        self.saved_rows = 0
+
+    @property
+    def rows(self):
+        return self.state['rows']
+
+    @property
+    def complete(self):
+        return self.state['complete']
+
+    def load(self):
+        """Continue from the saved checkpoint, if there is one"""
+        if not self.path.exists():
+            logger.warning(f"no checkpoint at {self.path}, starting from the "
+                           "beginning")
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        for key in ('source', 'index'):
+            if saved[key] != self.state[key]:
+                raise RuntimeError(
+                    f"checkpoint {self.path} was made for {saved[key]}, not "
+                    f"{self.state[key]}; remove it to start again")
+        self.state = saved
+        self.saved_rows = saved['rows']
+
+    def advance(self, rows):
+        self.state['rows'] = rows
+        if rows - self.saved_rows >= self.every:
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        replace_file(self.path, lambda path: path.write_text(
+            json.dumps(self.state)))
+        self.saved_rows = self.state['rows']
+
+    def finish(self, rows):
+        self.state.update(rows=rows, complete=True)
+        self.save()
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+class DeadLetters:
+    """A CSV of documents that failed to index along with why.
+
+    It has the speech_id, text and metadata columns of a speech dataset, so
+    it can be indexed again with its metadata once the problem is fixed. Documents are appended as they
+    fail, so none are lost if indexing is interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = None
+        self.writer = None
+        self.count = 0
+
+    def write(self, action, info):
+        if self.file is None:
+            write_header = (not self.path.exists() or
+                            self.path.stat().st_size == 0)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if write_header:
+                self.writer.writerow(DEAD_LETTER_COLUMNS)
+        source = action['_source']
+        self.writer.writerow([action['_id'], source.get('text')] +
+                             [source.get(field) for field in METADATA_FIELDS] +
+                             [info.get('status'), info.get('error')])
+        # flush so failures are kept even if the process is killed
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -4,13 +4,12 @@ import logging
 import traceback
 from json import dumps
 from pathlib import Path
+from datetime import datetime
 
-import pandas as pd
-
-from .process import process_speeches, get_members
-from .elastic import index_speeches, do_query, do_get
-from .utils import process_query_result, make_dataset, query_to_column_name
-from . import config
+# commands import what they use when they run, so that starting the CLI
+# doesn't wait on pandas, Elasticsearch etc. for commands that don't need them
+from .config import BACKENDS, FORMATS, ANALYZERS, FILTERS, INTERVALS, GROUPS
+from . import config, metrics
 
 
 logging.basicConfig()
@@ -30,9 +29,69 @@ class CatchCliExceptions(click.Group):
 @click.group(cls=CatchCliExceptions)
 @click.option('--log', default='WARNING',
               type=click.Choice(logging._levelToName.values()))
-def cli(log):
+@click.option('--profile', default=None, type=click.Choice(['text', 'json']),
+              help="Print timings and counts from each stage when done, as a "
+              "table or as lines of JSON.")
+@click.pass_context
+def cli(ctx, log, profile):
     level = logging.getLevelName(log)
     logger.setLevel(level)
+    if profile is not None:
+        ctx.call_on_close(lambda: print_profile(profile))
+
+
+def print_profile(profile):
+    if profile == 'json':
+        print(metrics.REGISTRY.json_lines(), file=sys.stderr)
+    else:
+        print(metrics.REGISTRY.summary(), file=sys.stderr)
+
+
+def check_date(ctx, param, value):
+    if value is not None:
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise click.BadParameter("dates are written as YYYY-MM-DD")
+    return value
+
+
+def filter_options(command):
+    """Add options for only querying speeches with some metadata"""
+    options = [
+        click.option('--date-from', default=None, callback=check_date,
+                     help="Only speeches on or after this date, YYYY-MM-DD."),
+        click.option('--date-to', default=None, callback=check_date,
+                     help="Only speeches on or before this date, YYYY-MM-DD."),
+        click.option('--house', default=None,
+                     type=click.Choice(['senate', 'representatives'])),
+        click.option('--party', multiple=True,
+                     help="Only speeches by members of this party, can be "
+                     "given more than once."),
+        click.option('--speaker-id', multiple=True, type=int,
+                     help="Only speeches by this member, can be given more "
+                     "than once."),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def pop_filters(kwargs, backend='elastic'):
+    """Take the filter_options out of a command's arguments, which only the
+    elastic backend can filter on"""
+    filters = {}
+    for name in FILTERS:
+        value = kwargs.pop(name)
+        if isinstance(value, tuple):
+            value = list(value)
+        if value:
+            filters[name] = value
+    if filters and backend != 'elastic':
+        options = ', '.join(f"--{name.replace('_', '-')}" for name in filters)
+        raise click.UsageError(f"filtering with {options} needs the elastic "
+                               "backend")
+    return filters
 
 
 @cli.command(name='process-speeches')
@@ -46,80 +105,420 @@ def cli(log):
 @click.option('--files', default=None, type=str,
               help="Limit the processing to these comma separated file names.")
 @click.option('--workers', default=1)
+@click.option('--batch-size', default=10000, type=int,
+              help="Number of speeches to hold in memory before writing.")
+@click.option('--cache-path', default=None, type=click.Path(file_okay=False),
+              help="Directory for caching speeches extracted from each file, "
+              "so that only new or changed files are reprocessed.")
+@click.option('--clean-workers', default=1, type=int,
+              help="Number of spaCy processes to clean text with.")
+@click.option('--clean-batch-size', default=1000, type=int,
+              help="Number of texts spaCy processes at a time.")
+@click.option('--clean-cache', 'clean_cache_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="SQLite file caching cleaned text, so unchanged speeches "
+              "are not cleaned again.")
+@click.option('--format', 'output_format', default='csv',
+              type=click.Choice(FORMATS), help="Format of the output files.")
 @click.option('--output-path', default='.', type=click.Path(file_okay=False),
-              help="Output file to write CSV data to.")
+              help="Output directory to write data to.")
 def run_process_speeches(speech_type, path, members_path, clean, limit, files,
-                         workers, output_path):
+                         workers, batch_size, cache_path, clean_workers,
+                         clean_batch_size, clean_cache_path, output_format,
+                         output_path):
     """Process a directory of speech XML files."""
+    from .process import process_speeches, write_speeches
     output_name = f"{speech_type}_speeches"
-    speeches_df = process_speeches(path, speech_type, members_path, clean,
-                                   limit, files, workers)
-    speeches_df.to_csv(f"{output_name}_full.csv", index=False)
-    speeches_df.drop(['text', 'cleaned_text'], errors='ignore',
-                     axis=1).to_csv(f"{output_name}_notext.csv", index=False)
+    speech_batches = process_speeches(path, speech_type, members_path, clean,
+                                      limit, files, workers, batch_size,
+                                      cache_path, clean_workers,
+                                      clean_batch_size, clean_cache_path)
+    write_speeches(speech_batches, output_path, output_name, output_format)
 
     
+@cli.command(name='ingest')
+@click.option('--senate', 'senate_path', default=None,
+              type=click.Path(exists=True, file_okay=False),
+              help="Directory of Senate sitting day files.")
+@click.option('--representatives', 'representatives_path', default=None,
+              type=click.Path(exists=True, file_okay=False),
+              help="Directory of House of Representatives sitting day files.")
+@click.option('--members-path', type=click.Path(exists=True))
+@click.option('--clean/--no-clean', default=False)
+@click.option('--limit', default=None, type=int,
+              help="Limit the processing to some number of files per house.")
+@click.option('--output-path', default='.', type=click.Path(file_okay=False),
+              help="Output directory to write data to.")
+@click.option('--format', 'output_format', default='csv',
+              type=click.Choice(FORMATS), help="Format of the output files.")
+@click.option('--write/--no-write', default=True,
+              help="Write the speech datasets of each house.")
+@click.option('--alias', default=None,
+              help="Also index speeches into a new index, pointing this "
+              "alias at it once loaded as reindex does.")
+@click.option('--parse-workers', default=1, type=int,
+              help="Number of processes parsing XML files.")
+@click.option('--clean-workers', default=1, type=int,
+              help="Number of spaCy processes to clean text with.")
+@click.option('--index-workers', default=4, type=int,
+              help="Number of bulk requests to keep in flight.")
+@click.option('--batch-size', default=10000, type=int,
+              help="Number of speeches passed between stages at a time.")
+@click.option('--queue-size', default=4, type=int,
+              help="Number of batches that can wait between two stages.")
+@click.option('--clean-batch-size', default=1000, type=int,
+              help="Number of texts spaCy processes at a time.")
+@click.option('--clean-cache', 'clean_cache_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="SQLite file caching cleaned text.")
+@click.option('--chunk-size', default=500, type=int,
+              help="Maximum number of documents per bulk request.")
+@click.option('--max-chunk-bytes', default=10 * 1024 * 1024, type=int,
+              help="Maximum size in bytes of each bulk request.")
+@click.option('--max-retries', default=3, type=int,
+              help="Number of times to retry documents that failed.")
+@click.option('--dead-letter', 'dead_letter_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="CSV that documents which failed to index are appended "
+              "to, defaults to the new index's name with _failed.csv in the "
+              "data directory.")
+@click.option('--shards', default=None, type=int,
+              help="Number of primary shards, defaults to the cluster's.")
+@click.option('--replicas', default=1, type=int,
+              help="Number of replicas once loaded.")
+@click.option('--keep', default=1, type=int,
+              help="Number of previous versions of the index to keep.")
+@click.option('--allow-failures/--no-allow-failures', default=False,
+              help="Swap the alias even if some documents failed to index.")
+def run_ingest(senate_path, representatives_path, **kwargs):
+    """Parse, clean, enrich, write and index speeches in one pass.
+
+    The stages run at the same time, passing batches of speeches between
+    them, so the datasets don't have to be written before indexing starts.
+    """
+    from .pipeline import ingest
+    paths = {speech_type: path for speech_type, path in
+             [('senate', senate_path),
+              ('representatives', representatives_path)]
+             if path is not None}
+    if not paths:
+        raise click.UsageError("give --senate or --representatives or both")
+    if not kwargs['write'] and kwargs['alias'] is None:
+        raise click.UsageError("--no-write needs --alias")
+    counts = ingest(paths, **kwargs)
+    for speech_type, count in counts.items():
+        print(f"{count} {speech_type} speeches ingested")
+    if kwargs['alias'] is not None:
+        from .elastic import alias_indices
+        print(f"{kwargs['alias']} now points to "
+              f"{', '.join(alias_indices(kwargs['alias']))}")
+
+
+@cli.command(name='clean-speeches')
+@click.argument('input-path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output-path', type=click.Path(dir_okay=False))
+@click.option('--workers', default=1, type=int,
+              help="Number of spaCy processes to clean text with.")
+@click.option('--batch-size', default=1000, type=int,
+              help="Number of texts spaCy processes at a time.")
+@click.option('--cache', 'cache_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="SQLite file caching cleaned text.")
+def run_clean_speeches(input_path, output_path, workers, batch_size,
+                       cache_path):
+    """Add a cleaned_text column to an extracted dataset of speeches"""
+    from .text import clean_frames, CleanedTextCache
+    from .datasets import iter_dataset, DatasetWriter
+    cache = CleanedTextCache(cache_path) if cache_path is not None else None
+    frames = clean_frames(iter_dataset(input_path), batch_size, workers, cache)
+    with DatasetWriter(output_path) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+
 @cli.command(name='get-members')
 @click.argument('path', nargs=-1, type=click.Path(exists=True))
-@click.option('--output', default='members.csv')
-def run_get_members(path, output):
+@click.option('--output', default='members.csv',
+              help="Output file, written as Parquet if it ends in .parquet")
+@click.option('--workers', default=1, type=int,
+              help="Number of files to parse at once.")
+def run_get_members(path, output, workers):
     """Process one or more members XML files"""
-    members_df = get_members(path)
-    members_df.to_csv(output, index=False)
+    from .process import get_members
+    from .datasets import write_dataset
+    members_df = get_members(path, workers)
+    write_dataset(members_df, output)
 
     
 @cli.command(name='index-speeches')
 @click.argument('path', type=click.Path(exists=True))
 @click.option('--index-name', default=config.DEFAULT_INDEX)
 @click.option('--limit', default=None, type=int)
-@click.option('--workers', default=1, type=int)
+@click.option('--workers', default=4, type=int,
+              help="Number of bulk requests to keep in flight.")
+@click.option('--chunk-size', default=500, type=int,
+              help="Maximum number of documents per bulk request.")
+@click.option('--max-chunk-bytes', default=10 * 1024 * 1024, type=int,
+              help="Maximum size in bytes of each bulk request.")
+@click.option('--read-size', default=10000, type=int,
+              help="Number of CSV rows to read into memory at a time.")
+@click.option('--max-retries', default=3, type=int,
+              help="Number of times to retry documents that failed.")
+@click.option('--resume', is_flag=True,
+              help="Continue from where the last run got to.")
+@click.option('--checkpoint', 'checkpoint_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="File recording progress, defaults to "
+              "INDEX_NAME_checkpoint.json in the data directory.")
+@click.option('--dead-letter', 'dead_letter_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="CSV that documents which failed to index are appended "
+              "to, defaults to INDEX_NAME_failed.csv in the data directory. "
+              "It can be indexed again with this command.")
+@click.option('--skip-unchanged', 'skip_unchanged_docs', is_flag=True,
+              help="Don't send speeches already indexed with the same text.")
 def run_index_speeches(**kwargs):
     """Index a CSV of exracted speeches"""
+    from .elastic import index_speeches
     index_speeches(**kwargs)
 
        
+@cli.command(name='reindex')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--alias', default=config.DEFAULT_INDEX,
+              help="Alias that queries read from.")
+@click.option('--limit', default=None, type=int)
+@click.option('--workers', default=4, type=int,
+              help="Number of bulk requests to keep in flight.")
+@click.option('--chunk-size', default=500, type=int,
+              help="Maximum number of documents per bulk request.")
+@click.option('--max-chunk-bytes', default=10 * 1024 * 1024, type=int,
+              help="Maximum size in bytes of each bulk request.")
+@click.option('--read-size', default=10000, type=int,
+              help="Number of CSV rows to read into memory at a time.")
+@click.option('--max-retries', default=3, type=int,
+              help="Number of times to retry documents that failed.")
+@click.option('--shards', default=None, type=int,
+              help="Number of primary shards, defaults to the cluster's.")
+@click.option('--replicas', default=1, type=int,
+              help="Number of replicas once loaded.")
+@click.option('--keep', default=1, type=int,
+              help="Number of previous versions of the index to keep.")
+@click.option('--allow-failures/--no-allow-failures', default=False,
+              help="Swap the alias even if some documents failed to index.")
+def run_reindex(path, alias, **kwargs):
+    """Load speeches into a new index, then point the alias at it"""
+    from .elastic import reindex_speeches
+    index_name, count, failed = reindex_speeches(path, alias, **kwargs)
+    print(f"{alias} now points to {index_name} ({count} documents)")
+
+
+@cli.command(name='build-local-index')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--index-name', default=config.DEFAULT_INDEX)
+@click.option('--workers', default=1, type=int)
+@click.option('--chunk-size', default=5000, type=int,
+              help="Number of speeches to analyze at a time.")
+def run_build_local_index(path, index_name, workers, chunk_size):
+    """Build a local index of a full speeches dataset for the local backend"""
+    from .local_index import build_local_index
+    from .query_cache import bump_generation
+    build_local_index(path, config.LOCAL_INDEX_PATH / index_name, workers,
+                      chunk_size)
+    bump_generation(index_name)
+
+       
+@cli.command(name='build-store')
+@click.option('--store-path', default=config.STORE_PATH,
+              type=click.Path(file_okay=False))
+def run_build_store(store_path):
+    """Build the memory-mapped copies of the speech datasets used by the app"""
+    from .store import build_store
+    build_store(config.SENATES_PATH, store_path, 'senate')
+    build_store(config.REPRESENTATIVES_PATH, store_path, 'representatives')
+
+
+@cli.command(name='term-matrix')
+@click.argument('input-path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output-path', type=click.Path(dir_okay=False))
+@click.option('--vocab', 'vocab_path', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="File of terms to count, one per line.")
+@click.option('--top', default=None, type=click.IntRange(min=1),
+              help="Count the most frequent terms instead of a vocabulary, "
+              "which takes an extra pass over the dataset.")
+@click.option('--analyzer', default='english', type=click.Choice(ANALYZERS),
+              help="Stem terms like the Elasticsearch index, or lemmatize "
+              "them like cleaned_text.")
+@click.option('--workers', default=1, type=int)
+@click.option('--chunk-size', default=5000, type=int,
+              help="Number of speeches to analyze at a time.")
+def run_term_matrix(input_path, output_path, vocab_path, top, analyzer,
+                    workers, chunk_size):
+    """Count terms in every speech, writing a sparse matrix (.npz, which
+    needs scipy) or long format Parquet (.parquet)"""
+    from .term_matrix import analyze_vocabulary, top_terms, term_matrix
+    if (vocab_path is None) == (top is None):
+        raise click.UsageError("Give one of --vocab or --top")
+    if vocab_path is not None:
+        with open(vocab_path) as f:
+            terms = analyze_vocabulary(f, analyzer)
+    else:
+        terms = top_terms(input_path, analyzer, top, workers, chunk_size)
+    term_matrix(input_path, terms, output_path, analyzer, workers, chunk_size)
+
+
 @cli.command(name='get-speech')
 @click.argument('identifier', )
 @click.option('--index-name', default=config.DEFAULT_INDEX)
-def run_get(**kwargs):
+@click.option('--backend', default=config.BACKEND, type=click.Choice(BACKENDS))
+def run_get(identifier, index_name, backend):
     """Get a speech from Elasticsearch using its ID"""
-    result = do_get(**kwargs)
+    from .backends import get_backend
+    result = get_backend(backend, index_name, cache=False).get(identifier)
     print(dumps(result))
 
     
 @cli.command(name='query')
 @click.argument('query', )
 @click.option('--index-name', default=config.DEFAULT_INDEX)
-@click.option('--size', default=10,
-              type=click.IntRange(1, config.ELASTIC_MAX_RESULTS))
+@click.option('--backend', default=config.BACKEND, type=click.Choice(BACKENDS))
+@click.option('--cache/--no-cache', default=config.QUERY_CACHE,
+              help="Use cached query results.")
+@click.option('--size', default=10, type=click.IntRange(min=1))
 @click.option('--query_type', default='and',
               type=click.Choice(["and", "or", "exact"]))
-@click.option('--json/--no-json', default=False)
-def run_query(query, index_name, size, query_type, json):
+@click.option('--json/--no-json', default=False,
+              help="Output Elasticsearch's response as JSON.")
+@click.option('--hits/--no-hits', default=False,
+              help="Output each hit as a line of JSON.")
+@filter_options
+def run_query(query, index_name, backend, cache, size, query_type, json, hits,
+              **kwargs):
     """Query Elasticsearch index of speeches"""
-    result = do_query(query, index_name, size, query_type)
-    if json :
-        print(dumps(result))
-    else:
-        docs = process_query_result(result)
-        for doc, tf in docs:
+    filters = pop_filters(kwargs, backend)
+    if json:
+        if backend != 'elastic':
+            raise click.UsageError("--json needs the elastic backend, use "
+                                   "--hits for the hits of other backends")
+        from .elastic import do_query
+        print(dumps(do_query(query, index_name, size, query_type, filters)))
+        return
+    from .backends import get_backend
+    backend = get_backend(backend, index_name, cache)
+    docs = backend.iter_term_frequencies(query, query_type, size, filters)
+    for doc, tf in docs:
+        if hits:
+            print(dumps({'_id': doc, 'tf': tf}))
+        else:
             print(f"{doc:21} {tf:2}")
 
 
+@cli.command(name='kwic')
+@click.argument('query')
+@click.option('--index-name', default=config.DEFAULT_INDEX)
+@click.option('--backend', default=config.BACKEND, type=click.Choice(BACKENDS))
+@click.option('--cache/--no-cache', default=config.QUERY_CACHE,
+              help="Use cached query results.")
+@click.option('--size', default=10, type=click.IntRange(min=1),
+              help="Number of speeches to show matches in.")
+@click.option('--query-type', default='and',
+              type=click.Choice(["and", "or", "exact"]))
+@click.option('--width', default=8, type=click.IntRange(1, 50),
+              help="Number of words either side of each match.")
+@click.option('--batch-size', default=100, type=click.IntRange(min=1),
+              help="Number of speeches to find matches in per request.")
+@click.option('--json/--no-json', default=False,
+              help="Output each match as a line of JSON.")
+@filter_options
+def run_kwic(query, index_name, backend, cache, size, query_type, width,
+             batch_size, json, **kwargs):
+    """Show the words around each match of a query in the speeches it hits"""
+    from .backends import get_backend
+    from .kwic import kwic
+    filters = pop_filters(kwargs, backend)
+    backend = get_backend(backend, index_name, cache)
+    speech_ids = backend.hit_ids(query, query_type, 0, size, filters)
+    rows = kwic(backend, speech_ids, query, query_type, width, batch_size)
+    if json:
+        for row in rows:
+            print(dumps(row))
+        return
+    # line up the matches, padding to the longest left context in the page
+    rows = list(rows)
+    left_width = max((len(row['left']) for row in rows), default=0)
+    for row in rows:
+        print(f"{row['speech_id']:21} {row['left']:>{left_width}} "
+              f"[{row['match']}] {row['right']}")
+
+
 @cli.command(name='make-dataset')
 @click.argument('input-path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('query', nargs=-1, required=True)
+@click.option('--index-name', default=config.DEFAULT_INDEX)
+@click.option('--backend', default=config.BACKEND, type=click.Choice(BACKENDS))
+@click.option('--cache/--no-cache', default=config.QUERY_CACHE,
+              help="Use cached query results.")
+@click.option('--size', type=click.IntRange(min=1), default=None,
+              help="Maximum number of hits per query, defaults to all.")
+@click.option('--query-type', default='and',
+              type=click.Choice(["and", "or", "exact"]),
+              help="Type of every query.")
+@click.option('--columns', default=None, type=str,
+              help="Only include these comma separated columns from the input.")
+@click.option('--output-path', default='.', type=click.Path(file_okay=False))
+@filter_options
+def run_make_dataset(input_path, query, index_name, backend, cache, size,
+                     query_type, columns, output_path, **kwargs):
+    """Create a copy of Austxt dataset with results of one or more queries."""
+    from .utils import make_dataset, query_to_column_name
+    from .backends import get_backend
+    from .datasets import read_dataset, write_dataset
+    filters = pop_filters(kwargs, backend)
+    queries = [(q, query_type) for q in query]
+    column_names = "__".join(query_to_column_name(q, query_type)
+                             for q in query)
+    input_path = Path(input_path)
+    output_name = f"{input_path.stem}_{column_names}{input_path.suffix}"
+    output_path = Path(output_path) / output_name
+    if columns is not None:
+        columns = ['speech_id'] + [col for col in columns.split(',')
+                                   if col != 'speech_id']
+    base_dataset_df = read_dataset(input_path, columns=columns)
+    new_dataset_df = make_dataset(base_dataset_df, queries,
+                                  get_backend(backend, index_name, cache),
+                                  size, filters)
+    write_dataset(new_dataset_df, output_path)
+
+
+@cli.command(name='aggregate')
 @click.argument('query')
 @click.option('--index-name', default=config.DEFAULT_INDEX)
-@click.option('--size', type=click.IntRange(1, config.ELASTIC_MAX_RESULTS),
-              default=config.ELASTIC_MAX_RESULTS)
 @click.option('--query-type', default='and',
               type=click.Choice(["and", "or", "exact"]))
-@click.option('--output-path', default='.', type=click.Path(file_okay=False))
-def run_make_dataset(input_path, query, index_name, size, query_type, output_path):
-    """Create a copy of Austxt dataset with results of a query."""
-    column_name = query_to_column_name(query, query_type)
-    output_path =  Path(output_path) / f"{Path(input_path).stem}_{column_name}.csv"
-    base_dataset_df = pd.read_csv(input_path)
-    new_dataset_df = make_dataset(base_dataset_df, query, index_name, size,
-                                  query_type)
-    new_dataset_df.to_csv(output_path)
+@click.option('--interval', default='year', type=click.Choice(INTERVALS))
+@click.option('--group-by', default=None,
+              type=click.Choice(GROUPS),
+              help="Also count per value of this field.")
+@click.option('--output', default=None, type=click.Path(dir_okay=False),
+              help="Write the counts to a CSV or Parquet file instead of "
+              "printing them.")
+@filter_options
+def run_aggregate(query, index_name, query_type, interval, group_by, output,
+                  **kwargs):
+    """Count speeches matching a query over time, computed by Elasticsearch.
+
+    Gives the number of matching speeches and the total frequency of the
+    query in them per period, without fetching any hits.
+    """
+    import pandas as pd
+    from .backends import get_backend
+    from .datasets import write_dataset
+    filters = pop_filters(kwargs)
+    backend = get_backend('elastic', index_name, cache=False)
+    rows = backend.aggregate(query, query_type, interval, group_by, filters)
+    if output is not None:
+        write_dataset(pd.DataFrame(rows), output)
+        return
+    for row in rows:
+        print(dumps(row))
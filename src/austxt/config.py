@@ -3,10 +3,58 @@ from pathlib import Path
 
 
 DEFAULT_INDEX = 'austxt'
-ELASTIC_MAX_RESULTS = 500000
+# 'elastic' or 'local', see backends.py
+BACKENDS = ['elastic', 'local']
+BACKEND = os.getenv('AUSTXT_BACKEND', 'elastic')
+# the number of hits fetched per request, which must not be more than the
+# index's max_result_window
+ELASTIC_PAGE_SIZE = 10000
 ELASTIC_ADDRESS = os.getenv('AUSTXT_ELASTIC_ADDRESS', 'localhost:9200')
+ELASTIC_TIMEOUT = int(os.getenv('AUSTXT_ELASTIC_TIMEOUT', 100))
+ELASTIC_VERIFY_CERTS = os.getenv('AUSTXT_ELASTIC_VERIFY_CERTS', '0') == '1'
+ELASTIC_USE_SSL = os.getenv('AUSTXT_ELASTIC_USE_SSL', '1') == '1'
+# keep-alive connections kept per node, which should be at least the number
+# of requests made at once by ELASTIC_CONCURRENCY or the indexer's workers
+ELASTIC_MAXSIZE = int(os.getenv('AUSTXT_ELASTIC_MAXSIZE', 25))
+ELASTIC_CONCURRENCY = int(os.getenv('AUSTXT_ELASTIC_CONCURRENCY', 8))
+ELASTIC_MAX_RETRIES = int(os.getenv('AUSTXT_ELASTIC_MAX_RETRIES', 3))
 DATA_PATH = Path(os.getenv("AUSTXT_DATA_PATH", "."))
 DOWNLOAD_PATH = DATA_PATH / 'download'
-SENATES_CSV_PATH = DATA_PATH / "senate_speeches_notext.csv"
-REPRESENTATIVES_CSV_PATH = DATA_PATH / "representatives_speeches_notext.csv"
+LOCAL_INDEX_PATH = Path(os.getenv("AUSTXT_LOCAL_INDEX_PATH",
+                                  DATA_PATH / 'local_index'))
+QUERY_CACHE = os.getenv("AUSTXT_QUERY_CACHE", "1") == "1"
+QUERY_CACHE_PATH = Path(os.getenv("AUSTXT_QUERY_CACHE_PATH",
+                                  DATA_PATH / 'query_cache'))
+QUERY_CACHE_MEMORY_BYTES = int(os.getenv("AUSTXT_QUERY_CACHE_MEMORY_BYTES",
+                                         256 * 1024 * 1024))
+QUERY_CACHE_DISK_BYTES = int(os.getenv("AUSTXT_QUERY_CACHE_DISK_BYTES",
+                                       4 * 1024 * 1024 * 1024))
+# number of threads building datasets for the web app, and how long a job can
+# go without an update before it is considered abandoned
+JOB_WORKERS = int(os.getenv("AUSTXT_JOB_WORKERS", 2))
+JOB_STALE_AFTER = int(os.getenv("AUSTXT_JOB_STALE_AFTER", 60 * 60))
+# stream query datasets to users instead of writing them to DOWNLOAD_PATH,
+# which is swept of jobs older than DOWNLOAD_TTL seconds
+STREAM_DOWNLOADS = os.getenv("AUSTXT_STREAM_DOWNLOADS", "0") == "1"
+DOWNLOAD_TTL = int(os.getenv("AUSTXT_DOWNLOAD_TTL", 24 * 60 * 60))
+SWEEP_INTERVAL = int(os.getenv("AUSTXT_SWEEP_INTERVAL", 10 * 60))
+# windows of words around matches kept in memory by the web app, see kwic.py
+KWIC_CACHE_ENTRIES = int(os.getenv("AUSTXT_KWIC_CACHE_ENTRIES", 100000))
+# lookups of members' periods of service built from the members dataset
+MEMBERS_CACHE_PATH = Path(os.getenv("AUSTXT_MEMBERS_CACHE_PATH",
+                                    DATA_PATH / 'members_cache'))
+# memory-mapped copies of the speech datasets shared by the app's workers
+STORE_PATH = Path(os.getenv("AUSTXT_STORE_PATH", DATA_PATH / 'store'))
+DATA_FORMAT = os.getenv("AUSTXT_DATA_FORMAT", "csv")
+SENATES_PATH = DATA_PATH / f"senate_speeches_notext.{DATA_FORMAT}"
+REPRESENTATIVES_PATH = DATA_PATH / f"representatives_speeches_notext.{DATA_FORMAT}"
 
+# choices that the CLI offers, kept here so it can list them without
+# importing the modules that use them
+FORMATS = ['csv', 'parquet']
+ANALYZERS = ['english', 'lemma']
+# metadata filters of queries, see elastic.filter_clauses
+FILTERS = ['date_from', 'date_to', 'house', 'party', 'speaker_id']
+INTERVALS = ['year', 'quarter', 'month']
+# fields that aggregations can count speeches per value of
+GROUPS = ['house', 'speaker_id', 'party', 'division', 'gender']
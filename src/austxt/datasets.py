@@ -0,0 +1,121 @@
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import metrics
+
+
+# columns with few distinct values that are stored as categoricals
+CATEGORY_COLUMNS = ['speaker', 'day', 'party', 'division', 'gender', 'house']
+INT_COLUMNS = ['speaker_id', 'duration', 'num_tokens', 'member_id']
+
+
+def dataset_format(path):
+    return 'parquet' if Path(path).suffix == '.parquet' else 'csv'
+
+
+def typed_dataset(df):
+    """Convert columns of a dataset to compact types for columnar storage"""
+    df = df.copy()
+    for col in df.columns.intersection(CATEGORY_COLUMNS):
+        df[col] = df[col].astype('category')
+    for col in df.columns.intersection(INT_COLUMNS):
+        df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int32')
+    return df
+
+
+def read_dataset(path, columns=None):
+    """Read a CSV or Parquet dataset, only loading the requested columns"""
+    if dataset_format(path) == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def dataset_columns(path):
+    """The names of the columns in a dataset, without reading any rows"""
+    if dataset_format(path) == 'parquet':
+        return pq.ParquetFile(path).schema_arrow.names
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def iter_dataset(path, columns=None, chunk_size=10000, limit=None):
+    """Yield DataFrames of up to chunk_size rows from a dataset"""
+    if dataset_format(path) == 'csv':
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size,
+                               nrows=limit)
+        return
+
+    remaining = limit
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                           columns=columns):
+        df = batch.to_pandas()
+        if remaining is not None:
+            df = df.iloc[:remaining]
+            remaining -= len(df)
+        yield df
+        if remaining == 0:
+            return
+
+
+def write_dataset(df, path):
+    if dataset_format(path) == 'parquet':
+        typed_dataset(df).to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def fixed_type(data_type):
+    # a column that is entirely missing in the first batch has no type
+    if pa.types.is_null(data_type):
+        return pa.string()
+    # categorical codes can be int8 in one batch and int16 in the next, so
+    # pin dictionary columns to a single index type
+    if pa.types.is_dictionary(data_type):
+        return pa.dictionary(pa.int32(), fixed_type(data_type.value_type))
+    return data_type
+
+
+def fixed_schema(schema):
+    return pa.schema([pa.field(field.name, fixed_type(field.type))
+                      for field in schema])
+
+
+class DatasetWriter:
+    """Incrementally append DataFrames to a CSV or Parquet dataset"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.format = dataset_format(path)
+        self.writer = None
+        self.header = True
+
+    def write(self, df):
+        with metrics.timer('dataset_write_seconds', format=self.format):
+            self.write_frame(df)
+        metrics.increment('rows_written', len(df), format=self.format)
+
+    def write_frame(self, df):
+        if self.format == 'csv':
+            mode = 'w' if self.header else 'a'
+            df.to_csv(self.path, index=False, header=self.header, mode=mode)
+            self.header = False
+            return
+
+        table = pa.Table.from_pandas(typed_dataset(df), preserve_index=False)
+        if self.writer is None:
+            schema = fixed_schema(table.schema)
+            self.writer = pq.ParquetWriter(self.path, schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,26 +1,65 @@
-import os
+import re
 import sys
+import time
+import json
+import hashlib
+import random
+import logging
+import threading
 import urllib3
-from multiprocessing import Pool, current_process
-from functools import partial
-from collections import deque
+from itertools import islice
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, TransportError, NotFoundError
+from elasticsearch.helpers import parallel_bulk, scan
 
-from . import config
+from . import config, metrics
+from .query_cache import bump_generation
+
+
+logger = logging.getLogger(__package__)
 
 
 DOC_TYPE = 'doc'
 TEXT_FIELD = 'text'
+# a hash of the text and metadata, for skipping speeches already indexed
+CONTENT_HASH_FIELD = 'content_hash'
+# metadata of speeches indexed alongside the text, for filtering and
+# aggregating, when they are in the dataset being indexed
+METADATA_FIELDS = {
+    'date': {'type': 'date', 'format': 'yyyy-MM-dd'},
+    'house': {'type': 'keyword'},
+    'speaker_id': {'type': 'integer'},
+    'party': {'type': 'keyword'},
+    'division': {'type': 'keyword'},
+    'gender': {'type': 'keyword'},
+}
+# the text field scores each document with the frequency of the query in it,
+# so summing scores gives term frequencies, see do_aggregate
+TF_SIMILARITY = 'term_frequency'
+# the furthest into the hits of a query that a page can reach, elasticsearch's
+# default index.max_result_window
+MAX_RESULT_WINDOW = 10000
+# failed documents held for retrying before they are retried in the middle of
+# indexing, rather than after it, so a struggling cluster can't fill memory
+MAX_PENDING_RETRIES = 10000
 ELASTIC = None
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+if not config.ELASTIC_VERIFY_CERTS:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 def create_elastic():
-    return Elasticsearch(config.ELASTIC_ADDRESS, timeout=100,
-                         verify_certs=False, use_ssl=True)
+    # the client keeps a pool of keep-alive connections per node and can be
+    # shared between threads
+    return Elasticsearch(
+        config.ELASTIC_ADDRESS,
+        timeout=config.ELASTIC_TIMEOUT,
+        maxsize=config.ELASTIC_MAXSIZE,
+        verify_certs=config.ELASTIC_VERIFY_CERTS,
+        use_ssl=config.ELASTIC_USE_SSL,
+    )
 
 
 def global_elastic():
@@ -28,62 +67,548 @@ def global_elastic():
     if ELASTIC is None:
         ELASTIC = create_elastic()
 
-    
-def index_speech(index, row_tuple):
-    i, row = row_tuple
+
+def content_hash(source):
+    content = json.dumps(source, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def speech_house(speech_id):
+    return 'senate' if speech_id.startswith('sen') else 'representatives'
+
+
+def speech_metadata(chunk, fields):
+    """Yield a dict of the metadata of each speech, without missing values"""
+    metadata = chunk[fields].astype(object)
+    metadata = metadata.where(metadata.notna(), None)
+    # integer columns with missing values are read back from CSV as floats
+    integers = [field for field in fields
+                if METADATA_FIELDS[field]['type'] == 'integer']
+    for record in metadata.to_dict('records'):
+        for field in integers:
+            if record[field] is not None:
+                record[field] = int(record[field])
+        yield {field: value for field, value in record.items()
+               if value is not None}
+
+
+def frame_actions(chunk, index_name, row=0):
+    """Yield bulk index actions for a DataFrame of speeches numbered from
+    row, with whichever metadata fields it has"""
+    fields = [field for field in METADATA_FIELDS if field in chunk]
+    texts = chunk[TEXT_FIELD].fillna('').astype(str)
+    metadata = speech_metadata(chunk, fields)
+    for speech_id, text, source in zip(chunk['speech_id'], texts, metadata):
+        source[TEXT_FIELD] = text
+        if 'house' not in source:
+            source['house'] = speech_house(speech_id)
+        source[CONTENT_HASH_FIELD] = content_hash(source)
+        yield row, {
+            '_index': index_name,
+            '_type': DOC_TYPE,
+            '_id': speech_id,
+            '_source': source,
+        }
+        row += 1
+
+
+def speech_actions(path, index_name, limit, read_size, start=0):
+    """Stream bulk index actions from a CSV or Parquet file of speeches.
+
+    Each action is yielded with its row in the file, starting from row start.
+    """
+    # pandas is only needed for indexing, not for querying from the CLI
+    from .datasets import iter_dataset, dataset_columns
+    available = dataset_columns(path)
+    fields = [field for field in METADATA_FIELDS if field in available]
+    chunks = iter_dataset(path, columns=['speech_id', TEXT_FIELD] + fields,
+                          chunk_size=read_size, limit=limit)
+    row = 0
+    for chunk in chunks:
+        if row + len(chunk) <= start:
+            row += len(chunk)
+            continue
+        skip = max(start - row, 0)
+        yield from frame_actions(chunk.iloc[skip:], index_name, row + skip)
+        row += len(chunk)
+
+
+def skip_unchanged(numbered_actions, index_name, batch_size=1000,
+                   progress=None):
+    """Leave out actions for documents already indexed with the same text
+    and metadata, counting their rows as read in progress"""
+    while True:
+        batch = list(islice(numbered_actions, batch_size))
+        if not batch:
+            return
+        try:
+            docs = do_mget([action['_id'] for _, action in batch], index_name,
+                           [CONTENT_HASH_FIELD])
+        except NotFoundError:
+            # nothing has been indexed yet
+            docs = []
+        indexed = {doc['_id']: doc['_source'].get(CONTENT_HASH_FIELD)
+                   for doc in docs if doc.get('found')}
+        for row, action in batch:
+            if indexed.get(str(action['_id'])) == \
+                    action['_source'][CONTENT_HASH_FIELD]:
+                metrics.increment('documents_unchanged')
+                if progress is not None:
+                    progress.read_until = row + 1
+            else:
+                yield row, action
+
+
+def is_retryable(info):
+    # connection errors have no HTTP status, 429 is the bulk queue being full
+    status = info.get('status')
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+def with_backoff(func, *args, max_retries=config.ELASTIC_MAX_RETRIES,
+                 **kwargs):
+    """Call func, backing off and retrying while the cluster is unavailable"""
+    operation = func.__name__
+    for attempt in range(max_retries + 1):
+        try:
+            with metrics.timer('elastic_request_seconds', operation=operation):
+                return func(*args, **kwargs)
+        except TransportError as error:
+            metrics.increment('elastic_request_errors', operation=operation,
+                              status=error.status_code)
+            if attempt == max_retries or not is_retryable(
+                    {'status': error.status_code}):
+                raise
+            # jitter stops concurrent requests from retrying in lockstep
+            delay = 2 ** attempt * (0.5 + random.random())
+            logger.warning(f"request failed ({error}), retrying in "
+                           f"{delay:.1f}s")
+            time.sleep(delay)
+
+
+def run_concurrently(calls, concurrency=config.ELASTIC_CONCURRENCY):
+    """Run functions making requests concurrently, returning their results"""
+    calls = list(calls)
+    if concurrency == 1 or len(calls) < 2:
+        return [call() for call in calls]
+    with ThreadPoolExecutor(min(concurrency, len(calls))) as executor:
+        return list(executor.map(lambda call: call(), calls))
+
+
+class ThroughputReporter:
+    """Periodically report the number of documents indexed per second"""
+
+    def __init__(self, every=10000):
+        self.every = every
+        self.count = 0
+        self.start = time.monotonic()
+
+    def rate(self):
+        return self.count / max(time.monotonic() - self.start, 1e-9)
+
+    def add(self, count=1):
+        before = self.count // self.every
+        self.count += count
+        if self.count // self.every > before:
+            self.report()
+
+    def report(self):
+        print(f"{self.count} docs indexed ({self.rate():.0f} docs/sec)")
+
+
+class Progress:
+    """The first row not yet done with, given the rows in flight and those
+    waiting to be retried.
+
+    read_until is the row after the last one read, whether it was sent or
+    left out by skip_unchanged.
+    """
+
+    def __init__(self, start=0):
+        self.read_until = start
+
+    def first_undone(self, pending, retry):
+        rows = [self.read_until]
+        if pending:
+            rows.append(next(iter(pending.values()))[0])
+        if retry:
+            rows.append(retry[0][0])
+        return min(rows)
+
+
+class Backoff:
+    """Pause sending documents while the cluster is rejecting them.
+
+    Each rejection doubles the pause, up to max_delay, and results from the
+    chunks already in flight during a pause don't extend it. An accepted
+    document after the pause is over resets it.
+    """
+
+    def __init__(self, max_delay=30):
+        self.max_delay = max_delay
+        self.delay = 0
+        self.resume_at = 0
+        # cleared while the documents held for retrying are sent
+        self.sending = threading.Event()
+        self.sending.set()
+
+    def rejected(self):
+        if time.monotonic() < self.resume_at:
+            return
+        self.delay = min(max(self.delay * 2, 1), self.max_delay)
+        delay = self.delay * (0.5 + random.random())
+        self.resume_at = time.monotonic() + delay
+        metrics.increment('index_backoffs')
+        logger.warning(f"cluster is rejecting documents, pausing for "
+                       f"{delay:.1f}s")
+
+    def accepted(self):
+        if time.monotonic() >= self.resume_at:
+            self.delay = 0
+
+    def wait(self):
+        self.sending.wait()
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def bulk_index(numbered_actions, workers, chunk_size, max_chunk_bytes,
+               reporter, dead_letters, checkpoint=None, progress=None,
+               max_retries=3, max_pending_retries=MAX_PENDING_RETRIES):
+    """Send actions through the bulk API, returning those to retry.
+
+    Each result is matched back to its action so that failed documents can be
+    retried, or written to the dead letter file if retrying won't help.
+    Results come back in the same order actions were sent, so the number of
+    pending actions is bounded by the number in flight, and the checkpoint
+    can be advanced to the first row still pending. Sending pauses while
+    documents are rejected with 429s, and once more than max_pending_retries
+    documents have failed they are retried before carrying on.
+    """
+    pending = OrderedDict()
+    backoff = Backoff()
+
+    def track(numbered_actions):
+        for row, action in numbered_actions:
+            # runs in parallel_bulk's thread feeding the workers
+            backoff.wait()
+            pending[action['_id']] = (row, action)
+            if progress is not None:
+                progress.read_until = row + 1
+            yield action
+
+    results = parallel_bulk(
+        ELASTIC,
+        track(numbered_actions),
+        thread_count=workers,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False,
+        raise_on_exception=False,
+    )
+    retry = []
+    for ok, result in results:
+        info = next(iter(result.values()))
+        row, action = pending.pop(info['_id'])
+        if ok:
+            reporter.add()
+            metrics.increment('documents_indexed')
+            backoff.accepted()
+        elif is_retryable(info):
+            retry.append((row, action))
+            metrics.increment('index_errors', status=info.get('status'))
+            if info.get('status') == 429:
+                backoff.rejected()
+        else:
+            dead_letters.write(action, info)
+            metrics.increment('index_errors', status=info.get('status'))
+        if (max_pending_retries is not None
+                and len(retry) >= max_pending_retries):
+            backoff.sending.clear()
+            try:
+                retry_failed(retry, workers, chunk_size, max_chunk_bytes,
+                             reporter, dead_letters, max_retries)
+            finally:
+                backoff.sending.set()
+            retry = []
+        if checkpoint is not None:
+            checkpoint.advance(progress.first_undone(pending, retry))
+    return retry
+
+
+def retry_failed(retry, workers, chunk_size, max_chunk_bytes, reporter,
+                 dead_letters, max_retries=3):
+    """Retry documents that failed with backoff, then give up on them"""
+    for attempt in range(1, max_retries + 1):
+        if not retry:
+            break
+        delay = 2 ** attempt
+        logger.warning(f"retrying {len(retry)} documents in {delay}s "
+                       f"(attempt {attempt}/{max_retries})")
+        time.sleep(delay)
+        # no more than were passed in can fail, so there's nothing to cap
+        retry = bulk_index(retry, workers, chunk_size, max_chunk_bytes,
+                           reporter, dead_letters, max_pending_retries=None)
+
+    for _, action in retry:
+        dead_letters.write(action, {'error': 'retries exhausted'})
+
+
+def index_speeches(path, index_name, limit, workers, chunk_size=500,
+                   max_chunk_bytes=10 * 1024 * 1024, read_size=10000,
+                   max_retries=3, resume=False, checkpoint_path=None,
+                   dead_letter_path=None, skip_unchanged_docs=False):
+    """Index an extracted file of speeches using the bulk API.
+
+    Progress is saved to a checkpoint file, by default in the data directory,
+    and with resume indexing continues from it. Documents that can't be
+    indexed are appended to a dead letter CSV. With skip_unchanged_docs,
+    speeches already indexed with the same text are not sent again.
+    """
+    from .checkpoint import Checkpoint, DeadLetters
+    if workers > config.ELASTIC_MAXSIZE:
+        logger.warning(f"{workers} workers will share {config.ELASTIC_MAXSIZE}"
+                       " connections, set AUSTXT_ELASTIC_MAXSIZE to add more")
+    global_elastic()
+    if checkpoint_path is None:
+        checkpoint_path = config.DATA_PATH / f"{index_name}_checkpoint.json"
+    if dead_letter_path is None:
+        dead_letter_path = config.DATA_PATH / f"{index_name}_failed.csv"
+    checkpoint = Checkpoint(checkpoint_path, path, index_name)
+    if resume:
+        checkpoint.load()
+        if checkpoint.complete:
+            print(f"{path} was already indexed into {index_name}")
+            return 0, 0
+        logger.info(f"resuming from row {checkpoint.rows}")
+
+    reporter = ThroughputReporter()
+    dead_letters = DeadLetters(dead_letter_path)
+    progress = Progress(checkpoint.rows)
+    actions = speech_actions(path, index_name, limit, read_size,
+                             checkpoint.rows)
+    if skip_unchanged_docs:
+        actions = skip_unchanged(actions, index_name, progress=progress)
     try:
-        ELASTIC.index(
-            id=row["speech_id"],
-            body={'text':row['text']},
-            index=index,
-            doc_type=DOC_TYPE,
-        )
-    except urllib3.exceptions.ProtocolError:
-        print(f"Error indexing: {row['speech_id']}", file=sys.stderr)
-    if (i + 1) % 1000 == 0:
-        print(i + 1)
-
-
-def index_speeches(path, index_name, limit, workers):
-    """Index an extracted CSV file of speeches"""
-    speech_df = pd.read_csv(path, nrows=limit)
-    func = partial(index_speech, index_name)
-    rows = ((index, row) for index, row in speech_df.iterrows())
-    if workers == 1:
-        global_elastic()
-        speeches = map(func, rows)
-        deque(speeches, maxlen=0)
-    else:
-        with Pool(workers, global_elastic) as pool:
-            speeches = pool.imap(func, rows)
-            deque(speeches, maxlen=0)
+        retry = bulk_index(actions, workers, chunk_size, max_chunk_bytes,
+                           reporter, dead_letters, checkpoint, progress,
+                           max_retries)
+
+        retry_failed(retry, workers, chunk_size, max_chunk_bytes, reporter,
+                     dead_letters, max_retries)
+        checkpoint.finish(progress.read_until)
+    finally:
+        # keep the progress made so far if interrupted
+        if not checkpoint.complete:
+            checkpoint.save()
+        dead_letters.close()
+
+    if dead_letters.count:
+        print(f"{dead_letters.count} documents failed to index, see "
+              f"{dead_letter_path}", file=sys.stderr)
+    reporter.report()
+    bump_generations(index_name)
+    return reporter.count, dead_letters.count
+
+
+def versioned_index_name(alias):
+    return f"{alias}_{time.strftime('%Y%m%d%H%M%S')}"
 
 
-def do_query(query, index_name, size, query_type):
+def create_index(index_name, shards=None):
+    """Create an index set up for bulk loading, with the english analyzer"""
     global_elastic()
+    # no refreshes or replicas until loading is finished, see finish_index
+    settings = {
+        'number_of_replicas': 0,
+        'refresh_interval': '-1',
+        # queries are sorted by _doc so the text field's scores are free to
+        # be term frequencies
+        'similarity': {TF_SIMILARITY: {
+            'type': 'scripted',
+            'script': {'source': 'return doc.freq;'},
+        }},
+    }
+    if shards is not None:
+        settings['number_of_shards'] = shards
+    properties = {
+        TEXT_FIELD: {'type': 'text', 'analyzer': 'english',
+                     'similarity': TF_SIMILARITY},
+        CONTENT_HASH_FIELD: {'type': 'keyword', 'index': False},
+    }
+    properties.update(METADATA_FIELDS)
+    ELASTIC.indices.create(index=index_name, body={
+        'settings': settings,
+        'mappings': {DOC_TYPE: {'properties': properties}},
+    })
+
+
+def finish_index(index_name, replicas=1):
+    """Make a loaded index searchable and wait for it to be allocated"""
+    global_elastic()
+    ELASTIC.indices.put_settings(index=index_name, body={
+        # null restores the default refresh interval
+        'index': {'refresh_interval': None, 'number_of_replicas': replicas},
+    })
+    ELASTIC.indices.refresh(index=index_name)
+    ELASTIC.cluster.health(index=index_name, wait_for_status='yellow',
+                           timeout='5m', request_timeout=330)
+
+
+def alias_indices(alias):
+    """Names of the indices an alias points to"""
+    global_elastic()
+    try:
+        return sorted(ELASTIC.indices.get_alias(name=alias))
+    except NotFoundError:
+        return []
+
+
+def index_aliases(index_name):
+    """The names an index can be queried by, its own and its aliases'.
+
+    index_name can be an alias, when its indices' names are included too.
+    """
+    global_elastic()
+    try:
+        found = ELASTIC.indices.get_alias(index=index_name)
+    except NotFoundError:
+        return [index_name]
+    names = {index_name}
+    for name, info in found.items():
+        names.add(name)
+        names.update(info.get('aliases', {}))
+    return sorted(names)
+
+
+def bump_generations(index_name):
+    """Invalidate cached results for an index under all its names"""
+    for name in index_aliases(index_name):
+        bump_generation(name)
+
+
+def swap_alias(alias, index_name):
+    """Atomically point an alias at an index instead of its current ones.
+
+    An index with the alias's name, from before indices were versioned, is
+    deleted in the same request so that the alias can replace it.
+    """
+    global_elastic()
+    old_indices = alias_indices(alias)
+    actions = [{'remove': {'index': old, 'alias': alias}}
+               for old in old_indices]
+    if not old_indices and ELASTIC.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    ELASTIC.indices.update_aliases(body={'actions': actions})
+    return old_indices
+
+
+def prune_indices(alias, keep):
+    """Delete all but the newest keep versions of an alias's indices that
+    it no longer points to"""
+    global_elastic()
+    current = set(alias_indices(alias))
+    version_re = re.compile(rf'^{re.escape(alias)}_\d{{14}}$')
+    versions = sorted(name for name in ELASTIC.indices.get(f"{alias}_*")
+                      if version_re.match(name) and name not in current)
+    old = versions[:len(versions) - keep] if keep else versions
+    for index_name in old:
+        logger.info(f"deleting old index {index_name}")
+        ELASTIC.indices.delete(index=index_name)
+    return old
+
+
+def reindex_speeches(path, alias, limit=None, workers=4, shards=None,
+                     replicas=1, keep=1, allow_failures=False, **kwargs):
+    """Load speeches into a new version of an index, then swap an alias to it.
+
+    Queries read from the alias, so they see the old index until the new one
+    is fully loaded, refreshed and allocated. If any documents fail to index
+    the alias is left alone, unless allow_failures is set.
+    """
+    from .checkpoint import Checkpoint
+    index_name = versioned_index_name(alias)
+    create_index(index_name, shards)
+    checkpoint_path = config.DATA_PATH / f"{index_name}_checkpoint.json"
+    count, failed = index_speeches(path, index_name, limit, workers,
+                                   checkpoint_path=checkpoint_path, **kwargs)
+    # a new index is made each time, so there is nothing to resume
+    Checkpoint(checkpoint_path, path, index_name).remove()
+    publish_index(alias, index_name, failed, replicas, keep, allow_failures)
+    return index_name, count, failed
+
+
+def publish_index(alias, index_name, failed=0, replicas=1, keep=1,
+                  allow_failures=False):
+    """Finish loading a new version of an alias's index and swap the alias
+    to it, unless failed documents didn't make it in and that isn't allowed"""
+    if failed and not allow_failures:
+        raise RuntimeError(f"{failed} documents failed to index, {alias} "
+                           f"still points to {alias_indices(alias)} and "
+                           f"{index_name} was left for inspection")
+    finish_index(index_name, replicas)
+    old_indices = swap_alias(alias, index_name)
+    logger.info(f"{alias} now points to {index_name} instead of "
+                f"{old_indices}")
+    prune_indices(alias, keep)
+    # cached results are keyed on the alias
+    bump_generations(alias)
+
+
+def filter_clauses(filters):
+    """Filter clauses for a dict of metadata filters, as named in FILTERS.
+
+    house, party and speaker_id can be a single value or a list of them.
+    """
+    clauses = []
+    dates = {}
+    if filters.get('date_from'):
+        dates['gte'] = filters['date_from']
+    if filters.get('date_to'):
+        dates['lte'] = filters['date_to']
+    if dates:
+        clauses.append({'range': {'date': dates}})
+    for field in ['house', 'party', 'speaker_id']:
+        values = filters.get(field)
+        if values is None or values == '' or values == []:
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        clauses.append({'terms': {field: list(values)}})
+    return clauses
+
+
+def query_body(query, query_type, filters=None):
     if query_type == "exact":
-        body= {
-            "explain": True,
-            "query": {
-                "match_phrase": {
-                    TEXT_FIELD : query
-                }
+        match = {
+            "match_phrase": {
+                TEXT_FIELD : query
             }
         }
     else:
-        body = {
-            "explain": True,
-            "query": {
-                "match": {
-                    TEXT_FIELD :{ 
-                        "query" : query,
-                        "operator": query_type,
-                    }
-                },
-            }
+        match = {
+            "match": {
+                TEXT_FIELD :{ 
+                    "query" : query,
+                    "operator": query_type,
+                }
+            },
         }
-        
-    result = ELASTIC.search(
+    clauses = filter_clauses(filters) if filters else []
+    if clauses:
+        # filters don't affect scores and are cached by elasticsearch
+        return {"query": {"bool": {"must": match, "filter": clauses}}}
+    return {"query": match}
+
+
+def do_query(query, index_name, size, query_type, filters=None):
+    global_elastic()
+    body = query_body(query, query_type, filters)
+    body.update(track_total_hits=True)
+    result = with_backoff(
+        ELASTIC.search,
         index=index_name,
         doc_type=DOC_TYPE,
         body=body,
@@ -96,7 +621,166 @@ def do_query(query, index_name, size, query_type):
     return result
 
 
+def iter_query_hits(query, query_type, index_name, page_size, filters=None):
+    """Lazily page through every hit of a query using the scroll API"""
+    global_elastic()
+    body = query_body(query, query_type, filters)
+    body.update(stored_fields=[])
+    # scan sorts by _doc, so hits are not scored
+    return scan(ELASTIC, query=body, index=index_name, doc_type=DOC_TYPE,
+                size=page_size)
+
+
+def do_hit_ids(query, query_type, index_name, offset, size, filters=None):
+    """The IDs of a page of the hits of a query, in a single request"""
+    if offset + size > MAX_RESULT_WINDOW:
+        raise ValueError(f"can't page past the first {MAX_RESULT_WINDOW} "
+                         f"hits")
+    global_elastic()
+    body = query_body(query, query_type, filters)
+    # in the same order as every other page
+    body.update({'_source': False, 'sort': ['_doc'], 'from': offset,
+                 'size': size})
+    result = with_backoff(ELASTIC.search, index=index_name, doc_type=DOC_TYPE,
+                          body=body)
+    return [hit['_id'] for hit in result['hits']['hits']]
+
+
+def hits_total(response):
+    total = response['hits']['total']
+    # elasticsearch 7 reports the total as an object, which is only exact
+    # for searches with track_total_hits
+    return total['value'] if isinstance(total, dict) else total
+
+
+def do_multi_query(queries, index_name, size, filters=None):
+    """Run a list of (query, query_type) pairs in a single _msearch request"""
+    global_elastic()
+    body = []
+    for query, query_type in queries:
+        search = query_body(query, query_type, filters)
+        # the total decides whether to scroll, so must not be capped
+        search.update(stored_fields=[], size=size, sort=['_doc'],
+                      track_total_hits=True)
+        body.extend([{}, search])
+    result = with_backoff(ELASTIC.msearch, body=body, index=index_name,
+                          doc_type=DOC_TYPE)
+    for response in result['responses']:
+        if 'error' in response:
+            raise RuntimeError(f"query failed: {response['error']}")
+    return result['responses']
+
+
+def do_aggregate(query, query_type, index_name, interval='year',
+                 group_by=None, filters=None):
+    """Count the speeches matching a query and sum the query's frequency in
+    them, per interval of time and optionally per value of a metadata field.
+
+    Returns a dict for each period and group. Frequencies are the scores of
+    the text field's similarity, which count phrases for exact queries but
+    are the sum of the frequencies of each term for multi-term and and or
+    queries. They are only right for indices made by create_index.
+    """
+    global_elastic()
+    sums = {'tf': {'sum': {'script': {'source': '_score'}}}}
+    if group_by is not None:
+        terms = {'field': group_by, 'size': 10000}
+        if METADATA_FIELDS[group_by]['type'] == 'keyword':
+            terms['missing'] = 'unknown'
+        sums = {'groups': {'terms': terms, 'aggs': sums}}
+    body = query_body(query, query_type, filters)
+    body.update(size=0, aggs={'periods': {
+        'date_histogram': {'field': 'date', 'interval': interval,
+                           'format': 'yyyy-MM-dd', 'min_doc_count': 1},
+        'aggs': sums,
+    }})
+    result = with_backoff(ELASTIC.search, index=index_name, doc_type=DOC_TYPE,
+                          body=body)
+    rows = []
+    for period in result['aggregations']['periods']['buckets']:
+        groups = period['groups']['buckets'] if group_by else [period]
+        for group in groups:
+            row = {'period': period['key_as_string']}
+            if group_by is not None:
+                row[group_by] = group['key']
+            row.update(speeches=group['doc_count'],
+                       tf=int(round(group['tf']['value'])))
+            rows.append(row)
+    return rows
+
+
+def do_highlight(identifiers, query, query_type, index_name, tags):
+    """Get the text of several documents with each match of a query in it
+    wrapped in a pair of tags, in a single request.
+
+    Documents that don't match the query are left out.
+    """
+    global_elastic()
+    match = query_body(query, query_type)['query']
+    body = {
+        'query': {'bool': {'must': match, 'filter': [
+            {'ids': {'values': list(identifiers)}}]}},
+        '_source': False,
+        'size': len(identifiers),
+        # the whole text, so that windows of words can be cut around matches
+        'highlight': {'pre_tags': [tags[0]], 'post_tags': [tags[1]],
+                      'fields': {TEXT_FIELD: {'number_of_fragments': 0}}},
+    }
+    result = with_backoff(ELASTIC.search, index=index_name, doc_type=DOC_TYPE,
+                          body=body)
+    return {hit['_id']: hit['highlight'][TEXT_FIELD][0]
+            for hit in result['hits']['hits'] if 'highlight' in hit}
+
+
+def do_analyze(text, index_name):
+    """Analyze text using the analyzer of the text field"""
+    global_elastic()
+    result = with_backoff(
+        ELASTIC.indices.analyze,
+        index=index_name,
+        body={'field': TEXT_FIELD, 'text': text},
+    )
+    return result['tokens']
+
+
+def do_term_vectors(identifiers, index_name, positions=False):
+    """Get the terms and their frequencies for the text of several documents"""
+    global_elastic()
+    result = with_backoff(
+        ELASTIC.mtermvectors,
+        index=index_name,
+        doc_type=DOC_TYPE,
+        body={
+            'ids': list(identifiers),
+            'parameters': {
+                'fields': [TEXT_FIELD],
+                'positions': positions,
+                'offsets': False,
+                'payloads': False,
+                'term_statistics': False,
+                'field_statistics': False,
+            }
+        }
+    )
+    return result['docs']
+
+
+def do_mget(identifiers, index_name, fields):
+    """Get some fields of several documents"""
+    global_elastic()
+    result = with_backoff(ELASTIC.mget, body={'ids': list(identifiers)},
+                          index=index_name, doc_type=DOC_TYPE,
+                          _source_includes=fields)
+    return result['docs']
+
+
 def do_get(identifier, index_name):
     global_elastic()
-    return ELASTIC.get(id=identifier, index=index_name, doc_type=DOC_TYPE)
+    return with_backoff(ELASTIC.get, id=identifier, index=index_name,
+                        doc_type=DOC_TYPE)
+
+
+def do_ping():
+    global_elastic()
+    return ELASTIC.ping()
     
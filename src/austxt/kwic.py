@@ -0,0 +1,164 @@
+"""Keyword in context: the words either side of each match of a query.
+
+Backends find the matches in a batch of speeches at once, Elasticsearch by
+highlighting them and the local index with the approximation of its english
+analyzer in analysis.py. Windows of words are then cut around each match,
+and can be kept in a SnippetCache so that pages of hits seen again are not
+fetched again.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from . import config, metrics
+from .analysis import analyze, analyze_word, tokenize
+from .utils import batched
+from .query_cache import normalize_query, read_generations
+
+
+# wrap matches highlighted by elasticsearch, characters from Unicode's
+# private use area so they can't be confused with the text of a speech
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+DEFAULT_WIDTH = 8
+MAX_WIDTH = 50
+
+
+def marked_spans(marked):
+    """Remove the marks from highlighted text, returning the text and the
+    spans of characters that were marked"""
+    text, spans = [], []
+    length, start = 0, None
+    for i, part in enumerate(marked.split(MARK_START)):
+        if i > 0:
+            start = length
+        if MARK_END in part:
+            match, rest = part.split(MARK_END, 1)
+            spans.append((start, start + len(match)))
+            part = match + rest
+        text.append(part)
+        length += len(part)
+    return ''.join(text), spans
+
+
+def query_spans(text, query, query_type):
+    """The spans of characters of the matches of a query in text"""
+    query_terms = analyze(query)
+    if not query_terms:
+        return []
+    tokens = list(tokenize(text))
+    terms = [analyze_word(word) for word, _, _ in tokens]
+    if query_type == 'exact' and len(query_terms) > 1:
+        # positions count stop words, so are offsets into the tokens
+        first = query_terms[0][1]
+        offsets = [(term, position - first) for term, position in query_terms]
+        last = offsets[-1][1]
+        return [(tokens[i][1], tokens[i + last][2])
+                for i in range(len(tokens) - last)
+                if all(terms[i + offset] == term for term, offset in offsets)]
+    wanted = {term for term, _ in query_terms}
+    return [(start, end) for (_, start, end), term in zip(tokens, terms)
+            if term in wanted]
+
+
+def merge_spans(text, spans):
+    """Join matches that are only separated by stop words and punctuation.
+
+    Elasticsearch highlights each word of a phrase on its own, so this makes
+    each occurrence of a phrase one match.
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and not any(analyze_word(word) for word, _, _
+                              in tokenize(text[merged[-1][1]:start])):
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def collapse(text):
+    return ' '.join(text.split())
+
+
+def windows(text, spans, width=DEFAULT_WIDTH):
+    """The width words either side of each span of text"""
+    tokens = [(start, end) for _, start, end in tokenize(text)]
+    starts = [start for start, _ in tokens]
+    ends = [end for _, end in tokens]
+    snippets = []
+    for start, end in spans:
+        # the words wholly before and after the match
+        before = bisect_right(ends, start)
+        after = bisect_left(starts, end)
+        left = starts[max(before - width, 0)] if before else start
+        right = ends[min(after + width, len(tokens)) - 1] if after < len(
+            tokens) else end
+        snippets.append({'left': collapse(text[left:start]),
+                         'match': collapse(text[start:end]),
+                         'right': collapse(text[end:right])})
+    return snippets
+
+
+class SnippetCache:
+    """The windows of recently seen speeches, least recently used first"""
+
+    def __init__(self, max_entries=config.KWIC_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, snippets):
+        with self.lock:
+            self.entries[key] = snippets
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def kwic(backend, speech_ids, query, query_type, width=DEFAULT_WIDTH,
+         batch_size=100, cache=None):
+    """Yield a dict for each match of a query in some speeches, with the
+    width words to its left and right.
+
+    The matches are found in batch_size speeches per request to the backend,
+    skipping those with windows in cache.
+    """
+    prefix = None
+    if cache is not None:
+        # windows are stale once the index is modified
+        generation = read_generations(config.QUERY_CACHE_PATH).get(
+            backend.index_name, 0)
+        prefix = (backend.index_name, generation, normalize_query(query),
+                  query_type, width)
+
+    for batch in batched(speech_ids, batch_size):
+        found = {}
+        if cache is not None:
+            for speech_id in batch:
+                snippets = cache.get(prefix + (speech_id,))
+                if snippets is not None:
+                    found[speech_id] = snippets
+            metrics.increment('snippet_cache_hits', len(found))
+            metrics.increment('snippet_cache_misses', len(batch) - len(found))
+        missing = [speech_id for speech_id in batch if speech_id not in found]
+        if missing:
+            with metrics.timer('highlight_seconds'):
+                highlighted = backend.highlight(missing, query, query_type)
+            for speech_id in missing:
+                text, spans = highlighted.get(speech_id, ('', []))
+                if query_type == 'exact':
+                    spans = merge_spans(text, spans)
+                found[speech_id] = windows(text, spans, width)
+                if cache is not None:
+                    cache.put(prefix + (speech_id,), found[speech_id])
+        for speech_id in batch:
+            for snippet in found[speech_id]:
+                yield dict(speech_id=speech_id, **snippet)
@@ -0,0 +1,229 @@
+import json
+import time
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+
+from .analysis import analyze
+from .datasets import iter_dataset
+from .utils import batched
+
+
+logger = logging.getLogger(__package__)
+
+TERMS_FILE = 'terms.json'
+META_FILE = 'meta.json'
+DOCS_FILE = 'docs.arrow'
+ARRAY_NAMES = ['doc_ids', 'doc_order', 'term_offsets', 'postings_docs',
+               'postings_freqs', 'position_offsets', 'positions']
+
+
+def analyze_chunk(chunk):
+    """Analyze texts into parallel arrays of terms, doc numbers and positions"""
+    start_doc, texts = chunk
+    terms, docs, positions = [], [], []
+    for doc, text in enumerate(texts, start_doc):
+        for term, position in analyze(text):
+            terms.append(term)
+            docs.append(doc)
+            positions.append(position)
+    return terms, np.array(docs, dtype=np.int32), np.array(positions,
+                                                           dtype=np.int32)
+
+
+def iter_chunks(path, chunk_size, docs_writer, doc_ids):
+    """Yield (start_doc, texts), storing the ids and texts as they are read"""
+    for chunk in iter_dataset(path, columns=['speech_id', 'text'],
+                              chunk_size=chunk_size):
+        chunk = chunk.fillna({'text': ''}).astype(str)
+        docs_writer.write_table(pa.Table.from_pandas(chunk,
+                                                     preserve_index=False))
+        start_doc = len(doc_ids)
+        doc_ids.extend(chunk['speech_id'])
+        yield start_doc, chunk['text'].tolist()
+
+
+def build_local_index(path, index_path, workers=1, chunk_size=5000):
+    """Build a positional inverted index of the text of a speeches dataset.
+
+    Postings are stored as flat NumPy arrays sorted by term, then document,
+    then position, so that they can be memory-mapped when querying. Each
+    term has a range of postings in term_offsets, and each posting has a
+    document, a frequency and a range of positions in position_offsets.
+    """
+    index_path = Path(index_path)
+    index_path.mkdir(parents=True, exist_ok=True)
+    vocab = {}
+    all_terms, all_docs, all_positions, doc_ids = [], [], [], []
+
+    schema = pa.schema([('speech_id', pa.string()), ('text', pa.string())])
+    with pa.OSFile(str(index_path / DOCS_FILE), 'wb') as sink, \
+         pa.ipc.new_file(sink, schema) as docs_writer:
+        chunks = iter_chunks(path, chunk_size, docs_writer, doc_ids)
+        for terms, docs, positions in analyze_chunks(chunks, workers):
+            term_ids = [vocab.setdefault(term, len(vocab)) for term in terms]
+            all_terms.append(np.array(term_ids, dtype=np.int32))
+            all_docs.append(docs)
+            all_positions.append(positions)
+            logger.info(f"analyzed {len(doc_ids)} documents")
+
+    # renumber terms alphabetically so that they can be looked up by bisection
+    sorted_terms = sorted(vocab)
+    renumber = np.empty(len(vocab), dtype=np.int32)
+    renumber[[vocab[term] for term in sorted_terms]] = np.arange(len(vocab))
+    terms = renumber[np.concatenate(all_terms or [np.array([], np.int32)])]
+    docs = np.concatenate(all_docs or [np.array([], np.int32)])
+    positions = np.concatenate(all_positions or [np.array([], np.int32)])
+    del all_terms, all_docs, all_positions
+
+    # documents and positions are already in order, so a stable sort by term
+    # gives the order of (term, doc, position)
+    order = np.argsort(terms, kind='stable')
+    terms, docs, positions = terms[order], docs[order], positions[order]
+    del order
+
+    new_posting = np.ones(len(terms), dtype=bool)
+    new_posting[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+    posting_starts = np.flatnonzero(new_posting)
+    position_offsets = np.append(posting_starts, len(terms))
+    posting_terms = terms[posting_starts]
+
+    doc_ids = np.array(doc_ids, dtype=bytes)
+    arrays = {
+        'doc_ids': doc_ids,
+        'doc_order': np.argsort(doc_ids),
+        'term_offsets': np.searchsorted(posting_terms,
+                                        np.arange(len(vocab) + 1)),
+        'postings_docs': docs[posting_starts],
+        'postings_freqs': np.diff(position_offsets).astype(np.int32),
+        'position_offsets': position_offsets,
+        'positions': positions,
+    }
+    for name, array in arrays.items():
+        np.save(index_path / f"{name}.npy", array)
+    with open(index_path / TERMS_FILE, 'w') as f:
+        json.dump(sorted_terms, f)
+    with open(index_path / META_FILE, 'w') as f:
+        json.dump({'source': str(path), 'built': time.time(),
+                   'num_docs': len(doc_ids), 'num_terms': len(vocab)}, f)
+
+
+def analyze_chunks(chunks, workers):
+    if workers == 1:
+        yield from map(analyze_chunk, chunks)
+        return
+    with Pool(workers) as pool:
+        # only read as many chunks as there are workers to analyze them
+        for window in batched(chunks, workers):
+            yield from pool.map(analyze_chunk, window)
+
+
+class LocalIndex:
+    """Query a positional inverted index built by build_local_index"""
+
+    def __init__(self, index_path):
+        self.path = Path(index_path)
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(self.path / f"{name}.npy",
+                                        mmap_mode='r'))
+        with open(self.path / TERMS_FILE) as f:
+            self.term_ids = {term: i for i, term in enumerate(json.load(f))}
+        with open(self.path / META_FILE) as f:
+            self.meta = json.load(f)
+        self.docs = None
+
+    def postings(self, term):
+        """Return the posting numbers, docs and frequencies of a term"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty.astype(np.int32), empty.astype(np.int32)
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return (np.arange(start, end), self.postings_docs[start:end],
+                self.postings_freqs[start:end])
+
+    def term_positions(self, posting):
+        start = self.position_offsets[posting]
+        end = self.position_offsets[posting + 1]
+        return self.positions[start:end]
+
+    def search(self, query, query_type):
+        """Return arrays of matching doc numbers and their term frequencies.
+
+        Frequencies follow the Elasticsearch backend: the number of phrase
+        occurrences for exact queries, otherwise the frequency of the least
+        frequent query term in the document.
+        """
+        query_terms = analyze(query)
+        if not query_terms:
+            return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+        postings = [self.postings(term) for term, _ in query_terms]
+
+        if query_type == 'or':
+            docs = np.concatenate([p[1] for p in postings])
+            freqs = np.concatenate([p[2] for p in postings])
+            order = np.lexsort((freqs, docs))
+            docs, freqs = docs[order], freqs[order]
+            first = np.ones(len(docs), dtype=bool)
+            first[1:] = docs[1:] != docs[:-1]
+            # sorted by freq within each doc, so the first is the minimum
+            return docs[first], freqs[first]
+
+        docs = postings[0][1]
+        for _, term_docs, _ in postings[1:]:
+            docs = np.intersect1d(docs, term_docs, assume_unique=True)
+        if query_type == 'exact' and len(query_terms) > 1:
+            return self.phrase_frequencies(query_terms, postings, docs)
+
+        freqs = None
+        for _, term_docs, term_freqs in postings:
+            found = term_freqs[np.searchsorted(term_docs, docs)]
+            freqs = found if freqs is None else np.minimum(freqs, found)
+        return docs, freqs
+
+    def phrase_frequencies(self, query_terms, postings, docs):
+        start = query_terms[0][1]
+        phrase_docs, phrase_freqs = [], []
+        posting_numbers = [numbers[np.searchsorted(term_docs, docs)]
+                           for numbers, term_docs, _ in postings]
+        for i, doc in enumerate(docs):
+            starts = None
+            for (term, position), numbers in zip(query_terms, posting_numbers):
+                term_starts = (self.term_positions(numbers[i]) -
+                               (position - start))
+                starts = (term_starts if starts is None else
+                          np.intersect1d(starts, term_starts,
+                                         assume_unique=True))
+            if len(starts):
+                phrase_docs.append(doc)
+                phrase_freqs.append(len(starts))
+        return (np.array(phrase_docs, dtype=np.int32),
+                np.array(phrase_freqs, dtype=np.int32))
+
+    def term_frequencies(self, query, query_type, size=None):
+        """Return a list of (doc_id, tf) for a query"""
+        docs, freqs = self.search(query, query_type)
+        docs, freqs = docs[:size], freqs[:size]
+        doc_ids = np.char.decode(self.doc_ids[docs], 'utf-8')
+        return list(zip(doc_ids.tolist(), freqs.tolist()))
+
+    def doc_number(self, identifier):
+        key = identifier.encode('utf-8')
+        i = np.searchsorted(self.doc_ids, key, sorter=self.doc_order)
+        if i == len(self.doc_order) or self.doc_ids[self.doc_order[i]] != key:
+            return None
+        return int(self.doc_order[i])
+
+    def get(self, identifier):
+        """Get the text of a document, in the shape of an Elasticsearch get"""
+        doc = self.doc_number(identifier)
+        if doc is None:
+            return {'_id': identifier, 'found': False}
+        if self.docs is None:
+            source = pa.memory_map(str(self.path / DOCS_FILE))
+            self.docs = pa.ipc.open_file(source).read_all()
+        text = self.docs.column('text')[doc].as_py()
+        return {'_id': identifier, 'found': True, '_source': {'text': text}}
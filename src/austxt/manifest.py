@@ -0,0 +1,100 @@
+import json
+import logging
+import hashlib
+from pathlib import Path
+
+import pandas as pd
+
+
+logger = logging.getLogger(__package__)
+
+MANIFEST_NAME = 'manifest.json'
+
+# bump this when a change to extraction means cached speeches are stale
+EXTRACTION_VERSION = 1
+
+
+def file_hash(path, block_size=1024 * 1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Manifest:
+    """Tracks which XML files have been processed and caches their speeches.
+
+    Each entry records a file's mtime, size and content hash along with the
+    settings it was processed with. A file whose mtime and size are unchanged
+    is assumed to be unchanged; otherwise its hash is compared, so touching a
+    file does not force it to be reprocessed.
+    """
+
+    def __init__(self, cache_path, settings):
+        self.path = Path(cache_path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.settings = dict(settings, version=EXTRACTION_VERSION)
+        self.manifest_path = self.path / MANIFEST_NAME
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def cache_file(self, xml_path):
+        # files with the same name in different directories are kept apart
+        # by a hash of their full path
+        digest = hashlib.sha1(self.key(xml_path).encode('utf-8')).hexdigest()
+        return self.path / f"{Path(xml_path).stem}_{digest[:16]}.pkl"
+
+    def key(self, xml_path):
+        return str(Path(xml_path).resolve())
+
+    def is_current(self, xml_path):
+        entry = self.entries.get(self.key(xml_path))
+        if entry is None or entry['settings'] != self.settings:
+            return False
+        if not self.cache_file(xml_path).exists():
+            return False
+        stat = Path(xml_path).stat()
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return True
+        if (entry['size'] == stat.st_size and
+                entry['hash'] == file_hash(xml_path)):
+            # contents are the same, just remember the new mtime
+            entry['mtime'] = stat.st_mtime
+            return True
+        return False
+
+    def load(self, xml_path):
+        return pd.read_pickle(self.cache_file(xml_path))
+
+    def store(self, xml_path, speeches_df):
+        speeches_df.to_pickle(self.cache_file(xml_path))
+        stat = Path(xml_path).stat()
+        self.entries[self.key(xml_path)] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'hash': file_hash(xml_path),
+            'settings': self.settings,
+        }
+
+    def save(self):
+        # forget files that have since been removed
+        for xml_path in list(self.entries):
+            if not Path(xml_path).exists():
+                del self.entries[xml_path]
+                if self.cache_file(xml_path).exists():
+                    self.cache_file(xml_path).unlink()
+        # and cached speeches no entry refers to, such as those named by
+        # earlier versions
+        current = {self.cache_file(xml_path) for xml_path in self.entries}
+        for cache_file in self.path.glob('*.pkl'):
+            if cache_file not in current:
+                cache_file.unlink()
+
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        tmp_path.replace(self.manifest_path)
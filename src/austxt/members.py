@@ -0,0 +1,123 @@
+"""The party, division etc. of members on the date of each speech.
+
+members.csv has a row for each period a member served, and the party or
+division of a member can differ between periods. The periods are loaded
+once into a lookup sorted by start date, which is cached on disk in
+config.MEMBERS_CACHE_PATH, and each speech is matched to the period of its
+speaker containing its date with pandas.merge_asof. Speeches outside every
+period of their speaker take the one starting nearest to them.
+"""
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import config, metrics
+from .datasets import read_dataset
+from .store import source_stamp, is_current, replace_file, META_FILE
+
+
+logger = logging.getLogger(__package__)
+
+# in the order of the columns of members.csv
+MEMBER_COLUMNS = ['division', 'party', 'gender']
+INTERVALS_FILE = '{name}.parquet'
+# for periods without a start or end date
+FIRST_DAY = 0
+LAST_DAY = 99991231
+
+
+def date_numbers(dates, missing):
+    """ISO dates as integers like 20200131, which sort the same way"""
+    # speeches share a few dates, so only convert each date once
+    codes, uniques = pd.factorize(dates)
+    digits = pd.Series(uniques).astype(str).str.replace('-', '', regex=False)
+    numbers = pd.to_numeric(digits, errors='coerce').fillna(missing)
+    numbers = numbers.astype(np.int64).to_numpy()
+    return np.where(codes == -1, missing, numbers[codes])
+
+
+def member_intervals(members_df):
+    """The periods of every member as a lookup sorted by start date"""
+    intervals = members_df.drop(['from_date', 'to_date'], axis=1)
+    intervals.insert(1, 'start', date_numbers(members_df['from_date'],
+                                              FIRST_DAY))
+    intervals.insert(2, 'end', date_numbers(members_df['to_date'], LAST_DAY))
+    intervals['member_id'] = intervals['member_id'].astype(np.int64)
+    return intervals.sort_values('start', kind='stable', ignore_index=True)
+
+
+def load_member_intervals(members_path, cache_path=None):
+    """The member lookup of a members dataset, built when it has changed.
+
+    The lookup is cached in cache_path, by default config.MEMBERS_CACHE_PATH.
+    If that can't be written to it is rebuilt every time.
+    """
+    members_path = Path(members_path)
+    cache_path = Path(cache_path or config.MEMBERS_CACHE_PATH)
+    name = f"{members_path.stem}_intervals"
+    intervals_path = cache_path / INTERVALS_FILE.format(name=name)
+    if is_current(cache_path, name, members_path):
+        return pd.read_parquet(intervals_path)
+
+    intervals = member_intervals(read_dataset(members_path))
+    try:
+        cache_path.mkdir(parents=True, exist_ok=True)
+        replace_file(intervals_path, lambda path: pq.write_table(
+            pa.Table.from_pandas(intervals, preserve_index=False), path))
+        replace_file(cache_path / META_FILE.format(name=name),
+                     lambda path: path.write_text(
+                         json.dumps(source_stamp(members_path))))
+    except OSError as error:
+        logger.warning(f"could not cache the members lookup: {error}")
+    return intervals
+
+
+def add_member_attributes(speeches_df, intervals, columns=MEMBER_COLUMNS):
+    """Add the columns of the member who gave each speech, as they were on
+    the day of the speech"""
+    missing = [column for column in columns if column not in intervals]
+    if missing:
+        logger.warning(f"members dataset has no {', '.join(missing)} columns")
+    columns = [column for column in columns if column in intervals]
+
+    speeches = pd.DataFrame({
+        'member_id': speeches_df['speaker_id'].astype(np.int64).to_numpy(),
+        'start': date_numbers(speeches_df['date'], FIRST_DAY),
+        'row': np.arange(len(speeches_df)),
+    }).sort_values('start', kind='stable')
+    lookup = intervals[['start', 'end', 'member_id'] + columns]
+    matched = pd.merge_asof(speeches, lookup, on='start', by='member_id')
+    # the latest period starting before a speech may have already ended, or
+    # the speech may be from before the first
+    outside = ((matched['start'] > matched['end']) |
+               matched['end'].isna()).to_numpy()
+    known = matched['member_id'].isin(intervals['member_id']).to_numpy()
+    nearest = outside & known
+    if nearest.any():
+        # most members only have one period in members.csv, which is the
+        # best guess for speeches outside it, so use the period starting
+        # nearest to the speech
+        fallback = pd.merge_asof(matched.loc[nearest, ['start', 'member_id']],
+                                 lookup, on='start', by='member_id',
+                                 direction='nearest')
+        for column in columns:
+            matched[column] = matched[column].astype(object)
+            matched.loc[nearest, column] = fallback[column].to_numpy()
+        logger.info(f"{int(nearest.sum())} of {len(matched)} speeches are "
+                    "outside the dates their speaker served, using their "
+                    "nearest period instead")
+    metrics.increment('speeches_without_member', int((~known).sum()))
+
+    new_df = speeches_df.reset_index(drop=True)
+    rows = matched['row'].to_numpy()
+    for column in columns:
+        values = matched[column].astype(object).to_numpy()
+        ordered = np.empty(len(values), dtype=object)
+        ordered[rows] = values
+        new_df[column] = ordered
+    return new_df
@@ -0,0 +1,167 @@
+"""Counters, histograms and timers for finding where time goes.
+
+Metrics are kept in memory per process. The CLI prints a summary of them
+with --profile and the web app serves them at /metrics in the Prometheus
+text format. Work done in worker processes is recorded by the parent from
+timings the workers send back.
+"""
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# upper bounds in seconds, also used for counts like hits per query
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300,
+           1000, 10000, 100000, float('inf'))
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, **extra):
+    items = list(key) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+class Registry:
+
+    def __init__(self, prefix='austxt'):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds taken by a block in a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed_iter(self, iterable, name, **labels):
+        """Yield from iterable, observing the total seconds spent in it"""
+        iterator = iter(iterable)
+        elapsed = 0.0
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.observe(name, elapsed + time.perf_counter() - start,
+                             **labels)
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.monotonic()
+
+    def records(self):
+        """A dict per metric, for structured logs"""
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            for (name, key), value in sorted(self.counters.items()):
+                yield {'metric': name, 'labels': dict(key), 'type': 'counter',
+                       'value': value, 'rate': value / elapsed}
+            for (name, key), histogram in sorted(self.histograms.items()):
+                yield {'metric': name, 'labels': dict(key),
+                       'type': 'histogram', 'count': histogram.count,
+                       'sum': histogram.sum, 'min': histogram.min,
+                       'max': histogram.max,
+                       'mean': histogram.sum / histogram.count}
+
+    def summary(self):
+        """A table of every metric, for printing at the end of a command"""
+        lines = []
+        for record in self.records():
+            name = record['metric'] + format_labels(
+                label_key(record['labels']))
+            if record['type'] == 'counter':
+                lines.append(f"{name:<60} {record['value']:>12g} "
+                             f"{record['rate']:>10.1f}/s")
+            else:
+                lines.append(f"{name:<60} {record['count']:>12} "
+                             f"total {record['sum']:10.3f} "
+                             f"mean {record['mean']:.4f} "
+                             f"max {record['max']:.4f}")
+        return '\n'.join(lines)
+
+    def json_lines(self):
+        return '\n'.join(json.dumps(record) for record in self.records())
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, key), value in counters:
+            name = f"{self.prefix}_{name}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{format_labels(key)} {value}")
+        for (name, key), histogram in histograms:
+            name = f"{self.prefix}_{name}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(key, le=le)} "
+                             f"{cumulative}")
+            lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(key)} "
+                         f"{histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+increment = REGISTRY.increment
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed_iter = REGISTRY.timed_iter
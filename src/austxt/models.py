@@ -1,24 +1,86 @@
-from dataclasses import dataclass, asdict
+from array import array
+from dataclasses import dataclass, asdict, fields
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 
 class DataclassRecord:
-    
+    # fields that are always ints, which are stored in typed buffers
+    int_fields = ()
+
     def asdict(self):
         return asdict(self)
 
     @classmethod
     def to_dataframe(cls, instances):
-        records = (instance.asdict() for instance in instances)
-        return pd.DataFrame.from_records(
-            records,
-            columns=cls.__annotations__.keys()
-        )
+        columns = Columns(cls)
+        for instance in instances:
+            columns.append(instance)
+        return columns.to_dataframe()
+
+
+class Columns:
+    """Accumulates records of a dataclass field by field into column buffers.
+
+    Rows are appended as tuples of values in field order, so no object or
+    dict is made per record. Trailing fields with defaults can be left out
+    of every row, and are filled in when converting to a DataFrame.
+    """
+
+    def __init__(self, record_cls):
+        self.record_cls = record_cls
+        # names and defaults rather than fields, which can't be pickled
+        self.names = [field.name for field in fields(record_cls)]
+        self.defaults = [field.default for field in fields(record_cls)]
+        self.buffers = [array('q') if name in record_cls.int_fields else []
+                        for name in self.names]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append_values(self, values):
+        for buffer, value in zip(self.buffers, values):
+            buffer.append(value)
+        self.length += 1
+
+    def append(self, record):
+        self.append_values([getattr(record, name) for name in self.names])
+
+    def column(self, i):
+        buffer = self.buffers[i]
+        if isinstance(buffer, array):
+            # copied, so the buffer can still grow
+            return np.frombuffer(buffer, dtype=np.int64).copy()
+        if not buffer and self.length:
+            # a default that was left out of every row
+            return [self.defaults[i]] * self.length
+        return buffer
+
+    def to_dict(self):
+        return {name: self.column(i) for i, name in enumerate(self.names)}
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.to_dict(), columns=self.names)
+
+    def to_arrow(self):
+        return pa.table(self.to_dict())
+
+    def records(self):
+        """The rows as instances of the dataclass"""
+        columns = [self.column(i) for i in range(len(self.names))]
+        columns = [column.tolist() if isinstance(column, np.ndarray)
+                   else column for column in columns]
+        for values in zip(*columns):
+            yield self.record_cls(*values)
 
 
 @dataclass
 class Speech(DataclassRecord):
+    int_fields = ('speaker_id', 'num_tokens')
+
     speech_id:str
     speaker: str
     speaker_id: int
@@ -0,0 +1,333 @@
+"""Ingest directories of sitting day files in one pass.
+
+Parsing, cleaning, adding member attributes, writing datasets and indexing
+run at the same time as stages of a Pipeline, each in its own thread and
+handing batches of speeches to the next stage through a bounded queue. A
+slow stage holds back the stages before it rather than letting batches pile
+up, so memory use is bounded by the size of the queues, and no stage has to
+wait for the whole corpus to pass through the stage before it.
+
+Parsing and cleaning use worker processes of their own, started before the
+threads, and indexing keeps several bulk requests in flight, so the threads
+mostly wait on them.
+"""
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+import pandas as pd
+
+from . import config, metrics
+from .process import xml_file_paths, read_speeches_file, bounded_starmap, \
+    SpeechesWriter
+from .members import MEMBER_COLUMNS, load_member_intervals, \
+    add_member_attributes
+
+
+logger = logging.getLogger(__package__)
+
+# put on a queue after the last batch
+DONE = object()
+
+
+class Stopped(Exception):
+    """Raised in stages when another stage has failed"""
+
+
+class Pipeline:
+    """Stages running in threads that pass items through bounded queues.
+
+    If a stage fails the others stop at their next get or put, and run
+    raises the error.
+    """
+
+    def __init__(self, queue_size=4, poll_seconds=0.1):
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.threads = []
+        self.errors = []
+        self.failed = threading.Event()
+
+    def queue(self):
+        return queue.Queue(self.queue_size)
+
+    def put(self, stage_queue, item, name):
+        start = time.perf_counter()
+        while True:
+            if self.failed.is_set():
+                raise Stopped()
+            try:
+                stage_queue.put(item, timeout=self.poll_seconds)
+                break
+            except queue.Full:
+                continue
+        # time spent waiting on the next stage
+        metrics.observe('stage_blocked_seconds', time.perf_counter() - start,
+                        stage=name)
+
+    def items(self, stage_queue, name):
+        """Yield items from a queue until the stage before is done"""
+        while True:
+            start = time.perf_counter()
+            while True:
+                if self.failed.is_set():
+                    raise Stopped()
+                try:
+                    item = stage_queue.get(timeout=self.poll_seconds)
+                    break
+                except queue.Empty:
+                    continue
+            # time spent waiting on the stage before
+            metrics.observe('stage_starved_seconds',
+                            time.perf_counter() - start, stage=name)
+            if item is DONE:
+                return
+            yield item
+
+    def stage(self, name, func, source=None, outputs=()):
+        """Run func in a thread on the items of the source queue, putting
+        each item it yields on every output queue"""
+        def run():
+            try:
+                items = self.items(source, name) if source is not None else ()
+                for item in func(items) or ():
+                    metrics.increment('stage_items', stage=name)
+                    for output in outputs:
+                        self.put(output, item, name)
+                for output in outputs:
+                    self.put(output, DONE, name)
+            except Stopped:
+                pass
+            except BaseException as error:
+                logger.error(f"{name} stage failed: {error!r}")
+                self.errors.append((name, error))
+                self.failed.set()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads.append(thread)
+
+    def run(self):
+        for thread in self.threads:
+            thread.start()
+        try:
+            for thread in self.threads:
+                thread.join()
+        except BaseException:
+            # stop the stages when interrupted
+            self.failed.set()
+            raise
+        if self.errors:
+            name, error = self.errors[0]
+            raise RuntimeError(f"{name} stage failed") from error
+
+
+def parsed_files(xml_files, pool=None, workers=1):
+    """Yield (speech_type, columns) for each file in order, parsing at most
+    twice as many files at once as the pool has workers"""
+    if pool is None:
+        parsed = (read_speeches_file(*xml_file) for xml_file in xml_files)
+    else:
+        parsed = bounded_starmap(pool, read_speeches_file, xml_files, workers)
+    for (speech_type, _), columns in zip(xml_files, parsed):
+        yield speech_type, record_parse(columns)
+
+
+def record_parse(parsed):
+    columns, seconds = parsed
+    metrics.observe('parse_file_seconds', seconds)
+    metrics.increment('speeches_parsed', len(columns))
+    return columns
+
+
+def parse_batches(xml_files, pool, workers, batch_size, clean, counts):
+    """Yield (speech_type, DataFrame) batches of at least batch_size speeches
+    of one house, counting the speeches of each house"""
+    pending = {}
+
+    def batch(speech_type):
+        frames = [columns.to_dataframe() for columns in
+                  pending.pop(speech_type)]
+        speeches_df = pd.concat(frames, ignore_index=True)
+        counts[speech_type] += len(speeches_df)
+        if not clean:
+            speeches_df = speeches_df.drop('cleaned_text', axis=1)
+        return speech_type, speeches_df
+
+    for speech_type, columns in parsed_files(xml_files, pool, workers):
+        house_pending = pending.setdefault(speech_type, [])
+        house_pending.append(columns)
+        if sum(map(len, house_pending)) >= batch_size:
+            yield batch(speech_type)
+    for speech_type in list(pending):
+        yield batch(speech_type)
+
+
+def clean_batches(batches, batch_size, workers, pool, cache_path):
+    from .text import clean_frames, CleanedTextCache
+    cache = CleanedTextCache(cache_path) if cache_path is not None else None
+    # clean_frames yields frames in the order they are given
+    speech_types = deque()
+
+    def frames():
+        for speech_type, speeches_df in batches:
+            speech_types.append(speech_type)
+            yield speeches_df
+
+    for speeches_df in clean_frames(frames(), batch_size, workers, cache,
+                                    pool):
+        yield speech_types.popleft(), speeches_df
+
+
+def enrich_batches(batches, intervals):
+    for speech_type, speeches_df in batches:
+        with metrics.timer('merge_members_seconds'):
+            speeches_df = add_member_attributes(speeches_df, intervals,
+                                                MEMBER_COLUMNS)
+        yield speech_type, speeches_df
+
+
+def write_batches(batches, speech_types, output_path, output_format):
+    """Write the datasets of each house, as process-speeches does"""
+    writers = {speech_type: SpeechesWriter(output_path,
+                                           f"{speech_type}_speeches",
+                                           output_format)
+               for speech_type in speech_types}
+    complete = False
+    try:
+        for speech_type, speeches_df in batches:
+            writers[speech_type].write(speeches_df)
+        complete = True
+    finally:
+        for writer in writers.values():
+            writer.close(complete)
+
+
+def index_batches(batches, index_name, workers, chunk_size, max_chunk_bytes,
+                  max_retries, dead_letter_path, failures):
+    """Index the speeches of each batch with the bulk API, counting the
+    documents that failed in failures"""
+    from .checkpoint import DeadLetters
+    from .elastic import (global_elastic, frame_actions, bulk_index,
+                          retry_failed, bump_generations,
+                          ThroughputReporter)
+    global_elastic()
+
+    def actions():
+        row = 0
+        for _, speeches_df in batches:
+            yield from frame_actions(speeches_df, index_name, row)
+            row += len(speeches_df)
+
+    reporter = ThroughputReporter()
+    dead_letters = DeadLetters(dead_letter_path)
+    try:
+        retry = bulk_index(actions(), workers, chunk_size, max_chunk_bytes,
+                           reporter, dead_letters, max_retries=max_retries)
+        retry_failed(retry, workers, chunk_size, max_chunk_bytes, reporter,
+                     dead_letters, max_retries)
+    finally:
+        dead_letters.close()
+    if dead_letters.count:
+        logger.warning(f"{dead_letters.count} documents failed to index, see "
+                       f"{dead_letter_path}")
+    failures['count'] = dead_letters.count
+    reporter.report()
+    bump_generations(index_name)
+
+
+def ingest(paths, members_path=None, clean=False, limit=None, output_path='.',
+           output_format='csv', write=True, alias=None, parse_workers=1,
+           clean_workers=1, index_workers=4, batch_size=10000, queue_size=4,
+           clean_batch_size=1000, clean_cache_path=None, chunk_size=500,
+           max_chunk_bytes=10 * 1024 * 1024, max_retries=3,
+           dead_letter_path=None, shards=None, replicas=1, keep=1,
+           allow_failures=False):
+    """Parse, optionally clean, enrich, write and index sitting day files.
+
+    paths maps speech types to directories of sitting day files, and limit
+    is the number of files to take from each. Datasets are written as by
+    process-speeches unless write is False. If alias is given speeches are
+    indexed into a new version of its index, which it is swapped to once
+    loaded as by reindex. Returns the number of speeches of each house.
+    """
+    if not write and alias is None:
+        raise ValueError("nothing to do without writing or indexing")
+    xml_files = [(speech_type, xml_path)
+                 for speech_type, path in paths.items()
+                 for xml_path in xml_file_paths(path, limit=limit)]
+    logger.info(f"ingesting {len(xml_files)} files")
+    # loaded before starting, so a bad members file fails early
+    intervals = None
+    if members_path is not None:
+        intervals = load_member_intervals(members_path)
+
+    index_name = None
+    if alias is not None:
+        from .elastic import versioned_index_name, create_index, publish_index
+        index_name = versioned_index_name(alias)
+        create_index(index_name, shards)
+    if clean:
+        # spaCy is slow to load, so only imported when cleaning, and loaded
+        # before forking so clean workers share the model
+        from .text import get_nlp
+        get_nlp()
+
+    counts = {speech_type: 0 for speech_type in paths}
+    failures = {'count': 0}
+    # started before the stages' threads, as forking a process with threads
+    # running can copy locks they hold
+    pool = Pool(parse_workers) if parse_workers > 1 else None
+    clean_pool = Pool(clean_workers) if clean and clean_workers > 1 else None
+    pipeline = Pipeline(queue_size)
+    parsed = pipeline.queue()
+    pipeline.stage('parse', lambda _: parse_batches(
+        xml_files, pool, parse_workers, batch_size, clean, counts),
+        outputs=[parsed])
+    if clean:
+        cleaned = pipeline.queue()
+        pipeline.stage('clean', partial(
+            clean_batches, batch_size=clean_batch_size, workers=clean_workers,
+            pool=clean_pool, cache_path=clean_cache_path), parsed, [cleaned])
+        parsed = cleaned
+    if intervals is not None:
+        enriched = pipeline.queue()
+        pipeline.stage('enrich', partial(enrich_batches, intervals=intervals),
+                       parsed, [enriched])
+        parsed = enriched
+
+    # written and indexed at the same time, each from its own queue
+    sinks = []
+    if write:
+        sinks.append(('write', partial(
+            write_batches, speech_types=list(paths), output_path=output_path,
+            output_format=output_format)))
+    if index_name is not None:
+        if dead_letter_path is None:
+            dead_letter_path = config.DATA_PATH / f"{index_name}_failed.csv"
+        sinks.append(('index', partial(
+            index_batches, index_name=index_name, workers=index_workers,
+            chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+            max_retries=max_retries, dead_letter_path=dead_letter_path,
+            failures=failures)))
+    if len(sinks) == 1:
+        outputs = [parsed]
+    else:
+        outputs = [pipeline.queue() for _ in sinks]
+        pipeline.stage('split', lambda batches: batches, parsed, outputs)
+    for (name, func), source in zip(sinks, outputs):
+        pipeline.stage(name, func, source)
+
+    try:
+        pipeline.run()
+    finally:
+        for stage_pool in (pool, clean_pool):
+            if stage_pool is not None:
+                stage_pool.terminate()
+    if alias is not None:
+        publish_index(alias, index_name, failures['count'], replicas, keep,
+                      allow_failures)
+    return counts
@@ -1,16 +1,23 @@
+import time
 import logging
 from pathlib import Path
 from datetime import datetime
 from functools import partial
 from multiprocessing import Pool
 from itertools import chain
+from collections import deque
 
+import pandas as pd
 from lxml import etree
 from unidecode import unidecode
 
-from .models import Speech, Member
-from .text import clean_speeches
-from .utils import add_members_columns
+from . import metrics
+from .models import Speech, Member, Columns
+from .manifest import Manifest
+from .datasets import DatasetWriter
+from .text import clean_frames, CleanedTextCache
+from .members import MEMBER_COLUMNS, load_member_intervals, \
+    add_member_attributes
 
 
 logger = logging.getLogger(__package__)
@@ -45,55 +52,104 @@ def members_from_xml(xml_path):
     return members
 
 
-def speeches_from_xml(speech_type, xml_path, clean=False):
-    logger.info(f'processing {xml_path}')
-    tree = etree.parse(xml_path)
-    speeches = []
+def iterparse_speeches(speech_type, xml_path):
+    """Yield the field values of each speech in a sitting day file, without
+    building the full tree"""
+    id_prefix = "sen" if speech_type.startswith("sen") else "rep"
+    date_str = Path(xml_path).stem
+    day = datetime.strptime(date_str, '%Y-%m-%d').strftime('%A')
 
-    for element in tree.iter(tag=etree.Element):
-        if element.tag != 'speech':
-            continue
-        if not element.get('speakername'):
-            # ignore entries without speaker names
-            continue
-        if element.get('speakerid') == 'unknown':
-            # skip over speeches from 'The Clerk' and 'Honorable Senators' etc 
-            continue
-        
-        paragraphs = []
-        etree.strip_tags(element, 'i', 'b')
-        for i, tag in enumerate(element.iter()): 
-            if tag.text is None or tag.text == '\n':
-                continue
-            paragraphs.append(tag.text.strip())
-
-        if not paragraphs:
+    for _, element in etree.iterparse(str(xml_path), tag='speech'):
+        values = speech_values(element, id_prefix, date_str, day)
+        # free the speech and any headings etc that came before it
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if values is not None:
+            yield values
+
+
+def speech_values(element, id_prefix, date_str, day):
+    """The values of the fields of a Speech, leaving out cleaned_text"""
+    if not element.get('speakername'):
+        # ignore entries without speaker names
+        return None
+    if element.get('speakerid') == 'unknown':
+        # skip over speeches from 'The Clerk' and 'Honorable Senators' etc 
+        return None
+
+    paragraphs = []
+    etree.strip_tags(element, 'i', 'b')
+    for tag in element.iter():
+        if tag.text is None or tag.text == '\n':
             continue
+        paragraphs.append(tag.text.strip())
 
-        id_prefix = "sen" if speech_type.startswith("sen") else "rep"
-        all_text = unidecode('\n\n'.join(paragraphs))
-        date_str = Path(xml_path).stem
-        speech = Speech(
-            speech_id=f"{id_prefix}_{element.get('id').split('/')[-1]}",
-            speaker_id=int(element.get('speakerid').split('/')[-1]),
-            speaker=element.get('speakername'),
-            duration=element.get('approximate_duration'),
-            date=date_str,
-            time=element.get('time'),
-            day=datetime.strptime(date_str, '%Y-%m-%d').strftime('%A'),
-            text=all_text,
-            num_tokens=len(all_text.split())
-        )
-        speeches.append(speech)
+    if not paragraphs:
+        return None
 
-    if clean:
-        clean_speeches(speeches)
-        
-    return speeches
+    all_text = unidecode('\n\n'.join(paragraphs))
+    return (
+        f"{id_prefix}_{element.get('id').split('/')[-1]}",
+        element.get('speakername'),
+        int(element.get('speakerid').split('/')[-1]),
+        date_str,
+        element.get('time'),
+        day,
+        element.get('approximate_duration'),
+        all_text,
+        len(all_text.split()),
+    )
 
 
-def process_speeches(path, speech_type, members_path, clean, limit, files,
-                     workers):
+def speeches_from_xml(speech_type, xml_path):
+    """Yield each Speech in a sitting day file"""
+    for values in iterparse_speeches(speech_type, xml_path):
+        yield Speech(*values)
+
+
+def read_speeches_file(speech_type, xml_path):
+    """Read the speeches of a sitting day file into columns.
+
+    Columns are much cheaper to send back from worker processes than a
+    Speech per row. Workers can't record metrics, so how long parsing took
+    is sent back too.
+    """
+    logger.info(f'processing {xml_path}')
+    start = time.perf_counter()
+    columns = Columns(Speech)
+    for values in iterparse_speeches(speech_type, xml_path):
+        columns.append_values(values)
+    return columns, time.perf_counter() - start
+
+
+def bounded_starmap(pool, func, args, workers):
+    """Yield func(*item_args) for each of args in order, giving the pool at
+    most twice as many items at once as it has workers.
+
+    Unlike pool.imap, results can't pile up while whatever reads them is
+    slower than the pool, so memory stays bounded.
+    """
+    in_flight = deque()
+    for item_args in args:
+        in_flight.append(pool.apply_async(func, item_args))
+        if len(in_flight) >= 2 * workers:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+
+def record_parsed(parsed):
+    """Record the parse times sent back by read_speeches_file"""
+    for columns, seconds in parsed:
+        metrics.observe('parse_file_seconds', seconds)
+        metrics.increment('speeches_parsed', len(columns))
+        yield columns
+
+
+def xml_file_paths(path, files=None, limit=None):
+    """The sitting day files in a directory as strings, optionally only some
+    comma separated file names or the first limit files"""
     xml_paths = sorted(path for path in Path(path).glob('*.xml'))
 
     if files is not None:
@@ -103,29 +159,154 @@ def process_speeches(path, speech_type, members_path, clean, limit, files,
     if limit is not None:
         xml_paths = xml_paths[:limit]
 
-    xml_path_strs = [str(path) for path in xml_paths]
-    func = partial(speeches_from_xml, speech_type, clean=clean)
+    return [str(path) for path in xml_paths]
+
+
+def process_speeches(path, speech_type, members_path, clean, limit, files,
+                     workers, batch_size=10000, cache_path=None,
+                     clean_workers=1, clean_batch_size=1000,
+                     clean_cache_path=None):
+    """Yield DataFrames of at most batch_size speeches from a directory"""
+    xml_path_strs = xml_file_paths(path, files, limit)
 
+    intervals = None
+    if members_path is not None:
+        intervals = load_member_intervals(members_path)
+
+    if cache_path is None:
+        frames = speech_frames(xml_path_strs, speech_type, workers)
+    else:
+        manifest = Manifest(Path(cache_path) / speech_type,
+                            {'speech_type': speech_type})
+        frames = cached_speech_frames(xml_path_strs, speech_type, workers,
+                                      manifest)
+    frames = concat_frames(frames, batch_size)
+
+    if clean:
+        clean_cache = None
+        if clean_cache_path is not None:
+            clean_cache = CleanedTextCache(clean_cache_path)
+        frames = clean_frames(frames, clean_batch_size, clean_workers,
+                              clean_cache)
+    else:
+        frames = (frame.drop('cleaned_text', axis=1) for frame in frames)
+
+    for speeches_df in frames:
+        if intervals is not None:
+            with metrics.timer('merge_members_seconds'):
+                speeches_df = add_member_attributes(speeches_df, intervals,
+                                                    MEMBER_COLUMNS)
+        yield speeches_df
+
+
+def speech_frames(xml_paths, speech_type, workers):
+    """Yield a DataFrame of the speeches in each file"""
+    func = partial(read_speeches_file, speech_type)
     if workers == 1:
-        speeches = chain.from_iterable(map(func, xml_path_strs))
-        speeches_df = Speech.to_dataframe(speeches)
+        for columns in record_parsed(map(func, xml_paths)):
+            yield columns.to_dataframe()
     else:
         with Pool(workers) as pool:
-            speeches = chain.from_iterable(pool.imap(func, xml_path_strs))
-            speeches_df = Speech.to_dataframe(speeches)
+            parsed = bounded_starmap(
+                pool, read_speeches_file,
+                [(speech_type, path) for path in xml_paths], workers)
+            for columns in record_parsed(parsed):
+                yield columns.to_dataframe()
 
-    if not clean:
-        speeches_df = speeches_df.drop('cleaned_text', axis=1)
 
-    if members_path is not None:
-        speeches_df = add_members_columns(speeches_df, members_path,
-                                          ['gender', 'division', 'party'])
-        
-    return speeches_df    
+def cached_speech_frames(xml_paths, speech_type, workers, manifest):
+    """Yield a DataFrame per file, only parsing files that have changed"""
+    stale_paths = [path for path in xml_paths if not manifest.is_current(path)]
+    logger.info(f"{len(stale_paths)} of {len(xml_paths)} files need processing")
+    func = partial(read_speeches_file, speech_type)
+    try:
+        if workers == 1:
+            parsed = record_parsed(map(func, stale_paths))
+            yield from merge_cached(xml_paths, stale_paths, parsed, manifest)
+        else:
+            with Pool(workers) as pool:
+                parsed = record_parsed(bounded_starmap(
+                    pool, read_speeches_file,
+                    [(speech_type, path) for path in stale_paths], workers))
+                yield from merge_cached(xml_paths, stale_paths, parsed,
+                                        manifest)
+    finally:
+        manifest.save()
+
+
+def merge_cached(xml_paths, stale_paths, parsed, manifest):
+    stale_paths = set(stale_paths)
+    for path in xml_paths:
+        if path in stale_paths:
+            speeches_df = next(parsed).to_dataframe()
+            manifest.store(path, speeches_df)
+        else:
+            speeches_df = manifest.load(path)
+        yield speeches_df
+
+
+def concat_frames(frames, batch_size):
+    """Combine DataFrames into batches of at least batch_size rows"""
+    pending, num_rows = [], 0
+    for frame in frames:
+        pending.append(frame)
+        num_rows += len(frame)
+        if num_rows >= batch_size:
+            yield pd.concat(pending, ignore_index=True)
+            pending, num_rows = [], 0
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+
+
+class SpeechesWriter:
+    """Incrementally write the full and no text datasets of a house"""
+
+    def __init__(self, output_path, output_name, output_format='csv'):
+        Path(output_path).mkdir(parents=True, exist_ok=True)
+        full_path = Path(output_path) / f"{output_name}_full.{output_format}"
+        notext_path = (Path(output_path) /
+                       f"{output_name}_notext.{output_format}")
+        self.full_writer = DatasetWriter(full_path)
+        self.notext_writer = DatasetWriter(notext_path)
+        self.empty = True
+
+    def write(self, speeches_df):
+        self.full_writer.write(speeches_df)
+        self.notext_writer.write(speeches_df.drop(['text', 'cleaned_text'],
+                                                  errors='ignore', axis=1))
+        self.empty = False
+
+    def close(self, complete=True):
+        if complete and self.empty:
+            # no speeches were found, still leave behind empty datasets
+            empty_df = Speech.to_dataframe([])
+            self.full_writer.write(empty_df)
+            self.notext_writer.write(empty_df.drop(['text', 'cleaned_text'],
+                                                   axis=1))
+        self.full_writer.close()
+        self.notext_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(complete=exc_type is None)
+
+
+def write_speeches(speech_batches, output_path, output_name,
+                   output_format='csv'):
+    """Incrementally write the full and no text datasets from batches"""
+    with SpeechesWriter(output_path, output_name, output_format) as writer:
+        for speeches_df in speech_batches:
+            writer.write(speeches_df)
 
     
-def get_members(path):
+def get_members(path, workers=1):
     """Process one or more members XML files"""
-    members = chain.from_iterable(members_from_xml(p) for p in path)
-    return Member.to_dataframe(members)
+    if workers == 1:
+        members = chain.from_iterable(map(members_from_xml, path))
+        return Member.to_dataframe(members)
+    with Pool(workers) as pool:
+        members = chain.from_iterable(pool.imap(members_from_xml, path))
+        return Member.to_dataframe(members)
 
@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+
+from . import config, metrics
+
+
+logger = logging.getLogger(__package__)
+
+GENERATIONS_FILE = 'generations.json'
+
+
+def normalize_query(query):
+    # the english analyzer lowercases, so case doesn't change results
+    return ' '.join(query.lower().split())
+
+
+def pack_results(results):
+    """Store a list of (doc_id, tf) as a pair of compact arrays"""
+    doc_ids = np.array([doc_id for doc_id, _ in results], dtype=bytes)
+    tfs = np.array([tf for _, tf in results], dtype=np.int32)
+    return doc_ids, tfs
+
+
+def unpack_results(packed):
+    doc_ids, tfs = packed
+    return list(zip(np.char.decode(doc_ids, 'utf-8').tolist(), tfs.tolist()))
+
+
+def packed_size(packed):
+    return sum(array.nbytes for array in packed)
+
+
+def read_generations(path):
+    try:
+        with open(Path(path) / GENERATIONS_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def bump_generation(index_name, path=config.QUERY_CACHE_PATH):
+    """Invalidate cached results for an index after it has been modified"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    generations = read_generations(path)
+    generations[index_name] = generations.get(index_name, 0) + 1
+    tmp_path = path / f"{GENERATIONS_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(generations, f)
+    tmp_path.replace(path / GENERATIONS_FILE)
+
+
+class QueryCache:
+    """Two tier cache of query results, in memory and on disk.
+
+    Both tiers evict the least recently used results once they grow past
+    their size limit in bytes. Results are keyed on the index generation,
+    which is bumped whenever the index is modified, so stale results are
+    never returned and are eventually evicted.
+    """
+
+    def __init__(self, path=config.QUERY_CACHE_PATH,
+                 memory_bytes=config.QUERY_CACHE_MEMORY_BYTES,
+                 disk_bytes=config.QUERY_CACHE_DISK_BYTES):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+
+    def key(self, backend_name, index_name, query, query_type, size,
+            filters=None):
+        generation = read_generations(self.path).get(index_name, 0)
+        key = [backend_name, index_name, normalize_query(query), query_type,
+               size, generation]
+        if filters:
+            key.append(filters)
+        key = json.dumps(key, sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def disk_path(self, key):
+        return self.path / f"{key}.npz"
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return unpack_results(self.memory[key])
+
+        path = self.disk_path(key)
+        try:
+            with np.load(path) as npz:
+                packed = npz['doc_ids'], npz['tfs']
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # mark as recently used for disk eviction
+        os.utime(path)
+        self.remember(key, packed)
+        return unpack_results(packed)
+
+    def put(self, key, results):
+        packed = pack_results(results)
+        self.remember(key, packed)
+        tmp_path = self.path / f"{key}.tmp.npz"
+        np.savez(tmp_path, doc_ids=packed[0], tfs=packed[1])
+        tmp_path.replace(self.disk_path(key))
+        self.evict_disk()
+
+    def remember(self, key, packed):
+        if key in self.memory:
+            self.memory_size -= packed_size(self.memory.pop(key))
+        self.memory[key] = packed
+        self.memory_size += packed_size(packed)
+        while self.memory_size > self.memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= packed_size(evicted)
+
+    def evict_disk(self):
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry)
+                   for entry in self.path.glob('*.npz')
+                   if not entry.name.endswith('.tmp.npz')]
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.disk_bytes:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info(f"evicted cached query results {entry.name}")
+
+
+class CachedBackend:
+    """Wraps a backend, only sending it queries that aren't cached"""
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+        self.name = type(backend).__name__
+        self.index_name = backend.index_name
+
+    def key(self, query, query_type, size, filters=None):
+        return self.cache.key(self.name, self.index_name, query, query_type,
+                              size, filters)
+
+    def query_term_frequencies(self, queries, size=None, filters=None):
+        keys = [self.key(query, query_type, size, filters)
+                for query, query_type in queries]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        metrics.increment('query_cache_hits', len(queries) - len(missing))
+        metrics.increment('query_cache_misses', len(missing))
+        if missing:
+            found = self.backend.query_term_frequencies(
+                [queries[i] for i in missing], size, filters)
+            for i, result in zip(missing, found):
+                self.cache.put(keys[i], result)
+                results[i] = result
+        return results
+
+    def iter_term_frequencies(self, query, query_type, size=None,
+                              filters=None):
+        key = self.key(query, query_type, size, filters)
+        results = self.cache.get(key)
+        if results is not None:
+            metrics.increment('query_cache_hits')
+            return iter(results)
+        metrics.increment('query_cache_misses')
+        # called here rather than in a generator, so a bad query fails now
+        hits = self.backend.iter_term_frequencies(query, query_type, size,
+                                                  filters)
+        return self.cache_hits(key, hits)
+
+    def cache_hits(self, key, hits):
+        """Yield hits as they arrive, caching them once they have all been
+        seen, so a partly read result is never cached"""
+        seen = []
+        for hit in hits:
+            seen.append(hit)
+            yield hit
+        self.cache.put(key, seen)
+
+    def hit_ids(self, query, query_type, offset=0, size=10, filters=None):
+        # a page is a single request, and cut from cached hits it could be
+        # in a different order to the pages before it
+        return self.backend.hit_ids(query, query_type, offset, size, filters)
+
+    def aggregate(self, *args, **kwargs):
+        # aggregations are small and quick to run, so aren't cached
+        return self.backend.aggregate(*args, **kwargs)
+
+    def highlight(self, identifiers, query, query_type):
+        # windows are cached by kwic.SnippetCache instead
+        return self.backend.highlight(identifiers, query, query_type)
+
+    def get(self, identifier):
+        return self.backend.get(identifier)
+
+    def is_available(self):
+        return self.backend.is_available()
@@ -0,0 +1,145 @@
+import os
+import json
+import uuid
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .datasets import read_dataset
+
+
+logger = logging.getLogger(__package__)
+
+TABLE_FILE = '{name}.arrow'
+IDS_FILE = '{name}_ids.npy'
+ORDER_FILE = '{name}_order.npy'
+META_FILE = '{name}.json'
+
+
+def source_stamp(path):
+    stat = Path(path).stat()
+    return {'source': str(Path(path).resolve()), 'mtime': stat.st_mtime,
+            'size': stat.st_size}
+
+
+def is_current(store_path, name, source_path):
+    try:
+        with open(Path(store_path) / META_FILE.format(name=name)) as f:
+            return json.load(f) == source_stamp(source_path)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def replace_file(path, write):
+    """Write a file next to its destination, then move it into place.
+
+    The file is written under a name unique to this call, so processes
+    writing the same file at once can't move each other's partial files
+    into place.
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}."
+                              f"{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        write(tmp_path)
+        tmp_path.replace(path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def save_array(path, array):
+    # np.save adds .npy to the names of paths that don't end with it
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+def build_store(source_path, store_path, name, id_col='speech_id'):
+    """Convert a dataset to a memory-mappable Arrow file and ID lookup.
+
+    Speech IDs are stored sorted, along with the row of each, so rows can
+    be found by bisection without building a hash table in every process.
+    Each file is moved into place once written and the metadata is written
+    last, so processes building the same store at once don't see partial
+    files.
+    """
+    store_path = Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(read_dataset(source_path),
+                                 preserve_index=False)
+
+    def write_table(path):
+        with pa.OSFile(str(path), 'wb') as sink, \
+             pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    ids = np.array(table.column(id_col).to_pylist(), dtype=bytes)
+    order = np.argsort(ids)
+    replace_file(store_path / TABLE_FILE.format(name=name), write_table)
+    for file_name, array in [(IDS_FILE, ids[order]), (ORDER_FILE, order)]:
+        replace_file(store_path / file_name.format(name=name),
+                     lambda path: save_array(path, array))
+    replace_file(store_path / META_FILE.format(name=name),
+                 lambda path: path.write_text(
+                     json.dumps(source_stamp(source_path))))
+    logger.info(f"built {name} store of {table.num_rows} rows")
+
+
+def load_store(source_path, store_path, name):
+    """Open the store of a dataset, building it first if it is out of date"""
+    if not is_current(store_path, name, source_path):
+        build_store(source_path, store_path, name)
+    return DatasetStore(store_path, name)
+
+
+class RowIndex:
+    """Looks up the rows of speech IDs, like a pandas Index's get_indexer"""
+
+    def __init__(self, sorted_ids, order):
+        self.sorted_ids = sorted_ids
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_indexer(self, doc_ids):
+        keys = np.array(doc_ids, dtype=bytes)
+        if not len(self.order) or not len(keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        i = np.searchsorted(self.sorted_ids, keys)
+        i[i == len(self.order)] = 0
+        found = self.sorted_ids[i] == keys
+        return np.where(found, self.order[i], -1)
+
+
+class DatasetStore:
+    """A read-only dataset memory-mapped from a store built by build_store.
+
+    The Arrow file and the ID arrays are mapped rather than read, so every
+    process serving the app shares the same pages of the OS page cache.
+    Rows are only converted to pandas a chunk at a time as they are needed.
+    """
+
+    def __init__(self, store_path, name):
+        store_path = Path(store_path)
+        source = pa.memory_map(str(store_path / TABLE_FILE.format(name=name)))
+        self.table = pa.ipc.open_file(source).read_all()
+        self.rows = RowIndex(
+            np.load(store_path / IDS_FILE.format(name=name), mmap_mode='r'),
+            np.load(store_path / ORDER_FILE.format(name=name), mmap_mode='r'),
+        )
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def iter_frames(self, columns=None, chunk_size=10000):
+        """Yield DataFrames of the dataset with extra columns of row values"""
+        columns = columns or {}
+        for start in range(0, len(self), chunk_size):
+            frame = self.table.slice(start, chunk_size).to_pandas()
+            frame.index = pd.RangeIndex(start, start + len(frame))
+            for column_name, values in columns.items():
+                frame[column_name] = values[start:start + len(frame)]
+            yield frame
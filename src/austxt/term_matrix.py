@@ -0,0 +1,189 @@
+"""Counts of many terms in every speech, from a single scan of a dataset.
+
+Terms are either stems from the approximation of Elasticsearch's english
+analyzer in analysis.py, or the lemmas produced by text.clean_texts. The
+vocabulary is analyzed the same way as the speeches, so a vocabulary of
+words matches every form of them.
+"""
+import logging
+from pathlib import Path
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .analysis import analyze
+from .datasets import iter_dataset, dataset_columns
+from .utils import batched
+
+
+logger = logging.getLogger(__package__)
+
+# the vocabulary of each worker process, see set_vocabulary
+VOCABULARY = None
+
+
+def english_terms(texts):
+    for text in texts:
+        yield [term for term, _ in analyze(text)]
+
+
+def lemma_terms(texts, cleaned=False):
+    if not cleaned:
+        from .text import clean_texts
+        texts = clean_texts(texts)
+    for text in texts:
+        yield text.lower().split()
+
+
+def text_column(path, analyzer):
+    # datasets processed with --clean already have lemmas
+    if analyzer == 'lemma' and 'cleaned_text' in dataset_columns(path):
+        return 'cleaned_text'
+    return 'text'
+
+
+def chunk_terms(chunk, analyzer, column):
+    texts = chunk[column].fillna('').astype(str).tolist()
+    if analyzer == 'english':
+        return english_terms(texts)
+    return lemma_terms(texts, cleaned=column == 'cleaned_text')
+
+
+def total_counts(task):
+    """Count every term in a chunk of speeches"""
+    chunk, analyzer, column = task
+    counts = Counter()
+    for terms in chunk_terms(chunk, analyzer, column):
+        counts.update(terms)
+    return counts
+
+
+def set_vocabulary(vocabulary):
+    global VOCABULARY
+    VOCABULARY = vocabulary
+
+
+def count_chunk(task):
+    """Count the vocabulary terms in a chunk of speeches.
+
+    Returns the row of each count within the chunk, the column of its term
+    and the count, as arrays ready for a sparse matrix.
+    """
+    chunk, analyzer, column = task
+    rows, cols, counts = [], [], []
+    for row, terms in enumerate(chunk_terms(chunk, analyzer, column)):
+        doc_counts = Counter(VOCABULARY[term] for term in terms
+                             if term in VOCABULARY)
+        rows.extend([row] * len(doc_counts))
+        cols.extend(doc_counts.keys())
+        counts.extend(doc_counts.values())
+    return (chunk['speech_id'].astype(str).tolist(),
+            np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int32),
+            np.array(counts, dtype=np.int32))
+
+
+def map_chunks(func, path, analyzer, workers, chunk_size, vocabulary=None):
+    column = text_column(path, analyzer)
+    chunks = iter_dataset(path, columns=['speech_id', column],
+                          chunk_size=chunk_size)
+    tasks = ((chunk, analyzer, column) for chunk in chunks)
+    if workers == 1:
+        set_vocabulary(vocabulary)
+        yield from map(func, tasks)
+        return
+    with Pool(workers, set_vocabulary, (vocabulary,)) as pool:
+        # only read as many chunks as there are workers to analyze them
+        for window in batched(tasks, workers):
+            yield from pool.map(func, window)
+
+
+def analyze_vocabulary(words, analyzer):
+    """Map the analyzed term of each word to the first word it came from"""
+    words = [word.strip() for word in words if word.strip()]
+    if analyzer == 'english':
+        analyzed = english_terms(words)
+    else:
+        analyzed = lemma_terms(words)
+    terms = {}
+    for word, word_terms in zip(words, analyzed):
+        if len(word_terms) != 1:
+            logger.warning(f"skipping {word!r}, which is not a single term "
+                           f"({word_terms})")
+            continue
+        if word_terms[0] in terms:
+            logger.warning(f"counting {word!r} as {terms[word_terms[0]]!r}, "
+                           f"they are both {word_terms[0]!r}")
+            continue
+        terms[word_terms[0]] = word
+    return terms
+
+
+def top_terms(path, analyzer, n, workers=1, chunk_size=5000):
+    """The n most frequent terms in a dataset, labelled with themselves"""
+    counts = Counter()
+    for chunk_counts in map_chunks(total_counts, path, analyzer, workers,
+                                   chunk_size):
+        counts.update(chunk_counts)
+    return {term: term for term, _ in counts.most_common(n)}
+
+
+def term_matrix(path, terms, output_path, analyzer='english', workers=1,
+                chunk_size=5000):
+    """Write the counts of terms in every speech of a dataset.
+
+    terms maps each analyzed term to the label it is written with. Output
+    ending in .parquet is written a chunk at a time in long format, with a
+    row for each speech_id and term found in it. Otherwise it's a scipy
+    sparse matrix with a row per speech, saved to an .npz file next to text
+    files of the speech IDs and terms of its rows and columns.
+    """
+    output_path = Path(output_path)
+    vocabulary = {term: i for i, term in enumerate(terms)}
+    labels = list(terms.values())
+    results = map_chunks(count_chunk, path, analyzer, workers, chunk_size,
+                         vocabulary)
+    if output_path.suffix == '.parquet':
+        write_long(results, labels, output_path)
+    else:
+        write_sparse(results, labels, output_path)
+
+
+def write_long(results, terms, output_path):
+    schema = pa.schema([('speech_id', pa.string()), ('term', pa.string()),
+                        ('count', pa.int32())])
+    terms = pa.array(terms)
+    with pq.ParquetWriter(str(output_path), schema) as writer:
+        for speech_ids, rows, cols, counts in results:
+            table = pa.table({
+                'speech_id': pa.array(speech_ids).take(pa.array(rows)),
+                'term': terms.take(pa.array(cols)),
+                'count': pa.array(counts),
+            }, schema=schema)
+            writer.write_table(table)
+
+
+def write_sparse(results, terms, output_path):
+    from scipy import sparse
+    all_ids, all_rows, all_cols, all_counts = [], [], [], []
+    for speech_ids, rows, cols, counts in results:
+        all_rows.append(rows + len(all_ids))
+        all_ids.extend(speech_ids)
+        all_cols.append(cols)
+        all_counts.append(counts)
+        logger.info(f"counted terms in {len(all_ids)} speeches")
+
+    def concat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.array([], dtype)
+
+    matrix = sparse.csr_matrix(
+        (concat(all_counts, np.int32),
+         (concat(all_rows, np.int64), concat(all_cols, np.int32))),
+        shape=(len(all_ids), len(terms)),
+    )
+    sparse.save_npz(output_path.with_suffix('.npz'), matrix)
+    stem = output_path.with_suffix('')
+    Path(f"{stem}_speech_ids.txt").write_text('\n'.join(all_ids) + '\n')
+    Path(f"{stem}_terms.txt").write_text('\n'.join(terms) + '\n')
@@ -1,15 +1,172 @@
-import spacy
+import time
+import sqlite3
+import hashlib
+from itertools import islice
+from collections import deque
 
+from . import metrics
 
-nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner'])
 
+MODEL = 'en_core_web_sm'
+NLP = None
 
 
-def clean_speeches(speeches):
-    speech_tuples = ((speech.text, speech) for speech in speeches) 
-    pipe = nlp.pipe(speech_tuples, as_tuples=True, n_threads=1,
-                    disable=['parser', 'ner'])
-    for doc, speech in pipe:
-        speech.cleaned_text = ' '.join(token.lemma_ for token in doc
-                                if not (token.is_stop or token.is_punct or
-                                        token.pos_ == 'PRON' or token.is_space))
+def get_nlp():
+    # spaCy and its model are slow to load, so only do it when cleaning
+    global NLP
+    if NLP is None:
+        import spacy
+        NLP = spacy.load(MODEL, disable=['parser', 'ner'])
+    return NLP
+
+
+def clean_doc(doc):
+    return ' '.join(token.lemma_ for token in doc
+                    if not (token.is_stop or token.is_punct or
+                            token.pos_ == 'PRON' or token.is_space))
+
+
+def clean_texts(texts, batch_size=1000, workers=1):
+    """Lazily yield the cleaned version of each text"""
+    docs = get_nlp().pipe(texts, batch_size=batch_size, n_process=workers)
+    return timed_batches(map(clean_doc, docs), batch_size)
+
+
+def clean_batch(texts):
+    """Clean a list of texts in one process, for cleaning in a Pool"""
+    return [clean_doc(doc) for doc in get_nlp().pipe(texts,
+                                                    batch_size=len(texts))]
+
+
+def pooled_clean_texts(texts, pool, workers, batch_size=1000):
+    """Lazily yield the cleaned version of each text, cleaning batches in an
+    already started pool, with at most twice as many batches in flight as it
+    has workers.
+
+    The pool's processes should be forked after spaCy is loaded by get_nlp,
+    so that they share the model rather than each loading it.
+    """
+    def cleaned_texts():
+        texts_iter = iter(texts)
+        in_flight = deque()
+        while True:
+            batch = list(islice(texts_iter, batch_size))
+            if batch:
+                in_flight.append(pool.apply_async(clean_batch, (batch,)))
+            if in_flight and (len(in_flight) >= 2 * workers or not batch):
+                yield from in_flight.popleft().get()
+            elif not batch:
+                return
+
+    return timed_batches(cleaned_texts(), batch_size)
+
+
+def timed_batches(cleaned_texts, batch_size):
+    """Yield cleaned texts, observing the time spent cleaning each batch"""
+    iterator = iter(cleaned_texts)
+    elapsed, count = 0.0, 0
+    while True:
+        start = time.perf_counter()
+        try:
+            cleaned_text = next(iterator)
+        except StopIteration:
+            break
+        elapsed += time.perf_counter() - start
+        count += 1
+        yield cleaned_text
+        if count == batch_size:
+            metrics.observe('clean_batch_seconds', elapsed)
+            metrics.increment('texts_cleaned', count)
+            elapsed, count = 0.0, 0
+    if count:
+        metrics.observe('clean_batch_seconds', elapsed)
+        metrics.increment('texts_cleaned', count)
+
+
+def text_hash(text):
+    return hashlib.sha1(f"{MODEL}\0{text}".encode('utf-8')).hexdigest()
+
+
+class CleanedTextCache:
+    """SQLite store of cleaned text keyed on a hash of the original text"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cleaned "
+            "(hash TEXT PRIMARY KEY, cleaned_text TEXT)"
+        )
+
+    def get_many(self, hashes, chunk_size=500):
+        found = {}
+        hashes = list(set(hashes))
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            params = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT hash, cleaned_text FROM cleaned WHERE hash IN ({params})",
+                chunk
+            )
+            found.update(rows)
+        return found
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cleaned VALUES (?, ?)", items
+            )
+
+
+class PendingFrame:
+
+    def __init__(self, frame, cache):
+        self.frame = frame
+        self.texts = frame['text'].fillna('').tolist()
+        self.hashes = [text_hash(text) for text in self.texts]
+        cached = cache.get_many(self.hashes) if cache is not None else {}
+        metrics.increment('clean_cache_hits', len(cached))
+        self.cleaned = [cached.get(h) for h in self.hashes]
+        self.missing = deque(i for i, cleaned in enumerate(self.cleaned)
+                             if cleaned is None)
+        self.new_items = []
+
+    def add(self, cleaned_text):
+        i = self.missing.popleft()
+        self.cleaned[i] = cleaned_text
+        self.new_items.append((self.hashes[i], cleaned_text))
+
+
+def clean_frames(frames, batch_size=1000, workers=1, cache=None, pool=None):
+    """Add a cleaned_text column to each DataFrame of speeches.
+
+    The texts from all frames are streamed through a single spaCy pipe, so
+    batches span frames and worker processes are only started once. Texts
+    found in the cache are not sent to spaCy at all. If a pool of worker
+    processes is given they clean the texts instead, see pooled_clean_texts.
+    """
+    pending = deque()
+
+    def uncleaned_texts():
+        for frame in frames:
+            pending_frame = PendingFrame(frame, cache)
+            pending.append(pending_frame)
+            for i in list(pending_frame.missing):
+                yield pending_frame.texts[i]
+
+    def finished_frames():
+        while pending and not pending[0].missing:
+            pending_frame = pending.popleft()
+            if cache is not None and pending_frame.new_items:
+                cache.put_many(pending_frame.new_items)
+            yield pending_frame.frame.assign(
+                cleaned_text=pending_frame.cleaned)
+
+    if pool is not None:
+        cleaned_texts = pooled_clean_texts(uncleaned_texts(), pool, workers,
+                                           batch_size)
+    else:
+        cleaned_texts = clean_texts(uncleaned_texts(), batch_size, workers)
+    for cleaned_text in cleaned_texts:
+        yield from finished_frames()
+        pending[0].add(cleaned_text)
+    yield from finished_frames()
@@ -1,64 +1,203 @@
-import re
+from itertools import islice
+from functools import partial
+from collections import defaultdict
+
+import numpy as np
 import pandas as pd
 
-from .elastic import do_query
+from . import config, metrics
+from .elastic import (TEXT_FIELD, do_multi_query, do_analyze, do_term_vectors,
+                      iter_query_hits, hits_total, run_concurrently)
 
 
 def query_to_column_name(query, query_type):
     return "_".join(query.split()+[query_type])
 
 
-# other option for multi-term AND/OR queries
-
-
-def process_query_result(result):
-    results = []
-    for hit in result['hits']['hits']:
-        doc_id = hit['_id']
-        tf_string = hit['_explanation']['details'][0]['description']
-        try:
-            tf = int(re.search(r'termFreq=(\d+)\.', tf_string)[1])
-        except TypeError:
-            # query was a phrase query
-            try:
-                tf = int(re.search(r'phraseFreq=(\d+)\.', tf_string)[1])
-            except TypeError:
-                # query was a multi term AND or OR query
-                term_strings = [term['details'][0]['description']
-                                for term in hit['_explanation']['details']]
-                tf = min([int(re.search(r'termFreq=(\d+)\.', term)[1])
-                      for term in term_strings])
-
-                tf = 1
-        results.append((doc_id, tf))
+def analyze_query(query, index_name):
+    """Analyzed terms of a query with their positions relative to the first"""
+    tokens = do_analyze(query, index_name)
+    start = tokens[0]['position'] if tokens else 0
+    return [(token['token'], token['position'] - start) for token in tokens]
+
+
+def phrase_frequency(query_terms, doc_terms):
+    # a phrase starts at each position where every term is found at its
+    # offset from that position
+    starts = []
+    for term, offset in query_terms:
+        if term not in doc_terms:
+            return 0
+        starts.append({token['position'] - offset
+                       for token in doc_terms[term]['tokens']})
+    return len(set.intersection(*starts))
+
+
+def term_frequency(query_terms, query_type, doc_terms):
+    """The frequency of a query in a document given the document's terms.
+
+    For exact queries this is the number of times the phrase occurs. For
+    multi-term AND and OR queries it is the frequency of the least frequent
+    query term found in the document.
+    """
+    if query_type == 'exact' and len(query_terms) > 1:
+        return phrase_frequency(query_terms, doc_terms)
+    freqs = [doc_terms[term]['term_freq'] for term, _ in query_terms
+             if term in doc_terms]
+    return min(freqs, default=0)
+
+
+def fetch_term_vectors(doc_queries, queries, index_name):
+    positions = any(queries[i][1] == 'exact'
+                    for doc_query_ids in doc_queries.values()
+                    for i in doc_query_ids)
+    return do_term_vectors(doc_queries, index_name, positions)
+
+
+def add_term_frequencies(results, batches, queries, query_terms, index_name,
+                         concurrency=config.ELASTIC_CONCURRENCY):
+    """Append (doc_id, tf) to results for each query matching each document.
+
+    Batches are dicts of doc_id to the queries it matched, and the term
+    vectors of each batch are fetched concurrently.
+    """
+    responses = run_concurrently(
+        [partial(fetch_term_vectors, doc_queries, queries, index_name)
+         for doc_queries in batches], concurrency)
+    for doc_queries, docs in zip(batches, responses):
+        for doc in docs:
+            vectors = doc.get('term_vectors', {})
+            doc_terms = vectors.get(TEXT_FIELD, {}).get('terms', {})
+            for i in doc_queries[doc['_id']]:
+                tf = term_frequency(query_terms[i], queries[i][1], doc_terms)
+                results[i].append((doc['_id'], tf))
+
+
+def iter_term_frequencies(query, query_type, index_name, size=None,
+                          batch_size=200, page_size=config.ELASTIC_PAGE_SIZE,
+                          concurrency=config.ELASTIC_CONCURRENCY,
+                          filters=None):
+    """Lazily yield (doc_id, tf) for each hit of a query"""
+    query_terms = [analyze_query(query, index_name)]
+    hits = islice(iter_query_hits(query, query_type, index_name, page_size,
+                                  filters), size)
+    # hold enough batches of hits to fetch their term vectors concurrently
+    for window in batched(batched(hits, batch_size), concurrency):
+        results = [[]]
+        batches = [{hit['_id']: [0] for hit in hit_batch}
+                   for hit_batch in window]
+        add_term_frequencies(results, batches, [(query, query_type)],
+                             query_terms, index_name, concurrency)
+        yield from results[0]
+
+
+def query_term_frequencies(queries, index_name, size=None, batch_size=200,
+                           page_size=config.ELASTIC_PAGE_SIZE,
+                           concurrency=config.ELASTIC_CONCURRENCY,
+                           filters=None):
+    """Get (doc_id, tf) results for a list of (query, query_type) pairs.
+
+    All queries are run in one _msearch returning the first page of hits,
+    then term vectors for every matched document are fetched once in batches
+    and used to count each query's terms, rather than parsing them out of an
+    explanation for every hit. Queries with more than a page of hits are
+    streamed with the scroll API instead, so there is no cap on the number of
+    results. A size of None returns all hits. Up to concurrency requests are
+    made at once. Only speeches matching filters are searched, see
+    elastic.filter_clauses.
+    """
+    first_size = page_size if size is None else min(size, page_size)
+    responses = do_multi_query(queries, index_name, first_size, filters)
+    query_terms = run_concurrently(
+        [partial(analyze_query, query, index_name) for query, _ in queries],
+        concurrency)
+
+    # the queries matching each document, for queries with one page of hits
+    doc_queries = defaultdict(list)
+    scrolled = []
+    for i, response in enumerate(responses):
+        hits = response['hits']['hits']
+        wanted = hits_total(response)
+        if size is not None:
+            wanted = min(wanted, size)
+        if len(hits) < wanted:
+            scrolled.append(i)
+            continue
+        for hit in hits:
+            doc_queries[hit['_id']].append(i)
+
+    results = [[] for _ in queries]
+    batches = ({doc_id: doc_queries[doc_id] for doc_id in doc_ids}
+               for doc_ids in batched(doc_queries, batch_size))
+    for window in batched(batches, concurrency):
+        add_term_frequencies(results, window, queries, query_terms,
+                             index_name, concurrency)
+
+    # each scroll makes its own requests one after another, so split the
+    # concurrency between them
+    scroll_concurrency = max(1, concurrency // max(len(scrolled), 1))
+
+    def scroll(i):
+        query, query_type = queries[i]
+        return list(iter_term_frequencies(query, query_type, index_name, size,
+                                          batch_size, page_size,
+                                          scroll_concurrency, filters))
+
+    scrolled_results = run_concurrently(
+        [partial(scroll, i) for i in scrolled], concurrency)
+    for i, scrolled_result in zip(scrolled, scrolled_results):
+        results[i] = scrolled_result
+    for result in results:
+        metrics.observe('query_hits', len(result), backend='elastic')
     return results
 
 
-def add_members_columns(speeches_df, members_path, columns):
-    members_df = pd.read_csv(members_path, usecols=['member_id']+columns)
-    new_df = speeches_df.merge(
-        members_df, left_on='speaker_id',
-        right_on='member_id', how='left').drop('member_id', axis=1
-    )
-    return new_df 
-
-
-def add_results_to_dataframe(parsed_results, dataframe, column_name):
-    id_col = "speech_id"
-    extra_col_df = pd.DataFrame.from_records(
-        parsed_results,
-        columns=[id_col, column_name]
-    )
-    new_df = dataframe.merge(extra_col_df, on=id_col, how="left")
-    # replace missing values from query results with zeroes, and then convert
-    # back to integerss as the missing values from the merge caused casting to
-    # floats
-    return new_df.fillna(0).astype({column_name:int})
-
-
-def make_dataset(dataset_df, query, index_name, size, query_type):
-    results = do_query(query, index_name, size, query_type)
-    parsed_results = process_query_result(results)
-    column_name = query_to_column_name(query, query_type)
-    return add_results_to_dataframe(parsed_results, dataset_df, column_name)
+def batched(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def build_row_index(dataframe, id_col="speech_id"):
+    """Index for looking up the row positions of speech IDs in a dataset"""
+    return pd.Index(dataframe[id_col])
+
+
+def result_column(parsed_results, row_index):
+    """Scatter the tf of each (doc_id, tf) into an array aligned with rows"""
+    column = np.zeros(len(row_index), dtype=np.int32)
+    if parsed_results:
+        doc_ids, tfs = zip(*parsed_results)
+        positions = row_index.get_indexer(doc_ids)
+        # results for speeches not in this dataset are dropped
+        found = positions >= 0
+        column[positions[found]] = np.asarray(tfs, dtype=np.int32)[found]
+    return column
+
+
+def add_results_columns(dataframe, results, row_index=None):
+    """Add a column for each of a dict of column name to query results.
+
+    Columns are built directly from the row positions of matched speeches
+    and attached all at once without copying the existing columns.
+    """
+    with metrics.timer('add_results_seconds'):
+        if row_index is None:
+            row_index = build_row_index(dataframe)
+        columns = {column_name: result_column(parsed_results, row_index)
+                   for column_name, parsed_results in results.items()}
+        columns_df = pd.DataFrame(columns, index=dataframe.index)
+        return pd.concat([dataframe, columns_df], axis=1, copy=False)
+
+
+def make_dataset(dataset_df, queries, backend, size=None, filters=None):
+    """Add a column to a dataset for each of a list of (query, query_type)"""
+    results = backend.query_term_frequencies(queries, size, filters)
+    column_names = [query_to_column_name(query, query_type)
+                    for query, query_type in queries]
+    return add_results_columns(dataset_df, dict(zip(column_names, results)))
 
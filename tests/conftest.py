@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# austxt from the source tree, and the benchmarks package's Elasticsearch
+# stand-in
+sys.path[:0] = [str(ROOT / 'src'), str(ROOT)]
+# config is read on import, so keep caches etc. out of the working directory
+os.environ['AUSTXT_DATA_PATH'] = tempfile.mkdtemp(prefix='austxt_tests_')
+os.environ.setdefault('AUSTXT_QUERY_CACHE', '0')
+
+
+@pytest.fixture
+def fake_elastic():
+    """The Elasticsearch stand-in, used by austxt.elastic"""
+    from elasticsearch import Elasticsearch
+    from benchmarks.fake_elastic import serve_in_thread
+    from austxt import elastic
+    server, url = serve_in_thread()
+    previous, elastic.ELASTIC = elastic.ELASTIC, Elasticsearch(url)
+    yield server.elastic
+    elastic.ELASTIC = previous
+    server.shutdown()
+
+
+@pytest.fixture
+def speeches_path(tmp_path):
+    """A small speeches dataset"""
+    import pandas as pd
+    texts = ["The carbon tax is a tax on carbon.",
+             "Climate change and the drought hurt farmers.",
+             "We debated the budget and tax reform.",
+             "Health and education funding was increased.",
+             "Refugees and asylum seekers were discussed.",
+             "The minister answered questions on water."]
+    path = tmp_path / 'speeches.csv'
+    pd.DataFrame({
+        'speech_id': [f'sen_2010-02-0{i % 3 + 1}.1.{i}' for i in range(30)],
+        'speaker_id': [100 + i % 4 for i in range(30)],
+        'date': [f'2010-02-0{i % 3 + 1}' for i in range(30)],
+        'text': [texts[i % len(texts)] + f" Speech {i}." for i in range(30)],
+    }).to_csv(path, index=False)
+    return path
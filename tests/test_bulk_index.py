@@ -0,0 +1,41 @@
+from austxt import elastic
+from austxt.elastic import (Backoff, ThroughputReporter, bulk_index,
+                            speech_actions)
+from austxt.checkpoint import DeadLetters
+
+
+def test_backoff_doubles_once_per_pause(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(elastic.time, 'monotonic', lambda: now[0])
+    backoff = Backoff(max_delay=4)
+    backoff.rejected()
+    # the rest of a rejected chunk arrives during the pause
+    backoff.rejected()
+    assert backoff.delay == 1
+    for delay in (2, 4, 4):
+        now[0] = backoff.resume_at
+        backoff.rejected()
+        assert backoff.delay == delay
+    now[0] = backoff.resume_at
+    backoff.accepted()
+    assert backoff.delay == 0
+
+
+def test_rejected_documents_are_retried_as_they_pile_up(
+        monkeypatch, tmp_path, speeches_path, fake_elastic):
+    sleeps = []
+    monkeypatch.setattr(elastic.time, 'sleep', sleeps.append)
+    fake_elastic.rejections = 2
+    dead_letters = DeadLetters(tmp_path / 'failed.csv')
+    actions = speech_actions(speeches_path, 'speeches', None, 1000)
+    retry = bulk_index(actions, 1, 10, 10 * 1024 * 1024,
+                       ThroughputReporter(), dead_letters,
+                       max_pending_retries=15)
+    dead_letters.close()
+    # of the two rejected chunks, 15 were retried once that many were held
+    # and the rest are left for after the pass
+    assert [row for row, _ in retry] == list(range(15, 20))
+    assert dead_letters.count == 0
+    assert len(fake_elastic.indices['speeches'].docs) == 25
+    # sending paused after the rejections, then for the retry attempt
+    assert len(sleeps) >= 2
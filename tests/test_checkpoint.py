@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from austxt import elastic
+from austxt.elastic import Progress, index_speeches
+from austxt.checkpoint import Checkpoint
+
+
+def test_progress_is_the_first_row_not_done():
+    progress = Progress(5)
+    progress.read_until = 20
+    assert progress.first_undone({}, []) == 20
+    assert progress.first_undone({'a': (12, {})}, []) == 12
+    assert progress.first_undone({'a': (12, {})}, [(8, {})]) == 8
+
+
+def test_checkpoint_saves_every_so_many_rows(tmp_path, speeches_path):
+    path = tmp_path / 'checkpoint.json'
+    checkpoint = Checkpoint(path, speeches_path, 'speeches', every=10)
+    checkpoint.advance(5)
+    assert not path.exists()
+    checkpoint.advance(12)
+    assert json.loads(path.read_text())['rows'] == 12
+    checkpoint.finish(30)
+
+    resumed = Checkpoint(path, speeches_path, 'speeches')
+    resumed.load()
+    assert resumed.rows == 30 and resumed.complete
+
+
+def test_checkpoint_is_only_for_its_index(tmp_path, speeches_path):
+    path = tmp_path / 'checkpoint.json'
+    Checkpoint(path, speeches_path, 'speeches').finish(30)
+    with pytest.raises(RuntimeError):
+        Checkpoint(path, speeches_path, 'other').load()
+
+
+def test_index_speeches_checkpoints_every_row(tmp_path, speeches_path,
+                                              fake_elastic):
+    path = tmp_path / 'checkpoint.json'
+    count, failed = index_speeches(speeches_path, 'speeches', None, 2,
+                                   chunk_size=7, checkpoint_path=path,
+                                   dead_letter_path=tmp_path / 'failed.csv')
+    assert (count, failed) == (30, 0)
+    assert json.loads(path.read_text())['rows'] == 30
+    assert len(fake_elastic.indices['speeches'].docs) == 30
+
+
+def test_unchanged_rows_count_as_done(tmp_path, speeches_path, fake_elastic):
+    index_speeches(speeches_path, 'speeches', None, 2, chunk_size=7,
+                   checkpoint_path=tmp_path / 'first.json',
+                   dead_letter_path=tmp_path / 'failed.csv')
+    path = tmp_path / 'checkpoint.json'
+    count, _ = index_speeches(speeches_path, 'speeches', None, 2,
+                              chunk_size=7, checkpoint_path=path,
+                              dead_letter_path=tmp_path / 'failed.csv',
+                              skip_unchanged_docs=True)
+    assert count == 0
+    state = json.loads(path.read_text())
+    assert state['rows'] == 30 and state['complete']
+
+
+def test_resuming_skips_rows_already_done(tmp_path, speeches_path,
+                                          fake_elastic):
+    path = tmp_path / 'checkpoint.json'
+    checkpoint = Checkpoint(path, speeches_path, 'speeches')
+    checkpoint.advance(20)
+    checkpoint.save()
+    count, _ = index_speeches(speeches_path, 'speeches', None, 1,
+                              resume=True, checkpoint_path=path,
+                              dead_letter_path=tmp_path / 'failed.csv')
+    assert count == 10
+    assert len(fake_elastic.indices['speeches'].docs) == 10
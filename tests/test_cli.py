@@ -0,0 +1,17 @@
+import pytest
+from click.testing import CliRunner
+
+from austxt.cli import cli
+
+
+@pytest.mark.parametrize('command', [
+    ['query', 'tax'],
+    ['kwic', 'tax'],
+    ['make-dataset', '{speeches}', 'tax'],
+])
+def test_filters_need_the_elastic_backend(command, speeches_path):
+    command = [arg.format(speeches=speeches_path) for arg in command]
+    result = CliRunner().invoke(
+        cli, command + ['--backend', 'local', '--party', 'ALP'])
+    assert result.exit_code == 2
+    assert "filtering with --party needs the elastic backend" in result.output
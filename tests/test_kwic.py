@@ -0,0 +1,49 @@
+from austxt.kwic import (MARK_START, MARK_END, marked_spans, merge_spans,
+                         query_spans, windows)
+
+
+TEXT = "We want a carbon tax. The tax on carbon is, they say, a tax on  carbon."
+
+
+def mark(text, spans):
+    for start, end in reversed(spans):
+        text = (text[:start] + MARK_START + text[start:end] + MARK_END +
+                text[end:])
+    return text
+
+
+def test_marked_spans_are_found_and_removed():
+    spans = [(10, 16), (17, 20)]
+    assert marked_spans(mark(TEXT, spans)) == (TEXT, spans)
+
+
+def test_words_of_a_phrase_are_merged():
+    # each word highlighted separately, as elasticsearch does
+    spans = [(26, 29), (33, 39), (56, 59), (64, 70)]
+    assert merge_spans(TEXT, spans) == [(26, 39), (56, 70)]
+
+
+def test_spans_across_punctuation_and_whitespace_are_merged():
+    text = "carbon, tax"
+    assert merge_spans(text, [(8, 11), (0, 6)]) == [(0, 11)]
+
+
+def test_spans_separated_by_other_words_are_not_merged():
+    # "a carbon" between the first two, only ". The" between the last two
+    spans = [(3, 7), (17, 20), (26, 29)]
+    assert merge_spans(TEXT, spans) == [(3, 7), (17, 29)]
+
+
+def test_phrase_spans_match_merged_highlights():
+    words = query_spans(TEXT, 'tax on carbon', 'and')
+    assert query_spans(TEXT, 'tax on carbon', 'exact') == [(26, 39), (56, 70)]
+    # the and query also matches the carbon tax just before the first
+    assert merge_spans(TEXT, words) == [(10, 39), (56, 70)]
+
+
+def test_windows_are_cut_on_words():
+    spans = query_spans(TEXT, 'tax on carbon', 'exact')
+    assert windows(TEXT, spans, 2) == [
+        {'left': 'tax. The', 'match': 'tax on carbon', 'right': 'is, they'},
+        {'left': 'say, a', 'match': 'tax on carbon', 'right': ''},
+    ]
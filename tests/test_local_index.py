@@ -0,0 +1,32 @@
+import pytest
+
+from austxt.elastic import index_speeches
+from austxt.backends import ElasticBackend
+from austxt.local_index import LocalIndex, build_local_index
+
+
+@pytest.fixture
+def local_index(tmp_path, speeches_path):
+    build_local_index(speeches_path, tmp_path / 'index', chunk_size=7)
+    return LocalIndex(tmp_path / 'index')
+
+
+@pytest.mark.parametrize('query, query_type', [
+    ('tax', 'and'),
+    ('carbon taxes', 'and'),
+    ('drought farmers', 'or'),
+    ('carbon tax', 'exact'),
+    ('tax on carbon', 'exact'),
+    ('answered questions', 'exact'),
+    ('nothing', 'and'),
+])
+def test_term_frequencies_match_elasticsearch(query, query_type, tmp_path,
+                                              speeches_path, local_index,
+                                              fake_elastic):
+    index_speeches(speeches_path, 'speeches', None, 1,
+                   checkpoint_path=tmp_path / 'checkpoint.json',
+                   dead_letter_path=tmp_path / 'failed.csv')
+    expected = ElasticBackend('speeches').iter_term_frequencies(query,
+                                                                query_type)
+    found = local_index.term_frequencies(query, query_type)
+    assert sorted(found) == sorted(expected)
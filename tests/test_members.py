@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+
+from austxt.members import member_intervals, add_member_attributes, \
+    load_member_intervals, MEMBER_COLUMNS
+
+
+@pytest.fixture
+def members_df():
+    return pd.DataFrame({
+        'member_id': [1, 2, 3, 3],
+        'from_date': ['2000-01-01', '2005-06-01', '1990-01-01', '2002-01-01'],
+        'to_date': ['2004-12-31', None, '2001-12-31', None],
+        'division': ['NSW', 'Vic', 'Qld', 'Qld'],
+        'party': ['Labor', 'Liberal', 'Democrats', 'Independent'],
+        'gender': ['female', 'male', 'male', 'male'],
+    })
+
+
+@pytest.fixture
+def speeches_df():
+    return pd.DataFrame({
+        'speech_id': [f'sen{i}' for i in range(6)],
+        'speaker_id': [1, 1, 2, 3, 3, 4],
+        'date': ['2001-03-04', '2010-01-01', '2000-01-01', '1995-05-05',
+                 '2003-03-03', '2001-01-01'],
+    })
+
+
+def baseline_join(speeches_df, members_df):
+    """Join on member ID alone, as before members had periods"""
+    return speeches_df.merge(
+        members_df[['member_id'] + MEMBER_COLUMNS], left_on='speaker_id',
+        right_on='member_id', how='left').drop('member_id', axis=1)
+
+
+def test_matches_baseline_when_members_have_one_period(members_df,
+                                                       speeches_df):
+    members_df = members_df.drop_duplicates('member_id')
+    speeches_df = speeches_df[speeches_df.speaker_id != 3]
+    result = add_member_attributes(speeches_df, member_intervals(members_df))
+    expected = baseline_join(speeches_df, members_df)
+    assert list(result.columns) == list(expected.columns)
+    for column in MEMBER_COLUMNS:
+        pd.testing.assert_series_equal(result[column],
+                                       expected[column].astype(object))
+
+
+def test_speeches_take_the_period_of_their_date(members_df, speeches_df):
+    result = add_member_attributes(speeches_df, member_intervals(members_df))
+    assert result['party'].tolist()[:5] == [
+        'Labor',        # during the only period
+        'Labor',        # after it, so the nearest
+        'Liberal',      # before it, so the nearest
+        'Democrats',    # during the first of two
+        'Independent',  # during the second
+    ]
+    # not a member
+    assert pd.isna(result['party'][5])
+    assert result['speech_id'].tolist() == speeches_df['speech_id'].tolist()
+
+
+def test_lookup_is_cached_where_asked(tmp_path):
+    path = tmp_path / 'members.csv'
+    pd.DataFrame({
+        'member_id': [10, 11],
+        'from_date': ['2010-01-01', '2012-01-01'],
+        'to_date': ['2011-01-01', None],
+        'division': ['ACT', 'WA'],
+        'party': ['Greens', 'Nationals'],
+        'gender': ['female', 'male'],
+    }).to_csv(path, index=False)
+    intervals = load_member_intervals(path, tmp_path / 'cache')
+    assert (tmp_path / 'cache' / 'members_intervals.parquet').exists()
+    speeches_df = pd.DataFrame({'speech_id': ['a', 'b'], 'speaker_id': [10, 11],
+                                'date': ['2015-01-01', '2011-01-01']})
+    result = add_member_attributes(speeches_df, intervals)
+    assert result['party'].tolist() == ['Greens', 'Nationals']
@@ -0,0 +1,32 @@
+import time
+from multiprocessing.pool import ThreadPool
+
+from austxt.process import bounded_starmap
+
+
+def slow_square(x):
+    time.sleep(0.01)
+    return x * x
+
+
+def test_bounded_starmap_keeps_order():
+    with ThreadPool(3) as pool:
+        assert list(bounded_starmap(pool, slow_square,
+                                    [(x,) for x in range(20)], 3)) == \
+            [x * x for x in range(20)]
+
+
+def test_bounded_starmap_only_reads_ahead_of_the_pool():
+    read = []
+
+    def args():
+        for x in range(100):
+            read.append(x)
+            yield (x,)
+
+    with ThreadPool(2) as pool:
+        results = bounded_starmap(pool, slow_square, args(), 2)
+        assert next(results) == 0
+        # the first result is taken once four are in flight
+        assert len(read) == 4
+        assert list(results) == [x * x for x in range(1, 100)]
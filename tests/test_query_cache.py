@@ -0,0 +1,91 @@
+from austxt.query_cache import QueryCache, CachedBackend, bump_generation
+
+
+RESULTS = [('sen_1', 3), ('sen_2', 1), ('rep_1', 2)]
+
+
+class CountingBackend:
+    """Returns the same hits for every query, counting the queries sent"""
+
+    index_name = 'speeches'
+
+    def __init__(self):
+        self.queries = []
+
+    def query_term_frequencies(self, queries, size=None, filters=None):
+        self.queries.extend(queries)
+        return [RESULTS for _ in queries]
+
+    def iter_term_frequencies(self, query, query_type, size=None,
+                              filters=None):
+        self.queries.append((query, query_type))
+        return iter(RESULTS)
+
+
+def test_results_round_trip(tmp_path):
+    cache = QueryCache(tmp_path)
+    key = cache.key('local', 'speeches', 'tax', 'and', None)
+    assert cache.get(key) is None
+    cache.put(key, RESULTS)
+    assert cache.get(key) == RESULTS
+    # and from disk, in a new process
+    assert QueryCache(tmp_path).get(key) == RESULTS
+
+
+def test_keys_ignore_case_and_spacing_but_not_filters(tmp_path):
+    cache = QueryCache(tmp_path)
+    key = cache.key('local', 'speeches', 'Carbon  tax', 'and', None)
+    assert key == cache.key('local', 'speeches', 'carbon tax', 'and', None)
+    assert key != cache.key('local', 'speeches', 'carbon tax', 'exact', None)
+    assert key != cache.key('local', 'speeches', 'carbon tax', 'and', None,
+                            {'party': ['ALP']})
+
+
+def test_bumping_the_generation_changes_keys(tmp_path):
+    cache = QueryCache(tmp_path)
+    key = cache.key('local', 'speeches', 'tax', 'and', None)
+    cache.put(key, RESULTS)
+    bump_generation('speeches', tmp_path)
+    new_key = cache.key('local', 'speeches', 'tax', 'and', None)
+    assert new_key != key and cache.get(new_key) is None
+    # other indices are unaffected
+    assert cache.key('local', 'other', 'tax', 'and', None) == cache.key(
+        'local', 'other', 'tax', 'and', None)
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = QueryCache(tmp_path, memory_bytes=1, disk_bytes=10 ** 9)
+    keys = [cache.key('local', 'speeches', q, 'and', None)
+            for q in ['a', 'b', 'c']]
+    for key in keys:
+        cache.put(key, RESULTS)
+    # only the latest is kept in memory, the rest are read from disk
+    assert list(cache.memory) == keys[-1:]
+    assert cache.get(keys[0]) == RESULTS
+
+    cache.disk_bytes = 0
+    cache.evict_disk()
+    assert not list(tmp_path.glob('*.npz'))
+
+
+def test_only_queries_not_cached_are_sent(tmp_path):
+    backend = CountingBackend()
+    cached = CachedBackend(backend, QueryCache(tmp_path))
+    cached.query_term_frequencies([('tax', 'and')])
+    results = cached.query_term_frequencies([('tax', 'and'),
+                                             ('water', 'or')])
+    assert results == [RESULTS, RESULTS]
+    assert backend.queries == [('tax', 'and'), ('water', 'or')]
+
+
+def test_streamed_hits_are_cached_once_read(tmp_path):
+    backend = CountingBackend()
+    cached = CachedBackend(backend, QueryCache(tmp_path))
+    hits = cached.iter_term_frequencies('tax', 'and')
+    next(hits)
+    # a partly read result isn't cached
+    cached.iter_term_frequencies('tax', 'and')
+    assert len(backend.queries) == 2
+    assert list(hits) == RESULTS[1:]
+    assert list(cached.iter_term_frequencies('tax', 'and')) == RESULTS
+    assert len(backend.queries) == 2
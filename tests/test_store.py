@@ -0,0 +1,50 @@
+import threading
+
+import pandas as pd
+
+from austxt.store import replace_file, build_store, load_store
+
+
+def test_replace_file_leaves_no_tmp_files(tmp_path):
+    path = tmp_path / 'file.txt'
+    replace_file(path, lambda tmp: tmp.write_text('hello'))
+    assert path.read_text() == 'hello'
+    assert [p.name for p in tmp_path.iterdir()] == ['file.txt']
+
+
+def test_concurrent_writers_never_move_partial_files(tmp_path):
+    path = tmp_path / 'file.txt'
+    started = threading.Barrier(2)
+    errors = []
+
+    def write(text):
+        def write_slowly(tmp):
+            with open(tmp, 'w') as f:
+                f.write(text[:5])
+                f.flush()
+                started.wait()
+                f.write(text[5:])
+        try:
+            replace_file(path, write_slowly)
+        except OSError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=write, args=(text,))
+               for text in ['a' * 10, 'b' * 10]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert path.read_text() in ('a' * 10, 'b' * 10)
+    assert [p.name for p in tmp_path.iterdir()] == ['file.txt']
+
+
+def test_store_is_built_once_and_reloaded(tmp_path):
+    source = tmp_path / 'speeches.csv'
+    pd.DataFrame({'speech_id': ['b', 'a', 'c'],
+                  'speaker_id': [1, 2, 3]}).to_csv(source, index=False)
+    build_store(source, tmp_path / 'store', 'speeches')
+    store = load_store(source, tmp_path / 'store', 'speeches')
+    assert len(store) == 3
+    assert not list((tmp_path / 'store').glob('*.tmp'))